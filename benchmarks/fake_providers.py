@@ -0,0 +1,633 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import copy
+import ipaddress
+import json
+import random
+import re
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+# Local stand-ins for Rackspace identity and Cloud DNS APIs, Azure DNS management API and AWS Route 53 API.
+# Only the calls made by Cloud DynDNS are emulated. Every request is counted,
+# latency and errors can be injected.
+# Authoritative nameservers answer UDP queries from the same zones, each one serving
+# the changes after a propagation delay of its own.
+
+RACKSPACE_PREFIX = '/rackspace'
+RACKSPACE_TENANT = '123456'
+RACKSPACE_PAGE_SIZE = 100
+
+AZURE_PREFIX = '/azure'
+AZURE_SUBSCRIPTION = '00000000-0000-0000-0000-000000000001'
+AZURE_RESOURCE_GROUP = 'dns-rg'
+AZURE_PAGE_SIZE = 100
+
+ROUTE53_PREFIX = '/route53'
+ROUTE53_API_VERSION = '2013-04-01'
+ROUTE53_XMLNS = 'https://route53.amazonaws.com/doc/2013-04-01/'
+ROUTE53_PAGE_SIZE = 300
+
+# Requests to these paths control the fake, they are not counted
+CONTROL_PREFIX = '/_bench'
+
+# Name of the nameserver of every zone, it resolves into the loopback address
+NAMESERVER_NAME = 'localhost'
+DNS_QTYPES = {1: 'A', 2: 'NS', 28: 'AAAA'}
+
+
+class FakeDns(object):
+    """
+    DNS zones shared by all fake APIs: zone name: {(record name, record type): IP-address}
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.initial_zones = {}
+        self.zone_ids = {}
+        self.record_ids = {}
+        self.etags = {}
+        # (zone, record name, record type): time of change, previous IP-address
+        self.changes = {}
+        self.requests = 0
+        self.errors = 0
+        self.dns_queries = 0
+
+    def load(self, zones):
+        """
+        :param zones: dict, zone name: {(record name, record type): IP-address}
+        :return:
+        """
+        with self.lock:
+            self.initial_zones = copy.deepcopy(zones)
+            self.zone_ids = {zone: str(1000000 + index) for index, zone in enumerate(sorted(zones))}
+            self._reset()
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self.zones = copy.deepcopy(self.initial_zones)
+        self.record_ids = {}
+        self.etags = {}
+        self.changes = {}
+        self.requests = 0
+        self.errors = 0
+        self.dns_queries = 0
+
+    def put_record(self, zone, name, record_type, ip):
+        """
+        Change a record. Nameservers keep serving the previous address for their propagation delay.
+        """
+        self.changes[(zone, name, record_type)] = (time.monotonic(), self.zones[zone].get((name, record_type)))
+        self.zones[zone][(name, record_type)] = ip
+
+    def served_record(self, zone, name, record_type, propagation_delay=0.0):
+        """
+        :param propagation_delay: seconds it takes for a change to reach the nameserver
+        :return: IP-address served by a nameserver, None if it has no such record
+        """
+        changed_at, previous_ip = self.changes.get((zone, name, record_type), (None, None))
+        if changed_at is not None and time.monotonic() - changed_at < propagation_delay:
+            return previous_ip
+
+        return self.zones[zone].get((name, record_type))
+
+    def zone_by_id(self, zone_id):
+        for zone, known_id in self.zone_ids.items():
+            if known_id == zone_id:
+                return zone
+
+        return None
+
+    def record_id(self, zone, name, record_type):
+        key = (zone, name, record_type)
+        if key not in self.record_ids:
+            self.record_ids[key] = "{0}-{1}".format(record_type, uuid.uuid4().hex[:12])
+
+        return self.record_ids[key]
+
+    def etag(self, zone, name, record_type, changed=False):
+        """
+        :param changed: record was written, give it a new ETag
+        :return: str, ETag of the record
+        """
+        key = (zone, name, record_type)
+        if changed or key not in self.etags:
+            self.etags[key] = uuid.uuid4().hex
+
+        return self.etags[key]
+
+    def record_by_id(self, record_id):
+        for key, known_id in self.record_ids.items():
+            if known_id == record_id:
+                return key
+
+        return None
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        if body and not url.path.startswith(ROUTE53_PREFIX):
+            body = json.loads(body)
+        dns = self.server.dns
+
+        if url.path.startswith(CONTROL_PREFIX):
+            self._control(method, url.path[len(CONTROL_PREFIX):])
+            return
+
+        with dns.lock:
+            dns.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            with dns.lock:
+                dns.errors += 1
+            if url.path.startswith(ROUTE53_PREFIX):
+                self._respond_xml(*self._route53_error(503, 'ServiceUnavailable', 'Injected error'),
+                                  headers={'Retry-After': '0'})
+            else:
+                self._respond(503, {'message': 'Injected error'}, {'Retry-After': '0'})
+            return
+
+        if url.path.startswith(ROUTE53_PREFIX):
+            with dns.lock:
+                status, data = self._route53(method, url.path[len(ROUTE53_PREFIX):], query, body)
+            self._respond_xml(status, data)
+            return
+
+        with dns.lock:
+            if url.path.startswith(RACKSPACE_PREFIX):
+                status, data = self._rackspace(method, url.path[len(RACKSPACE_PREFIX):], query, body)
+            elif url.path.startswith(AZURE_PREFIX):
+                status, data = self._azure(method, url.path[len(AZURE_PREFIX):], query, body)
+            else:
+                status, data = 404, {'message': 'Not found'}
+        self._respond(status, data)
+
+    def _control(self, method, path):
+        dns = self.server.dns
+        if path == '/stats':
+            with dns.lock:
+                self._respond(200, {'requests': dns.requests, 'errors': dns.errors, 'dns_queries': dns.dns_queries})
+        elif path == '/reset' and method == 'POST':
+            dns.reset()
+            self._respond(200, {})
+        else:
+            self._respond(404, {'message': 'Not found'})
+
+    def _respond(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond_xml(self, status, data, headers=None):
+        body = data.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _base_url(self):
+        return "http://{0}:{1}".format(*self.server.server_address[:2])
+
+    # Rackspace
+
+    def _rackspace(self, method, path, query, body):
+        dns = self.server.dns
+        if path == '/identity/v2.0/tokens' and method == 'POST':
+            return 200, self._rackspace_token()
+
+        match = re.match(r'^/v1\.0/{0}/domains(/([^/]+)(/records)?)?$'.format(RACKSPACE_TENANT), path)
+        if not match:
+            return 404, {'message': 'Not found'}
+        if not match.group(1):
+            # Domain search
+            zone = query.get('name', '').lower()
+            domains = [{'id': int(dns.zone_ids[zone]), 'name': zone}] if zone in dns.zones else []
+            return 200, {'domains': domains, 'totalEntries': len(domains)}
+
+        zone = dns.zone_by_id(match.group(2))
+        if zone is None:
+            return 404, {'code': 404, 'message': 'Object not Found.'}
+        if not match.group(3):
+            return 200, {'id': int(dns.zone_ids[zone]), 'name': zone}
+
+        if method == 'GET':
+            return 200, self._rackspace_records(zone, query)
+        if method == 'POST':
+            added = []
+            for record in body['records']:
+                name = record['name'][:-len(zone) - 1]
+                dns.put_record(zone, name, record['type'], record['data'])
+                added.append(self._rackspace_record(zone, name, record['type'], record['data']))
+            return 202, self._rackspace_job({'records': added})
+        if method == 'PUT':
+            for record in body['records']:
+                _, name, record_type = dns.record_by_id(record['id'])
+                dns.put_record(zone, name, record_type, record['data'])
+            return 202, self._rackspace_job(None)
+
+        return 405, {'message': 'Method not allowed'}
+
+    def _rackspace_token(self):
+        return {
+            "access": {
+                "token": {
+                    "id": uuid.uuid4().hex,
+                    "expires": time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time() + 86400)),
+                    "tenant": {"id": RACKSPACE_TENANT, "name": RACKSPACE_TENANT},
+                },
+                "user": {"id": "1", "name": "bench", "roles": [], "RAX-AUTH:defaultRegion": "DFW"},
+                "serviceCatalog": [{
+                    "name": "cloudDNS",
+                    "type": "rax:dns",
+                    "endpoints": [{
+                        "publicURL": "{0}{1}/v1.0/{2}".format(self._base_url(), RACKSPACE_PREFIX, RACKSPACE_TENANT),
+                        "tenantId": RACKSPACE_TENANT,
+                    }],
+                }],
+            }
+        }
+
+    def _rackspace_record(self, zone, name, record_type, ip):
+        dns = self.server.dns
+        return {'id': dns.record_id(zone, name, record_type), 'name': "{0}.{1}".format(name, zone),
+                'type': record_type, 'data': ip, 'ttl': 300}
+
+    def _rackspace_records(self, zone, query):
+        records = [self._rackspace_record(zone, name, record_type, ip)
+                   for (name, record_type), ip in sorted(self.server.dns.zones[zone].items())]
+        if 'type' in query:
+            records = [record for record in records if record['type'] == query['type']]
+        if 'name' in query:
+            records = [record for record in records if record['name'] == query['name']]
+            return {'records': records}
+
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', RACKSPACE_PAGE_SIZE))
+        data = {'records': records[offset:offset + limit], 'totalEntries': len(records)}
+        if offset + limit < len(records):
+            data['links'] = [{'rel': 'next', 'href': "{0}{1}/v1.0/{2}/domains/{3}/records?{4}".format(
+                self._base_url(), RACKSPACE_PREFIX, RACKSPACE_TENANT, self.server.dns.zone_ids[zone],
+                urlencode({'limit': limit, 'offset': offset + limit}))}]
+
+        return data
+
+    def _rackspace_job(self, response):
+        job_id = uuid.uuid4().hex
+        job = {'status': 'COMPLETED', 'jobId': job_id,
+               'callbackUrl': "{0}{1}/v1.0/{2}/status/{3}".format(self._base_url(), RACKSPACE_PREFIX,
+                                                                  RACKSPACE_TENANT, job_id)}
+        if response is not None:
+            job['response'] = response
+
+        return job
+
+    # Azure
+
+    def _azure(self, method, path, query, body):
+        dns = self.server.dns
+        zones_path = '/subscriptions/{0}/providers/Microsoft.Network/dnszones'.format(AZURE_SUBSCRIPTION)
+        if path.lower() == zones_path.lower():
+            zones = [self._azure_zone(zone) for zone in sorted(dns.zones)]
+            return 200, self._azure_page(zones, query, AZURE_PREFIX + path)
+
+        match = re.match(r'^/subscriptions/{0}/resourceGroups/([^/]+)/providers/Microsoft\.Network/dnszones/([^/]+)'
+                         r'(/(recordsets|A|AAAA)(/([^/]+))?)?$'.format(AZURE_SUBSCRIPTION), path, re.IGNORECASE)
+        if not match or match.group(1) != AZURE_RESOURCE_GROUP or match.group(2).lower() not in dns.zones:
+            return 404, {'error': {'code': 'ResourceNotFound', 'message': 'Not found'}}
+        zone = match.group(2).lower()
+        if not match.group(3):
+            return 200, self._azure_zone(zone)
+
+        if match.group(4).lower() == 'recordsets':
+            suffix = query.get('$recordsetnamesuffix')
+            record_sets = [self._azure_record_set(zone, name, record_type, ip)
+                           for (name, record_type), ip in sorted(dns.zones[zone].items())
+                           if not suffix or name.endswith('.' + suffix)]
+            return 200, self._azure_page(record_sets, query, AZURE_PREFIX + path)
+
+        record_type = match.group(4).upper()
+        name = match.group(6)
+        if method == 'GET':
+            if (name, record_type) not in dns.zones[zone]:
+                return 404, {'error': {'code': 'NotFound', 'message': 'Record set not found'}}
+            return 200, self._azure_record_set(zone, name, record_type, dns.zones[zone][(name, record_type)])
+        if method == 'PUT':
+            exists = (name, record_type) in dns.zones[zone]
+            if_match = self.headers.get('If-Match')
+            if_none_match = self.headers.get('If-None-Match')
+            if (if_match and (not exists or if_match != dns.etag(zone, name, record_type))) or \
+                    (if_none_match == '*' and exists):
+                return 412, {'error': {'code': 'PreconditionFailed', 'message': 'Record set has been modified'}}
+            properties = body['properties']
+            if record_type == 'AAAA':
+                ip = properties['AAAARecords'][0]['ipv6Address']
+            else:
+                ip = properties['ARecords'][0]['ipv4Address']
+            dns.put_record(zone, name, record_type, ip)
+            dns.etag(zone, name, record_type, changed=True)
+            return 200 if exists else 201, self._azure_record_set(zone, name, record_type, ip)
+
+        return 405, {'error': {'code': 'MethodNotAllowed', 'message': 'Method not allowed'}}
+
+    def _azure_page(self, items, query, path):
+        skip = int(query.get('$skipToken', 0))
+        top = int(query.get('$top', AZURE_PAGE_SIZE))
+        data = {'value': items[skip:skip + top]}
+        if skip + top < len(items):
+            next_query = dict(query)
+            next_query['$skipToken'] = skip + top
+            data['nextLink'] = "{0}{1}?{2}".format(self._base_url(), path, urlencode(next_query))
+
+        return data
+
+    @staticmethod
+    def _azure_zone_id(zone):
+        return '/subscriptions/{0}/resourceGroups/{1}/providers/Microsoft.Network/dnszones/{2}'.format(
+            AZURE_SUBSCRIPTION, AZURE_RESOURCE_GROUP, zone)
+
+    def _azure_zone(self, zone):
+        return {'id': self._azure_zone_id(zone), 'name': zone, 'type': 'Microsoft.Network/dnszones',
+                'location': 'global', 'properties': {'numberOfRecordSets': len(self.server.dns.zones[zone])}}
+
+    def _azure_record_set(self, zone, name, record_type, ip):
+        properties = {'TTL': 300, 'fqdn': "{0}.{1}.".format(name, zone)}
+        if record_type == 'AAAA':
+            properties['AAAARecords'] = [{'ipv6Address': ip}]
+        else:
+            properties['ARecords'] = [{'ipv4Address': ip}]
+
+        return {'id': "{0}/{1}/{2}".format(self._azure_zone_id(zone), record_type, name), 'name': name,
+                'type': 'Microsoft.Network/dnszones/{0}'.format(record_type),
+                'etag': self.server.dns.etag(zone, name, record_type),
+                'properties': properties}
+
+
+    # Route 53
+
+    def _route53(self, method, path, query, body):
+        dns = self.server.dns
+        if path == '/{0}/hostedzonesbyname'.format(ROUTE53_API_VERSION) and method == 'GET':
+            return 200, self._route53_zones_by_name(query)
+
+        match = re.match(r'^/{0}/hostedzone/([^/]+)/rrset/?$'.format(ROUTE53_API_VERSION), path)
+        if not match:
+            return self._route53_error(404, 'NotFound', 'Not found')
+        zone = dns.zone_by_id(match.group(1))
+        if zone is None:
+            return self._route53_error(404, 'NoSuchHostedZone', 'No hosted zone found with ID: ' + match.group(1))
+
+        if method == 'GET':
+            return 200, self._route53_record_sets(zone, query)
+        if method == 'POST':
+            changes = []
+            for change in ElementTree.fromstring(body).iter('{%s}Change' % ROUTE53_XMLNS):
+                record_set = change.find('{%s}ResourceRecordSet' % ROUTE53_XMLNS)
+                name = record_set.findtext('{%s}Name' % ROUTE53_XMLNS).rstrip('.').lower()
+                if change.findtext('{%s}Action' % ROUTE53_XMLNS) != 'UPSERT' or not name.endswith('.' + zone):
+                    return self._route53_error(400, 'InvalidChangeBatch', 'Unsupported change for ' + name)
+                changes.append(((name[:-len(zone) - 1], record_set.findtext('{%s}Type' % ROUTE53_XMLNS)),
+                                record_set.findtext('.//{%s}Value' % ROUTE53_XMLNS)))
+            # Changes of a batch are applied all at once
+            for (name, record_type), ip in changes:
+                dns.put_record(zone, name, record_type, ip)
+            return 200, ('<ChangeResourceRecordSetsResponse xmlns="{0}"><ChangeInfo><Id>/change/C{1}</Id>'
+                         '<Status>PENDING</Status><SubmittedAt>{2}</SubmittedAt></ChangeInfo>'
+                         '</ChangeResourceRecordSetsResponse>').format(
+                ROUTE53_XMLNS, uuid.uuid4().hex[:12].upper(), time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+
+        return self._route53_error(405, 'MethodNotAllowed', 'Method not allowed')
+
+    def _route53_zones_by_name(self, query):
+        dns = self.server.dns
+        dns_name = query.get('dnsname', '').rstrip('.').lower()
+        max_items = int(query.get('maxitems', 100))
+        zones = [zone for zone in sorted(dns.zones, key=self._route53_sort_key) if
+                 self._route53_sort_key(zone) >= self._route53_sort_key(dns_name)][:max_items]
+        hosted_zones = ''.join(
+            '<HostedZone><Id>/hostedzone/{0}</Id><Name>{1}.</Name><CallerReference>{0}</CallerReference>'
+            '<Config><PrivateZone>false</PrivateZone></Config><ResourceRecordSetCount>{2}</ResourceRecordSetCount>'
+            '</HostedZone>'.format(dns.zone_ids[zone], escape(zone), len(dns.zones[zone])) for zone in zones)
+
+        return ('<ListHostedZonesByNameResponse xmlns="{0}"><HostedZones>{1}</HostedZones><DNSName>{2}</DNSName>'
+                '<IsTruncated>false</IsTruncated><MaxItems>{3}</MaxItems></ListHostedZonesByNameResponse>').format(
+            ROUTE53_XMLNS, hosted_zones, escape(dns_name), max_items)
+
+    def _route53_record_sets(self, zone, query):
+        records = sorted(((self._route53_sort_key("{0}.{1}".format(name, zone)), record_type), name, ip)
+                         for (name, record_type), ip in self.server.dns.zones[zone].items())
+        if 'name' in query:
+            start = (self._route53_sort_key(query['name'].rstrip('.').lower()), query.get('type', ''))
+            records = [record for record in records if record[0] >= start]
+        max_items = int(query.get('maxitems', ROUTE53_PAGE_SIZE))
+        page, rest = records[:max_items], records[max_items:]
+
+        record_sets = ''.join(
+            '<ResourceRecordSet><Name>{0}.{1}.</Name><Type>{2}</Type><TTL>300</TTL><ResourceRecords>'
+            '<ResourceRecord><Value>{3}</Value></ResourceRecord></ResourceRecords></ResourceRecordSet>'.format(
+                escape(name), escape(zone), record_type, escape(ip)) for (_, record_type), name, ip in page)
+        next_record = ''
+        if rest:
+            (_, next_type), next_name, _ = rest[0]
+            next_record = '<NextRecordName>{0}.{1}.</NextRecordName><NextRecordType>{2}</NextRecordType>'.format(
+                escape(next_name), escape(zone), next_type)
+
+        return ('<ListResourceRecordSetsResponse xmlns="{0}"><ResourceRecordSets>{1}</ResourceRecordSets>'
+                '<IsTruncated>{2}</IsTruncated>{3}<MaxItems>{4}</MaxItems></ListResourceRecordSetsResponse>').format(
+            ROUTE53_XMLNS, record_sets, 'true' if rest else 'false', next_record, max_items)
+
+    @staticmethod
+    def _route53_sort_key(name):
+        # Route 53 orders names by their labels in reverse: com.example.www
+        return tuple(reversed(name.split('.')))
+
+    @staticmethod
+    def _route53_error(status, code, message):
+        return status, ('<ErrorResponse xmlns="{0}"><Error><Type>Sender</Type><Code>{1}</Code>'
+                        '<Message>{2}</Message></Error><RequestId>{3}</RequestId></ErrorResponse>').format(
+            ROUTE53_XMLNS, code, escape(message), uuid.uuid4())
+
+
+class FakeNameserverHandler(socketserver.BaseRequestHandler):
+    """
+    Authoritative answers to A, AAAA and NS queries of the fake zones
+    """
+
+    def handle(self):
+        message, sock = self.request
+        dns = self.server.dns
+        try:
+            query_id, flags, question_count = struct.unpack_from('!HHH', message)
+            labels = []
+            offset = 12
+            while message[offset]:
+                labels.append(message[offset + 1:offset + 1 + message[offset]].decode('ascii').lower())
+                offset += 1 + message[offset]
+            qtype, _ = struct.unpack_from('!HH', message, offset + 1)
+            question = message[12:offset + 5]
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return
+        if question_count != 1:
+            return
+
+        name = '.'.join(labels)
+        record_type = DNS_QTYPES.get(qtype)
+        with dns.lock:
+            dns.dns_queries += 1
+            zone = next((zone for zone in dns.zones if name == zone or name.endswith('.' + zone)), None)
+            if zone is None:
+                # Not authoritative, refused
+                rcode, answers = 5, []
+            elif name == zone:
+                rcode = 0
+                answers = [self._name_data(NAMESERVER_NAME)] if record_type == 'NS' else []
+            else:
+                host = name[:-len(zone) - 1]
+                host_records = {served_type: dns.served_record(zone, host, served_type, self.server.propagation_delay)
+                                for served_type in ('A', 'AAAA')}
+                host_records = {served_type: ip for served_type, ip in host_records.items() if ip}
+                rcode = 0 if host_records else 3
+                answers = [ipaddress.ip_address(host_records[record_type]).packed] \
+                    if record_type in host_records else []
+
+        # Answer, authoritative
+        response = struct.pack('!HHHHHH', query_id, 0x8000 | 0x0400 | (flags & 0x0100) | rcode, 1, len(answers), 0, 0)
+        response += question
+        for data in answers:
+            # Name is a pointer to the question
+            response += struct.pack('!HHHIH', 0xc00c, qtype, 1, 300, len(data)) + data
+        sock.sendto(response, self.client_address)
+
+    @staticmethod
+    def _name_data(name):
+        return b''.join(struct.pack('!B', len(label)) + label.encode('ascii') for label in name.split('.')) + b'\0'
+
+
+class FakeProviderServer(object):
+    """
+    Serve the fake APIs in a background thread
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, address=('127.0.0.1', 0), propagation_delays=(0.0,)):
+        """
+        :param latency: seconds to delay each response
+        :param error_rate: share of requests to fail with 503, 0.0 - 1.0
+        :param address: address and port to listen on, port 0 for any free one
+        :param propagation_delays: seconds it takes for a change to reach each of the nameservers,
+        one nameserver for each
+        """
+        self.dns = FakeDns()
+        self.server = ThreadingHTTPServer(address, FakeProviderHandler)
+        self.server.daemon_threads = True
+        self.server.dns = self.dns
+        self.server.latency = latency
+        self.server.error_rate = error_rate
+        self.nameservers = []
+        for propagation_delay in propagation_delays:
+            nameserver = socketserver.ThreadingUDPServer((address[0], 0), FakeNameserverHandler)
+            nameserver.daemon_threads = True
+            nameserver.dns = self.dns
+            nameserver.propagation_delay = propagation_delay
+            self.nameservers.append(nameserver)
+        self.thread = None
+        self.nameserver_threads = []
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server.server_address[:2])
+
+    @property
+    def rackspace_auth_endpoint(self):
+        return self.url + RACKSPACE_PREFIX + '/identity/v2.0/'
+
+    @property
+    def azure_resource_manager_url(self):
+        return self.url + AZURE_PREFIX
+
+    @property
+    def route53_endpoint_url(self):
+        return self.url + ROUTE53_PREFIX
+
+    @property
+    def nameserver_address(self):
+        """
+        :return: str, address:port of the first authoritative nameserver
+        """
+        return self.nameserver_addresses[0]
+
+    @property
+    def nameserver_addresses(self):
+        """
+        :return: list of address:port of all authoritative nameservers
+        """
+        return ["{0}:{1}".format(*nameserver.server_address[:2]) for nameserver in self.nameservers]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-providers', daemon=True)
+        self.thread.start()
+        for nameserver in self.nameservers:
+            nameserver_thread = threading.Thread(target=nameserver.serve_forever, name='fake-nameserver', daemon=True)
+            nameserver_thread.start()
+            self.nameserver_threads.append(nameserver_thread)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for nameserver in self.nameservers:
+            nameserver.shutdown()
+            nameserver.server_close()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_providers
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+# Run cloud-dyndns.py against local fake Rackspace, Azure and Route 53 APIs, see fake_providers.py.
+# For each scenario: requests made to provider per run, wall time percentiles and peak RSS.
+# Needs the provider libraries installed, no network access or accounts.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-dyndns.py')
+
+PROVIDERS = ('rackspace', 'azure', 'route53')
+
+BENCH_DOMAIN = 'example.com'
+BENCH_HOST = 'bench'
+BENCH_IP = '192.0.2.1'
+OLD_IP = '192.0.2.2'
+
+# Every run verifies from the provider, and damping never defers a write
+COMMON_ARGS = ['--state-max-age', '0', '--flap-half-life', '0', '--record-update-rate', '0',
+               '--zone-update-rate', '0']
+
+# Share of hosts having a changed address in scenarios of many hosts
+CHANGED_SHARE = 0.1
+
+
+def host_scenario(current_ip):
+    """
+    A single host, given by command line
+    :param current_ip: address in DNS before the run, None for no record
+    """
+    records = {(BENCH_HOST, 'A'): current_ip} if current_ip else {}
+
+    return {
+        'zones': {BENCH_DOMAIN: records},
+        'hosts': None,
+    }
+
+
+def many_hosts_scenario(host_count):
+    """
+    Hosts of a single zone, one configuration each
+    """
+    hosts = []
+    records = {}
+    for index in range(host_count):
+        host = "host{0:04d}".format(index)
+        records[(host, 'A')] = OLD_IP if index < host_count * CHANGED_SHARE else BENCH_IP
+        hosts.append("{0}.{1}".format(host, BENCH_DOMAIN))
+
+    return {
+        'zones': {BENCH_DOMAIN: records},
+        'hosts': hosts,
+    }
+
+
+def many_zones_scenario(zone_count):
+    """
+    One host in each of the zones, one configuration each
+    """
+    hosts = []
+    zones = {}
+    for index in range(zone_count):
+        zone = "zone{0:04d}.example".format(index)
+        zones[zone] = {(BENCH_HOST, 'A'): OLD_IP if index < zone_count * CHANGED_SHARE else BENCH_IP}
+        hosts.append("{0}.{1}".format(BENCH_HOST, zone))
+
+    return {
+        'zones': zones,
+        'hosts': hosts,
+    }
+
+
+SCENARIOS = {
+    'unchanged': lambda: host_scenario(BENCH_IP),
+    'changed': lambda: host_scenario(OLD_IP),
+    'missing': lambda: host_scenario(None),
+    '500-hosts': lambda: many_hosts_scenario(500),
+    '1000-zones': lambda: many_zones_scenario(1000),
+}
+
+
+def write_credentials(provider, work_dir):
+    """
+    Fake credentials for the provider
+    :return: tuple, credentials as command line arguments and as YAML-configuration lines
+    """
+    if provider in ('rackspace', 'route53'):
+        return ['--api-user', 'bench', '--api-key', 'bench'], ['  api_user: bench', '  api_key: bench']
+
+    creds_file = os.path.join(work_dir, 'azure.json')
+    with open(creds_file, 'w') as fp:
+        json.dump({'tenant-id': 'bench', 'subscription-id': fake_providers.AZURE_SUBSCRIPTION,
+                   'spn-user': 'bench', 'password': 'bench'}, fp)
+
+    return ['--api-credentials-file', creds_file], ['  api_credentials_file: ' + creds_file]
+
+
+def seed_azure_token(creds_file):
+    """
+    Azure login goes to Azure AD with ADAL, which insists on https and a known authority.
+    Put a token into token cache instead, it is used without any requests.
+    """
+    from clouddns.azure import Azure
+
+    provider = Azure()
+    creds = provider._read_credentials_file(creds_file)
+    provider.token_cache.put(provider._token_cache_key(creds), {
+        'subscription_id': creds[1],
+        'token': {'access_token': 'bench', 'token_type': 'Bearer'},
+    }, time.time() + 3600)
+
+
+def control(server_url, action):
+    from urllib.request import urlopen
+
+    with urlopen(server_url + fake_providers.CONTROL_PREFIX + '/' + action,
+                 data=b'' if action == 'reset' else None) as resp:
+        return json.loads(resp.read())
+
+
+def run_main(module, script_args):
+    """
+    Do a single run of cloud-dyndns.py
+    :param module: cloud-dyndns.py as loaded module
+    :param script_args: command line arguments
+    :return: int, exit code
+    """
+    sys.argv = [SCRIPT] + script_args
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            module.main()
+        except SystemExit as exc:
+            return exc.code or 0
+        except Exception as exc:
+            # Injected errors may end a run with an exception from provider library
+            sys.stderr.write("Run failed: {0}\n".format(exc))
+            return 1
+
+    return 0
+
+
+def run_scenario_child(spec):
+    """
+    Run a scenario in this process. Modules are imported once, as in daemon or collector mode,
+    but token and zone caches are on disk and persist between the runs as they do for oneshot runs.
+    :param spec: dict, see run_scenario()
+    :return: dict of results
+    """
+    import importlib.util
+
+    module_spec = importlib.util.spec_from_file_location('cloud_dyndns', SCRIPT)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    if spec['provider'] == 'azure':
+        seed_azure_token(spec['args'][spec['args'].index('--api-credentials-file') + 1])
+
+    requests = []
+    wall_ms = []
+    errors = 0
+    for _ in range(spec['runs']):
+        control(spec['server'], 'reset')
+        start = time.perf_counter()
+        exit_code = run_main(module, spec['args'])
+        wall_ms.append((time.perf_counter() - start) * 1000)
+        requests.append(control(spec['server'], 'stats')['requests'])
+        if exit_code:
+            errors += 1
+
+    return {
+        'requests': requests,
+        'wall_ms': wall_ms,
+        'errors': errors,
+        # Kilobytes on Linux
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run_scenario(server, provider, name, runs, extra_args=()):
+    """
+    Run a scenario in a child process, for peak memory of the scenario only
+    :param extra_args: more command line arguments for every run
+    """
+    scenario = SCENARIOS[name]()
+    server.dns.load(scenario['zones'])
+    with tempfile.TemporaryDirectory() as work_dir:
+        creds_args, creds_config = write_credentials(provider, work_dir)
+        if scenario['hosts'] is None:
+            args = ['--provider', provider, '--hostname', "{0}.{1}".format(BENCH_HOST, BENCH_DOMAIN),
+                    '--ip-address', BENCH_IP] + creds_args
+        else:
+            config_dir = os.path.join(work_dir, 'config')
+            os.mkdir(config_dir)
+            for index, fqdn in enumerate(scenario['hosts']):
+                with open(os.path.join(config_dir, "{0:04d}.yaml".format(index)), 'w') as fp:
+                    fp.write('\n'.join(['dyndns:', '  provider: ' + provider, '  hostname: ' + fqdn,
+                                        '  ip_address: ' + BENCH_IP] + creds_config) + '\n')
+            args = ['--config-dir', config_dir] + creds_args
+
+        env = dict(os.environ)
+        env.pop('STATE_DIRECTORY', None)
+        env.pop('CACHE_DIRECTORY', None)
+        env['XDG_STATE_HOME'] = os.path.join(work_dir, 'state')
+        env['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+        env['CLOUD_AUTH_ENDPOINT'] = server.rackspace_auth_endpoint
+        env['AZURE_RESOURCE_MANAGER_URL'] = server.azure_resource_manager_url
+        env['AWS_ENDPOINT_URL_ROUTE_53'] = server.route53_endpoint_url
+        # Child imports clouddns from this source tree
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(SCRIPT), env.get('PYTHONPATH')]))
+        spec = {'provider': provider, 'server': server.url, 'runs': runs,
+                'args': args + COMMON_ARGS + list(extra_args)}
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-scenario', json.dumps(spec)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError("Scenario {0} of {1} failed with exit code {2}:\n{3}".format(
+                name, provider, proc.returncode, proc.stderr))
+
+    return json.loads(proc.stdout)
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+
+    return ordered[min(len(ordered) - 1, int(round(percent / 100.0 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Provider request benchmark of cloud-dyndns.py against fake APIs')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Runs per scenario. Default: 20')
+    parser.add_argument('--provider', action='append', choices=PROVIDERS,
+                        help='Provider to benchmark, can be given multiple times. Default: all')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be given multiple times. Default: all')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Delay of each fake API response in milliseconds. Default: 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of fake API requests failing with 503, 0.0 - 1.0. Default: 0.0')
+    parser.add_argument('--dns-precheck', action='store_true',
+                        help='Pre-check addresses from the fake authoritative nameservers')
+    parser.add_argument('--verify-propagation', action='store_true',
+                        help='Wait for updates to propagate into the fake authoritative nameservers')
+    parser.add_argument('--propagation-delays-ms', default='0', metavar='DELAYS',
+                        help='Comma-separated propagation delays of fake nameservers in milliseconds, '
+                             'one nameserver for each. Default: 0')
+    parser.add_argument('--run-scenario', metavar='JSON',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario_child(json.loads(args.run_scenario))))
+        exit(0)
+
+    server = fake_providers.FakeProviderServer(latency=args.latency_ms / 1000.0, error_rate=args.error_rate,
+                                               propagation_delays=[float(delay) / 1000.0 for delay in
+                                                                   args.propagation_delays_ms.split(',')])
+    server.start()
+    extra_args = []
+    if args.dns_precheck:
+        extra_args.append('--dns-precheck')
+    if args.verify_propagation:
+        extra_args.append('--verify-propagation')
+    if extra_args:
+        extra_args += ['--dns-precheck-servers', ','.join(server.nameserver_addresses)]
+    try:
+        print("%-10s %-11s %8s %8s %10s %10s %10s %7s" % ('provider', 'scenario', 'requests', 'cold', 'p50 ms',
+                                                          'p99 ms', 'RSS MB', 'errors'))
+        for provider in args.provider or PROVIDERS:
+            for name in args.scenario or SCENARIOS:
+                result = run_scenario(server, provider, name, args.runs, extra_args)
+                print("%-10s %-11s %8d %8d %10.1f %10.1f %10.1f %7d" % (
+                    provider, name, statistics.median(result['requests']), result['requests'][0],
+                    percentile(result['wall_ms'], 50), percentile(result['wall_ms'], 99),
+                    result['max_rss_kb'] / 1024.0, result['errors']))
+                sys.stdout.flush()
+    finally:
+        server.stop()
+
+    exit(0)
+
+
+if __name__ == "__main__":
+    main()
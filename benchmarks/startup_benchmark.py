@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+# Measure import time of cloud-dyndns.py with python -X importtime.
+# Fails, if a scenario exceeds the import time budget or imports a module it shouldn't need.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloud-dyndns.py')
+
+# Default budget for imports done by the tool itself, in milliseconds
+DEFAULT_BUDGET_MS = 40
+
+BENCH_HOSTNAME = 'bench.example.com'
+BENCH_IP = '192.0.2.1'
+
+# Heavy modules none of the scenarios need
+FORBIDDEN_MODULES = ('yaml', 'requests', 'urllib3', 'netifaces', 'pyrax', 'azure', 'msrestazure',
+                     'concurrent.futures')
+
+SCENARIOS = {
+    # Argument parsing only
+    'help': ['--help'],
+    # Static address, which was recently published. No provider is loaded.
+    'state-hit': ['--provider', 'rackspace', '--hostname', BENCH_HOSTNAME, '--ip-address', BENCH_IP],
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parse output of -X importtime
+    :param stderr: stderr of the process
+    :return: tuple, total microseconds of top-level imports after site-initialization, set of imported modules
+    """
+    total_us = 0
+    modules = set()
+    after_site = False
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        module = name.strip()
+        if not after_site:
+            after_site = module == 'site'
+            continue
+        modules.add(module)
+        if len(name) - len(name.lstrip()) > 1:
+            # Nested import, already counted in its parent
+            continue
+        total_us += int(cumulative)
+
+    return total_us, modules
+
+
+def run_scenario(args, env):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + args,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, universal_newlines=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError("Scenario {0} failed with exit code {1}:\n{2}".format(args, proc.returncode, proc.stderr))
+    import_us, modules = parse_importtime(proc.stderr)
+
+    return import_us / 1000, wall_ms, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time benchmark of cloud-dyndns.py')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Runs per scenario. Median is compared to budget. Default: 10')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Import time budget per scenario in milliseconds. Default: %d' % DEFAULT_BUDGET_MS)
+    args = parser.parse_args()
+
+    failures = 0
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Pre-populate published state for the state-hit scenario
+        env = dict(os.environ)
+        env.pop('STATE_DIRECTORY', None)
+        env['XDG_STATE_HOME'] = state_dir
+        env['XDG_CACHE_HOME'] = state_dir
+        os.makedirs(state_dir + '/cloud-dyndns')
+        host, domain = BENCH_HOSTNAME.split('.', 1)
+        with open(state_dir + '/cloud-dyndns/published.json', 'w') as fp:
+            json.dump({'rackspace/{0}/{1}/A'.format(domain, host): {'stored': time.time(),
+                                                                    'value': BENCH_IP}}, fp)
+
+        print("%-12s %12s %12s" % ('scenario', 'imports ms', 'wall ms'))
+        for name, scenario_args in SCENARIOS.items():
+            # First run warms up bytecode caches
+            run_scenario(scenario_args, env)
+            results = [run_scenario(scenario_args, env) for _ in range(args.runs)]
+            import_ms = statistics.median([result[0] for result in results])
+            wall_ms = statistics.median([result[1] for result in results])
+            print("%-12s %12.1f %12.1f" % (name, import_ms, wall_ms))
+
+            if import_ms > args.budget_ms:
+                sys.stderr.write("Error: Scenario %s import time %.1f ms exceeds budget of %.1f ms\n" %
+                                 (name, import_ms, args.budget_ms))
+                failures += 1
+            forbidden = sorted(module for module in results[0][2]
+                               if any(module == forbidden_module or module.startswith(forbidden_module + '.')
+                                      for forbidden_module in FORBIDDEN_MODULES))
+            if forbidden:
+                sys.stderr.write("Error: Scenario %s imports %s\n" % (name, ', '.join(forbidden)))
+                failures += 1
+
+    exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
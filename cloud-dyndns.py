@@ -2,14 +2,30 @@
 
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
+import time
+# Start of imports, for metrics
+IMPORT_STARTED = time.perf_counter()
 import argparse
+import copy
+import glob
 import os.path
 import sys
-import yaml
 import socket
-import netifaces
-import requests
-import json
+from clouddns import BaseCloud, PreconditionFailed
+from clouddns.ip_detect import DEFAULT_SOURCES as DEFAULT_IP_DETECT_SOURCES
+from clouddns.ip_detect import DEFAULT_IPV6_SOURCES as DEFAULT_IPV6_DETECT_SOURCES
+from clouddns.ip_detect import DEFAULT_SOURCE_TIMEOUT as DEFAULT_IP_DETECT_TIMEOUT
+from clouddns.damping import DEFAULT_HOLD_DOWN, DEFAULT_FLAP_HALF_LIFE, DEFAULT_RECORD_UPDATE_RATE, \
+    DEFAULT_ZONE_UPDATE_RATE
+from clouddns.dns_query import DEFAULT_TIMEOUT as DEFAULT_DNS_PRECHECK_TIMEOUT
+from clouddns.dns_query import DEFAULT_PROPAGATION_TIMEOUT
+from clouddns.call_policy import CallPolicy, DEFAULT_DEADLINE, DEFAULT_API_RETRIES, DEFAULT_API_TIMEOUT, \
+    DEFAULT_CIRCUIT_FAILURES, DEFAULT_CIRCUIT_RESET
+from clouddns.state import PublishedState
+from clouddns.update_queue import UpdateQueue
+from clouddns.worker import DEFAULT_IDLE_TIMEOUT as DEFAULT_WORKER_IDLE_TIMEOUT
+from clouddns.worker import DEFAULT_SOCKET_PATH as DEFAULT_WORKER_SOCKET
+from clouddns.metrics import metrics
 
 
 # This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
@@ -27,8 +43,41 @@ import json
 #
 # Copyright (c) Jari Turkia
 
+# Supported Cloud providers. See create_provider().
+PROVIDERS = ('rackspace', 'azure', 'route53')
+
+# Seconds to wait before retrying a failed authentication refresh in daemon mode
+DAEMON_RETRY_INTERVAL = 60
+
+# Hosts to update in parallel in --config-dir mode
+DEFAULT_WORKERS = 8
+
+# Hosts in one zone needed to read the whole zone at once, instead of reading records host by host
+DEFAULT_ZONE_LISTING_MIN_HOSTS = 3
+
+# Seconds the collector waits for more reports before updating DNS
+DEFAULT_COLLECTOR_DEBOUNCE = 5.0
+
+# Name to record addresses reported to a collector with in published state
+REPORT_STATE_NAME = 'report'
+
+# Seconds a trigger waits for the worker on top of --deadline, as starting the worker isn't part of it
+TRIGGER_TIMEOUT_MARGIN = 30
+
+# Seconds a published address is trusted before verifying it from provider API
+DEFAULT_STATE_MAX_AGE = 3600
+
+# DNS-records to maintain for each address family setting
+ADDRESS_FAMILY_RECORD_TYPES = {
+    'ipv4': ('A',),
+    'ipv6': ('AAAA',),
+    'dual': ('A', 'AAAA'),
+}
+
 
 def read_config_file(config_file, args_to_update):
+    import yaml
+
     config_in = None
     with open(config_file, 'rt', encoding='utf8') as stream:
         try:
@@ -46,7 +95,10 @@ def read_config_file(config_file, args_to_update):
 
     dyndns_config = config_in['dyndns']
     for key in dyndns_config.keys():
-        if isinstance(dyndns_config[key], str) or isinstance(dyndns_config[key], bool):
+        if isinstance(dyndns_config[key], (str, bool, int)):
+            pass
+        elif key == 'interfaces' and isinstance(dyndns_config[key], dict):
+            # Mapping of interface: hostname
             pass
         else:
             sys.stderr.write(
@@ -57,8 +109,16 @@ def read_config_file(config_file, args_to_update):
             args_to_update.provider = dyndns_config[key]
         elif key == 'interface':
             args_to_update.interface = dyndns_config[key]
+        elif key == 'interfaces':
+            args_to_update.interfaces = dyndns_config[key]
+        elif key == 'address_policy':
+            args_to_update.address_policy = dyndns_config[key]
         elif key == 'ip_address':
             args_to_update.ip_address = dyndns_config[key]
+        elif key == 'ipv6_address':
+            args_to_update.ipv6_address = dyndns_config[key]
+        elif key == 'address_family':
+            args_to_update.address_family = dyndns_config[key]
         elif key == 'detect_public_ip':
             args_to_update.detect_public_ip = True
         elif key == 'public_ip_from_platform':
@@ -71,58 +131,1396 @@ def read_config_file(config_file, args_to_update):
             args_to_update.api_key = dyndns_config[key]
         elif key == 'api_credentials_file':
             args_to_update.api_credentials_file = dyndns_config[key]
+        elif key == 'daemon':
+            args_to_update.daemon = dyndns_config[key]
+        elif key == 'ip_detect_sources':
+            args_to_update.ip_detect_sources = dyndns_config[key]
+        elif key == 'ipv6_detect_sources':
+            args_to_update.ipv6_detect_sources = dyndns_config[key]
+        elif key == 'ip_detect_timeout':
+            args_to_update.ip_detect_timeout = float(dyndns_config[key])
+        elif key == 'ip_detect_quorum':
+            args_to_update.ip_detect_quorum = dyndns_config[key]
+        elif key == 'state_max_age':
+            args_to_update.state_max_age = dyndns_config[key]
+        elif key == 'hold_down':
+            args_to_update.hold_down = dyndns_config[key]
+        elif key == 'flap_half_life':
+            args_to_update.flap_half_life = dyndns_config[key]
+        elif key == 'record_update_rate':
+            args_to_update.record_update_rate = dyndns_config[key]
+        elif key == 'zone_update_rate':
+            args_to_update.zone_update_rate = dyndns_config[key]
+        elif key == 'report_to':
+            args_to_update.report_to = dyndns_config[key]
+        elif key == 'report_token':
+            args_to_update.report_token = dyndns_config[key]
+        elif key == 'metrics_file':
+            args_to_update.metrics_file = dyndns_config[key]
+        elif key == 'metrics_json':
+            args_to_update.metrics_json = dyndns_config[key]
+        elif key == 'deadline':
+            args_to_update.deadline = dyndns_config[key]
+        elif key == 'api_retries':
+            args_to_update.api_retries = dyndns_config[key]
+        elif key == 'api_timeout':
+            args_to_update.api_timeout = dyndns_config[key]
+        elif key == 'circuit_failures':
+            args_to_update.circuit_failures = dyndns_config[key]
+        elif key == 'circuit_reset':
+            args_to_update.circuit_reset = dyndns_config[key]
+        elif key == 'provider_quorum':
+            args_to_update.provider_quorum = dyndns_config[key]
+        elif key == 'dns_precheck':
+            args_to_update.dns_precheck = dyndns_config[key]
+        elif key == 'dns_precheck_servers':
+            args_to_update.dns_precheck_servers = dyndns_config[key]
+        elif key == 'dns_precheck_timeout':
+            args_to_update.dns_precheck_timeout = float(dyndns_config[key])
+        elif key == 'verify_propagation':
+            args_to_update.verify_propagation = dyndns_config[key]
+        elif key == 'verify_propagation_timeout':
+            args_to_update.verify_propagation_timeout = dyndns_config[key]
+        elif key == 'worker':
+            args_to_update.worker = dyndns_config[key]
+        elif key == 'worker_socket':
+            args_to_update.worker_socket = dyndns_config[key]
+        elif key == 'worker_idle_timeout':
+            args_to_update.worker_idle_timeout = dyndns_config[key]
 
     # Done!
 
 
-def get_current_ip_from_interface(iface):
+def get_address_policy(args, parser):
     """
-    Query the IPv4-address for given interface
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: AddressPolicy choosing among the addresses of an interface
+    """
+    from clouddns.interfaces import AddressPolicy
+
+    try:
+        return AddressPolicy(args.address_policy)
+    except ValueError as exc:
+        sys.stderr.write("Error: %s. Cannot continue!\n\n" % exc)
+        parser.print_help()
+        exit(2)
+
+
+def read_interface_addresses(iface, record_type='A', policy=None, interface_addresses=None):
+    """
+    Query the addresses of given type for given interface, the ones address policy allows.
+    Link-local addresses are skipped, they are of no use in DNS.
     :param iface:
+    :param record_type: A for IPv4-addresses, AAAA for IPv6-addresses
+    :param policy: AddressPolicy to choose with. Default: the default policy.
+    :param interface_addresses: dict, interface: list of InterfaceAddress already read. None to read them now.
+    :return: list of IP-addresses, empty list if none
+    """
+    from clouddns.interfaces import AddressPolicy, read_addresses
+
+    if interface_addresses is None:
+        interface_addresses = read_addresses()
+    if policy is None:
+        policy = AddressPolicy()
+
+    return policy.select(interface_addresses.get(iface, []), record_type)
+
+
+def get_current_ip_from_interface(iface, record_type='A', policy=None, interface_addresses=None):
+    """
+    Query the IP-address for given interface
+    :param iface:
+    :param record_type: A for IPv4-address, AAAA for IPv6-address
+    :param policy: AddressPolicy to choose with, if interface has many addresses
+    :param interface_addresses: dict, interface: list of InterfaceAddress already read. None to read them now.
     :return:
     """
-    ips = netifaces.ifaddresses(iface)
-    if not ips[netifaces.AF_INET]:
-        sys.stderr.write("Error: Interface %s has no IPv4-addresses. Cannot continue!" % iface)
+    family = 'IPv4' if record_type == 'A' else 'IPv6'
+    ips = read_interface_addresses(iface, record_type, policy, interface_addresses)
+    if not ips:
+        sys.stderr.write("Error: Interface %s has no %s-addresses. Cannot continue!" % (iface, family))
         exit(1)
 
-    if len(ips[netifaces.AF_INET]) > 1:
-        sys.stderr.write("Error: Interface %s has multiple IPv4-addresses. Cannot continue!" % iface)
+    if len(ips) > 1:
+        sys.stderr.write("Error: Interface %s has multiple %s-addresses: %s. Use --address-policy to choose. "
+                         "Cannot continue!" % (iface, family, ', '.join(ips)))
         exit(1)
 
-    # Return the only IPv4-address there is.
-    return ips[netifaces.AF_INET][0]['addr']
+    # Return the only address there is.
+    return ips[0]
+
+
+def detect_public_ip_address(args, record_type='A'):
+    """
+    Ask a number of public IP-address sources concurrently, use the first answer (or quorum of answers)
+    :param args: parsed command-line arguments
+    :param record_type: A for IPv4-address, AAAA for IPv6-address
+    :return: str, IP-address. None on failure.
+    """
+    from clouddns.ip_detect import PublicIpDetector
+
+    if record_type == 'A':
+        sources, family = args.ip_detect_sources, 4
+    else:
+        sources, family = args.ipv6_detect_sources, 6
+    sources = [source.strip() for source in sources.split(',') if source.strip()]
+    try:
+        detector = PublicIpDetector(sources, timeout=args.ip_detect_timeout, quorum=args.ip_detect_quorum,
+                                    family=family)
+    except ValueError as exc:
+        sys.stderr.write("Error: %s. Cannot continue!\n" % exc)
+        exit(2)
+
+    return detector.detect()
+
+
+def split_hostname(fqdn):
+    """
+    Split FQDN into hostname and DNS zone
+    :param fqdn:
+    :return: tuple, hostname and domain. Either can be empty on parse failure.
+    """
+    hostname_to_use = fqdn.split('.')[0]
+    domain_to_use = '.'.join(fqdn.split('.')[1:])
+
+    return hostname_to_use, domain_to_use
+
+
+def provider_class(provider_name):
+    """
+    Import the implementation of given provider
+    :param provider_name:
+    :return: BaseCloud subclass, None if provider is not known
+    """
+    if provider_name == 'rackspace':
+        from clouddns.rackspace import Rackspace
+        return Rackspace
+    elif provider_name == 'azure':
+        from clouddns.azure import Azure
+        return Azure
+    elif provider_name == 'route53':
+        from clouddns.route53 import Route53
+        return Route53
+
+    return None
+
+
+def create_provider(provider_name, args):
+    """
+    Import the implementation of given provider and set it up
+    :param provider_name:
+    :param args: parsed command-line arguments, for deadline and retries of API calls
+    :return: BaseCloud implementation, None if provider is not known
+    """
+    with metrics.phase('provider_load'):
+        cls = provider_class(provider_name)
+        if not cls:
+            return None
+        provider = cls()
+    provider.call_policy = CallPolicy(provider.name, deadline=args.deadline, retries=args.api_retries,
+                                      timeout=args.api_timeout, circuit_failures=args.circuit_failures,
+                                      circuit_reset=args.circuit_reset)
+
+    return metrics.instrument(provider)
+
+
+def get_provider_names(args, parser):
+    """
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: list of provider names given as comma-separated --provider
+    """
+    provider_names = []
+    for provider_name in args.provider.split(','):
+        provider_name = provider_name.strip()
+        if provider_name not in PROVIDERS:
+            sys.stderr.write("Error: Unknown provider %s, cannot continue.\n\n" % provider_name)
+            parser.print_help()
+            exit(2)
+        if provider_name not in provider_names:
+            provider_names.append(provider_name)
+
+    return provider_names
+
+
+def read_api_credentials(provider, args):
+    """
+    Confirm, that there exists credentials
+    :param provider: BaseCloud implementation or subclass of it to read credentials for
+    :param args: parsed command-line arguments
+    :return: tuple of credentials, None if there are none
+    """
+    default_credentials_filename = provider.default_credentials_file()
+    if args.api_user and args.api_key:
+        return args.api_user, args.api_key
+    elif args.api_credentials_file and args.api_credentials_file != default_credentials_filename:
+        # A credentials-file was given
+        return provider._read_credentials_file(args.api_credentials_file)
+    elif default_credentials_filename and os.path.isfile(default_credentials_filename):
+        # Using default credentials file for given provider
+        return provider._read_credentials_file(default_credentials_filename)
+
+    return None
+
+
+def get_record_types(args, parser):
+    """
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: tuple of DNS-record types to maintain
+    """
+    if args.address_family not in ADDRESS_FAMILY_RECORD_TYPES:
+        sys.stderr.write("Error: Address family '%s' not known.\n\n" % args.address_family)
+        parser.print_help()
+        exit(2)
+
+    return ADDRESS_FAMILY_RECORD_TYPES[args.address_family]
+
+
+def get_addresses_to_use(args, parser):
+    """
+    Find out the addresses of all maintained families to set into DNS
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: dict, record type: IP-address
+    """
+    with metrics.phase('address'):
+        interface_addresses = None
+        if args.interface:
+            from clouddns.interfaces import read_addresses
+
+            # Addresses of all interfaces are read at once, for all record types
+            interface_addresses = read_addresses()
+
+        return {record_type: get_ip_to_use(args, parser, record_type, interface_addresses)
+                for record_type in get_record_types(args, parser)}
+
+
+def get_interface_hostnames(args, parser):
+    """
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: dict, interface: hostname to publish its addresses with. Empty if there is no mapping.
+    """
+    if not args.interfaces:
+        return {}
+
+    interface_hostnames = {}
+    if isinstance(args.interfaces, dict):
+        # From YAML-configuration
+        mappings = ["%s=%s" % (iface, hostname) for iface, hostname in args.interfaces.items()]
+    else:
+        mappings = args.interfaces.split(',')
+    for mapping in mappings:
+        iface, _, hostname = mapping.strip().partition('=')
+        if not iface or not hostname:
+            sys.stderr.write("Error: Invalid interface mapping '%s', need INTERFACE=HOSTNAME.\n\n" % mapping)
+            parser.print_help()
+            exit(2)
+        interface_hostnames[iface] = hostname
+
+    for hostname in interface_hostnames.values():
+        if not all(split_hostname(hostname)):
+            sys.stderr.write("Error: Cannot parse hostname %s\n" % hostname)
+            exit(2)
+
+    return interface_hostnames
+
+
+def get_interface_hosts(args, parser, interface_hostnames, policy, interface_addresses=None):
+    """
+    Find out the addresses of all mapped interfaces. Interfaces without a single usable address are skipped.
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param interface_hostnames: dict, interface: hostname
+    :param policy: AddressPolicy to choose with, if an interface has many addresses
+    :param interface_addresses: dict, interface: list of InterfaceAddress already read. None to read them now.
+    :return: tuple, list of (hostname, dict of record type: IP-address) and list of interfaces skipped
+    """
+    from clouddns.interfaces import read_addresses
+
+    if interface_addresses is None:
+        interface_addresses = read_addresses()
+
+    hosts = []
+    skipped = []
+    for iface, hostname in interface_hostnames.items():
+        addresses = {}
+        for record_type in get_record_types(args, parser):
+            ips = read_interface_addresses(iface, record_type, policy, interface_addresses)
+            if len(ips) != 1:
+                sys.stderr.write("Warning: Interface %s has %d %s-addresses%s, skipping %s.\n" %
+                                 (iface, len(ips), 'IPv4' if record_type == 'A' else 'IPv6',
+                                  ': ' + ', '.join(ips) if ips else '', hostname))
+                addresses = None
+                break
+            addresses[record_type] = ips[0]
+        if addresses:
+            hosts.append((hostname, addresses))
+        else:
+            skipped.append(iface)
+
+    return hosts, skipped
+
+
+def get_ip_to_use(args, parser, record_type='A', interface_addresses=None):
+    """
+    Find out the IP-address to set into DNS
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param record_type: A for IPv4-address, AAAA for IPv6-address
+    :param interface_addresses: dict, interface: list of InterfaceAddress already read. None to read them if needed.
+    :return: IP-address
+    """
+    static_ip = args.ip_address if record_type == 'A' else args.ipv6_address
+    family = 'IPv4' if record_type == 'A' else 'IPv6'
+
+    # IP-address given on CLI?
+    if static_ip:
+        # Using static one. No need to check for interface.
+        ip_to_use = static_ip
+    elif args.detect_public_ip:
+        ip_to_use = detect_public_ip_address(args, record_type)
+        if not ip_to_use:
+            sys.stderr.write("Error: Failed to detect public %s address from %s\n" %
+                             (family, args.ip_detect_sources if record_type == 'A' else args.ipv6_detect_sources))
+            exit(1)
+    elif args.public_ip_from_platform:
+        if record_type != 'A':
+            sys.stderr.write("Error: Platform metadata has no IPv6 address, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        if args.public_ip_from_platform.lower() == 'aws':
+            ip_to_use = BaseCloud.get_current_ipv4_from_aws_vm_metadata()
+        elif args.public_ip_from_platform.lower() == 'azure':
+            ip_to_use = BaseCloud.get_current_ipv4_from_azure_vm_metadata()
+        else:
+            sys.stderr.write("Error: Given platform '%s' not known.\n\n" % args.public_ip_from_platform)
+            parser.print_help()
+            exit(2)
+
+        if not ip_to_use:
+            sys.stderr.write("Error: Failed to get IPv4 address from platform '%s'" % args.public_ip_from_platform)
+            exit(1)
+        if isinstance(ip_to_use, bytes):
+            # AWS metadata gives the response body as is. Addresses are compared and parsed as str.
+            ip_to_use = ip_to_use.decode('ascii').strip()
+    else:
+        # Detect, check that we have interface
+        if not args.interface:
+            sys.stderr.write("Error: Need interface to query IP-address for, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+
+        ip_to_use = get_current_ip_from_interface(args.interface, record_type, get_address_policy(args, parser),
+                                                  interface_addresses)
+
+    return ip_to_use
+
+
+def authenticate(provider, api_credentials):
+    """
+    Use the given credentials, unless there is a valid token in cache.
+    :param provider: BaseCloud implementation to authenticate
+    :param api_credentials: credentials to authenticate with
+    :return:
+    """
+    with metrics.phase('authenticate'):
+        if not provider.is_authenticated(api_credentials):
+            provider.authenticate(api_credentials)
+
+
+def is_published(state, args, addresses, provider_name=None, fqdn=None, queue=None):
+    """
+    See if all the addresses were recently published, no need to even ask the provider.
+    :param state: PublishedState of previous runs
+    :param args: parsed command-line arguments
+    :param addresses: dict, record type: IP-address to set
+    :param provider_name: name the addresses were published with. Default: --provider
+    :param fqdn: hostname the addresses are for. Default: --hostname
+    :param queue: UpdateQueue to drop a queued update of the host from, if the addresses are published
+    :return: bool, True if nothing needs to be done
+    """
+    fqdn = fqdn or args.hostname
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+    for record_type, ip_to_use in addresses.items():
+        if not state.is_published(provider_name or args.provider, hostname_to_use, domain_to_use, ip_to_use,
+                                  args.state_max_age, record_type):
+            return False
+
+    for ip_to_use in addresses.values():
+        print("No need to update! %s already has address of %s" % (fqdn, ip_to_use))
+    if queue:
+        # An update queued earlier has been superseded
+        queue.remove(provider_name or args.provider, fqdn)
+
+    return True
+
+
+def get_dns_precheck_servers(args, parser):
+    """
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: list of (IP-address, port) of nameservers to ask. None to discover the nameservers of each zone.
+    """
+    from clouddns.dns_query import parse_server
+
+    if not args.dns_precheck_servers:
+        return None
+
+    try:
+        return [parse_server(server.strip()) for server in args.dns_precheck_servers.split(',')]
+    except ValueError as exc:
+        sys.stderr.write("Error: Invalid --dns-precheck-servers: %s, cannot continue.\n\n" % exc)
+        parser.print_help()
+        exit(2)
+
+
+def precheck_hosts(args, parser, provider_hosts, state, queue=None):
+    """
+    Ask the authoritative nameservers of the zones directly, which of the hosts already have their addresses.
+    Those hosts need no update, the provider isn't even loaded for them. The addresses are recorded as published,
+    as if they were verified from the provider API.
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param provider_hosts: dict, provider name: list of (hostname, dict of record type: IP-address)
+    :param state: PublishedState to record the addresses into
+    :param queue: UpdateQueue to drop queued updates of the hosts from, optional
+    :return: dict, provider name: list of (hostname, dict of record type: IP-address) still to update
+    """
+    from clouddns.dns_query import AuthoritativeResolver
+
+    resolver = AuthoritativeResolver(servers=get_dns_precheck_servers(args, parser), timeout=args.dns_precheck_timeout)
+    in_dns = {}
+    for hosts in provider_hosts.values():
+        for fqdn, addresses in hosts:
+            if fqdn not in in_dns:
+                in_dns[fqdn] = resolver.has_addresses(split_hostname(fqdn)[1], fqdn, addresses)
+                if in_dns[fqdn]:
+                    for ip_to_use in addresses.values():
+                        print("No need to update! Nameservers of %s answer with address of %s" % (fqdn, ip_to_use))
+
+    for provider_name, hosts in provider_hosts.items():
+        for fqdn, addresses in hosts:
+            if not in_dns[fqdn]:
+                continue
+            hostname_to_use, domain_to_use = split_hostname(fqdn)
+            for record_type, ip_to_use in addresses.items():
+                state.published(provider_name, hostname_to_use, domain_to_use, ip_to_use, record_type)
+            if queue:
+                queue.remove(provider_name, fqdn)
+
+    return {provider_name: [(fqdn, addresses) for fqdn, addresses in hosts if not in_dns[fqdn]]
+            for provider_name, hosts in provider_hosts.items()}
+
+
+def verify_propagation(args, parser, provider_name, hosts):
+    """
+    Wait for the authoritative nameservers of the zones to answer with the updated addresses, if requested.
+    Each nameserver is polled until it has the addresses or --verify-propagation-timeout is up, hosts are waited
+    for concurrently. Time each nameserver took is recorded into metrics, for tracking propagation delays
+    of the provider.
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param provider_name: name of the provider the hosts were updated into
+    :param hosts: list of (hostname, dict of record type: IP-address) updated
+    :return: list of hostnames not answered with by all nameservers in time
+    """
+    if not args.verify_propagation or not hosts:
+        return []
+
+    import concurrent.futures
+    from clouddns.dns_query import AuthoritativeResolver, format_server
+
+    resolver = AuthoritativeResolver(servers=get_dns_precheck_servers(args, parser), timeout=args.dns_precheck_timeout)
+    # Discover nameservers of each zone once, not in every thread
+    for domain_to_use in {split_hostname(fqdn)[1] for fqdn, _ in hosts}:
+        resolver.nameservers(domain_to_use)
+
+    def wait_for_host(fqdn, addresses):
+        return resolver.wait_for_addresses(split_hostname(fqdn)[1], fqdn, addresses, args.verify_propagation_timeout)
+
+    not_propagated = []
+    with metrics.phase('verify'), concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        waits = [(fqdn, addresses, executor.submit(wait_for_host, fqdn, addresses)) for fqdn, addresses in hosts]
+        for fqdn, addresses, wait in waits:
+            nameserver_seconds = wait.result()
+            if not nameserver_seconds:
+                sys.stderr.write("Error: No nameservers found to verify update of %s\n" % fqdn)
+                not_propagated.append(fqdn)
+                continue
+
+            for server, seconds in nameserver_seconds.items():
+                metrics.observe('propagation', (provider_name, format_server(server)),
+                                args.verify_propagation_timeout if seconds is None else seconds, seconds is None)
+            late = sorted(format_server(server) for server, seconds in nameserver_seconds.items() if seconds is None)
+            if late:
+                sys.stderr.write("Error: Nameservers %s don't answer with address of %s for %s after %d seconds\n" %
+                                 (', '.join(late), ', '.join(addresses.values()), fqdn,
+                                  args.verify_propagation_timeout))
+                not_propagated.append(fqdn)
+            else:
+                print("Nameservers answer with address of %s for %s: %s" % (
+                    ', '.join(addresses.values()), fqdn,
+                    ', '.join("%s in %.1f seconds" % (format_server(server), seconds)
+                              for server, seconds in sorted(nameserver_seconds.items()))))
+
+    return not_propagated
+
+
+def records_to_change(provider, fqdn, addresses, current_records, state=None):
+    """
+    Compare the addresses to set with the ones in DNS
+    :param provider: BaseCloud implementation in use
+    :param fqdn: hostname to update
+    :param addresses: dict, record type: IP-address to set
+    :param current_records: dict, record type: tuple of record object and IP-address in DNS
+    :param state: PublishedState to record the already set addresses into, optional
+    :return: list of tuples: record type, IP-address, existing record object or None
+    """
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+
+    changes = []
+    for record_type, ip_to_use in addresses.items():
+        current_rr, current_ip = current_records[record_type]
+        if current_ip and current_ip == ip_to_use:
+            print("No need to update! %s already has address of %s" % (fqdn, ip_to_use))
+            if state:
+                state.published(provider.name, hostname_to_use, domain_to_use, ip_to_use, record_type,
+                                provider.record_etag(current_rr))
+            continue
+        changes.append((record_type, ip_to_use, current_rr))
+
+    return changes
+
+
+def published_etags(provider, fqdn, addresses, state):
+    """
+    See if the records can be written without reading them first. That is when provider has conditional writes,
+    and all the addresses have changed since this tool wrote them, ETags of those writes being known.
+    If someone else has changed a record since, the conditional write fails.
+    :param provider: BaseCloud implementation in use
+    :param fqdn: hostname to update
+    :param addresses: dict, record type: IP-address to set
+    :param state: PublishedState of previous runs, optional
+    :return: dict, record type: ETag. None if records need to be read.
+    """
+    if not provider.conditional_writes or not state:
+        return None
+
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+    etags = {}
+    for record_type, ip_to_use in addresses.items():
+        published_ip, etag = state.published_etag(provider.name, hostname_to_use, domain_to_use, record_type)
+        if not etag or published_ip == ip_to_use:
+            # Not written by this tool, or the published address is due for verification
+            return None
+        etags[record_type] = etag
+
+    return etags
+
+
+def is_upsert_enough(provider, fqdn, addresses, state):
+    """
+    See if the records can be written without reading them first. That is when provider creates or replaces
+    records with a single write, and all the addresses have changed since this tool published them.
+    :param provider: BaseCloud implementation in use
+    :param fqdn: hostname to update
+    :param addresses: dict, record type: IP-address to set
+    :param state: PublishedState of previous runs, optional
+    :return: bool, True if records need not be read
+    """
+    if not provider.upsert_writes or not state:
+        return False
+
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+    for record_type, ip_to_use in addresses.items():
+        published_ip, _ = state.published_etag(provider.name, hostname_to_use, domain_to_use, record_type)
+        if not published_ip or published_ip == ip_to_use:
+            # Not published by this tool, or the published address is due for verification
+            return False
+
+    return True
+
+
+def changed_records_to_write(provider, fqdn, addresses, changes, current_records, state=None):
+    """
+    A conditional write failed. Compare the addresses with the records read, and write only
+    the changes still needed out of the ones allowed by damping.
+    :param changes: list of tuples: record type, IP-address, None; as allowed to be written
+    :param current_records: dict, record type: tuple of record object and IP-address in DNS
+    :return: tuple, list of changes and dict of record type: ETag for a conditional write
+    """
+    print("Records of %s have been changed by someone else, reading them." % fqdn)
+    allowed = {record_type for record_type, _, _ in changes}
+    changes = [change for change in records_to_change(provider, fqdn, addresses, current_records, state)
+               if change[0] in allowed]
+
+    return changes, {record_type: provider.record_etag(record) for record_type, _, record in changes}
+
+
+def create_damper(args):
+    """
+    :param args: parsed command-line arguments
+    :return: UpdateDamper to damp and rate limit updates with
+    """
+    from clouddns.damping import UpdateDamper
+
+    return UpdateDamper(hold_down=args.hold_down, flap_half_life=args.flap_half_life,
+                        record_update_rate=args.record_update_rate, zone_update_rate=args.zone_update_rate)
+
+
+def damp_changes(provider, fqdn, addresses, changes, damper):
+    """
+    Leave out changes of flapping or too frequently updated records
+    :param provider: BaseCloud implementation in use
+    :param fqdn: hostname to update
+    :param addresses: dict, record type: IP-address to set
+    :param changes: list of tuples: record type, IP-address, existing record object or None
+    :param damper: UpdateDamper to consult, None for no damping
+    :return: list of changes to write now
+    """
+    if not damper:
+        return changes
+
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+    changes, deferred = damper.filter(provider.name, hostname_to_use, domain_to_use, addresses, changes)
+    for _, ip_to_use, reason in deferred:
+        print("Deferred update of %s to have address of %s: %s" % (fqdn, ip_to_use, reason))
+
+    return changes
+
+
+def records_changed(provider, fqdn, changes, state=None, etags=None):
+    """
+    Record and report the changes done
+    :param provider: BaseCloud implementation in use
+    :param fqdn: hostname updated
+    :param changes: list of tuples: record type, IP-address, previous record object or None
+    :param state: PublishedState to record the addresses into, optional
+    :param etags: dict, record type: ETag of the written record, optional
+    :return:
+    """
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+
+    for record_type, ip_to_use, _ in changes:
+        if state:
+            state.published(provider.name, hostname_to_use, domain_to_use, ip_to_use, record_type,
+                            (etags or {}).get(record_type))
+        print("Updated %s to have address of %s. Done." % (fqdn, ip_to_use))
+
+
+def update_dns(provider, fqdn, addresses, dry_run, state=None, damper=None):
+    """
+    Make sure the DNS has given IP-addresses for given hostname.
+    All record types are read at once, and changed in one batch where provider allows it.
+    Records written earlier are not read, if provider can write them conditionally on their ETags, or with upserts.
+    Provider needs to be authenticated already.
+    :param provider: BaseCloud implementation to use
+    :param fqdn: hostname to update
+    :param addresses: dict, record type: IP-address to set
+    :param dry_run: don't do any changes
+    :param state: PublishedState to record the address into, optional
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :return: bool, True if an update was (or would have been) done
+    """
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+
+    # Changed since previous write? No need to read, write conditionally on nobody else having changed the records,
+    # or with an upsert.
+    etags = None if dry_run else published_etags(provider, fqdn, addresses, state)
+    if etags or (not dry_run and is_upsert_enough(provider, fqdn, addresses, state)):
+        changes = [(record_type, ip_to_use, None) for record_type, ip_to_use in addresses.items()]
+    else:
+        # Need to do anything?
+        current_records = provider.get_current_ips_from_dns(hostname_to_use, domain_to_use, tuple(addresses))
+        changes = records_to_change(provider, fqdn, addresses, current_records, state)
+        if dry_run:
+            for _, ip_to_use, _ in changes:
+                print("--dry-run specified!\nWould update %s to have address of %s." % (fqdn, ip_to_use))
+            return bool(changes)
+
+    changes = damp_changes(provider, fqdn, addresses, changes, damper)
+    if not changes:
+        return False
+
+    # Go update!
+    if not provider.conditional_writes:
+        provider.update_rrs(hostname_to_use, domain_to_use, changes)
+        records_changed(provider, fqdn, changes, state)
+        return True
+
+    try:
+        etags = provider.update_rrs_conditional(hostname_to_use, domain_to_use, changes, etags or {
+            record_type: provider.record_etag(record) for record_type, _, record in changes})
+    except PreconditionFailed:
+        if not etags:
+            raise
+        current_records = provider.get_current_ips_from_dns(hostname_to_use, domain_to_use, tuple(addresses))
+        changes, etags = changed_records_to_write(provider, fqdn, addresses, changes, current_records, state)
+        if not changes:
+            return False
+        etags = provider.update_rrs_conditional(hostname_to_use, domain_to_use, changes, etags)
+    records_changed(provider, fqdn, changes, state, etags)
+
+    return True
+
+
+def run_daemon(provider, api_credentials, args, parser, state, queue, damper=None):
+    """
+    Keep running and update DNS whenever the address of an interface changes.
+    Either --interface is monitored for --hostname, or every interface of --interfaces for its own hostname.
+    The provider stays authenticated between updates. Idle time is spent waiting for kernel netlink events,
+    and on every event addresses of all interfaces are read with a single query.
+    Failed updates are queued and retried with backoff, as are the updates queued by earlier runs.
+    :param provider: BaseCloud implementation to use
+    :param api_credentials: credentials to authenticate with, if there is no valid token
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param state: PublishedState of previous runs
+    :param queue: UpdateQueue of failed updates
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :return:
+    """
+    from clouddns.netlink import AddressMonitor
 
+    record_types = ADDRESS_FAMILY_RECORD_TYPES[args.address_family]
+    interface_hostnames = get_interface_hostnames(args, parser) or {args.interface: args.hostname}
+    policy = get_address_policy(args, parser)
+
+    # Subscribe before reading the initial address. No change can slip between the read and the wait.
+    monitor = AddressMonitor(list(interface_hostnames), ipv4='A' in record_types, ipv6='AAAA' in record_types)
+    account = None if args.dry_run else provider.account_key(api_credentials)
+    # Hostname: tuple of addresses published and time of publishing or checking them.
+    # Like the persisted state, trusted for --state-max-age seconds only.
+    published = {}
+    for iface, hostname in interface_hostnames.items():
+        print("Monitoring interface %s for address changes of %s" % (iface, hostname))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            # Every round of updates has a deadline of its own
+            provider.call_policy.start()
+            now = time.time()
+            published = {hostname: (addresses, published_at) for hostname, (addresses, published_at)
+                         in published.items() if args.state_max_age and published_at + args.state_max_age > now}
+            hosts, _ = get_interface_hosts(args, parser, interface_hostnames, policy)
+            to_update = []
+            for hostname, addresses in hosts:
+                if hostname not in published and is_published(state, args, addresses, fqdn=hostname, queue=queue):
+                    published[hostname] = (addresses, now)
+                    continue
+                if addresses == published.get(hostname, (None, None))[0]:
+                    continue
+                if queue.is_backing_off(provider.name, hostname, addresses):
+                    # Failed recently, retried when the backoff is over
+                    continue
+                to_update.append((hostname, addresses))
+            if not args.dry_run:
+                # Updates queued by earlier runs, for hosts not monitored here
+                to_update += queue.pending(provider.name, account, due=True, exclude=set(interface_hostnames.values()))
+
+            for hostname, addresses in to_update:
+                try:
+                    authenticate(provider, api_credentials)
+                    with metrics.phase('update'):
+                        update_dns(provider, hostname, addresses, args.dry_run, state, damper)
+                    queue.remove(provider.name, hostname)
+                    if not damper or not damper.is_deferred(provider.name, *split_hostname(hostname)):
+                        published[hostname] = (addresses, time.time())
+                except Exception as exc:
+                    sys.stderr.write("Error: Failed to update %s to have address of %s: %s\n" %
+                                     (hostname, ', '.join(addresses.values()), exc))
+                    if not args.dry_run:
+                        queue.put(provider.name, account, hostname, addresses)
+                metrics.write()
+            retry_timeouts = [timeout for timeout in (damper.next_retry() if damper else None,
+                                                      queue.next_retry(provider.name, account))
+                              if timeout is not None]
+            retry_timeout = min(retry_timeouts) if retry_timeouts else None
+
+            # Published addresses are checked from provider again when they are not trusted anymore
+            expiry_timeout = max(0.0, min(published_at for _, published_at in published.values()) +
+                                 args.state_max_age - time.time()) if published and args.state_max_age else None
+
+            # Refresh authentication ahead of token expiry, an address change shouldn't have to wait for it.
+            refresh_timeout = provider.seconds_until_refresh()
+            if refresh_timeout == 0:
+                try:
+                    provider.call_policy.start()
+                    provider.authenticate(api_credentials)
+                    refresh_timeout = provider.seconds_until_refresh()
+                except Exception as exc:
+                    sys.stderr.write("Error: Failed to refresh authentication: %s\n" % exc)
+                    refresh_timeout = DAEMON_RETRY_INTERVAL
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            timeouts = [timeout for timeout in (retry_timeout, refresh_timeout, expiry_timeout) if timeout is not None]
+            monitor.wait_for_change(timeout=min(timeouts) if timeouts else None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+
+
+def read_config_dir(config_dir, args, parser, state, queue=None):
+    """
+    Read all YAML-configurations from given directory.
+    Configurations sharing provider and API credentials are grouped together to authenticate only once.
+    :param config_dir: directory to read *.yaml from
+    :param args: parsed command-line arguments, used as defaults for every configuration
+    :param parser: argument parser for printing help on error
+    :param state: PublishedState of previous runs, hosts with recently published address are skipped
+    :param queue: UpdateQueue to drop queued updates of the skipped hosts from, optional
+    :return: list of tuples: provider, API credentials, list of (hostname, dict of record type: IP-address)
+    """
+    groups = {}
+    for config_file in sorted(glob.glob(os.path.join(config_dir, '*.yaml'))):
+        host_args = copy.copy(args)
+        host_args.config = config_file
+        read_config_file(config_file, host_args)
+
+        if not host_args.provider:
+            sys.stderr.write("Error: Configuration file %s has no provider, cannot continue.\n\n" % config_file)
+            exit(2)
+        if host_args.provider not in PROVIDERS:
+            sys.stderr.write("Error: Unknown provider %s in %s, cannot continue.\n\n" %
+                             (host_args.provider, config_file))
+            exit(2)
+
+        if not host_args.hostname:
+            host_args.hostname = socket.getfqdn()
+        hostname_to_use, domain_to_use = split_hostname(host_args.hostname)
+        if not hostname_to_use or not domain_to_use:
+            sys.stderr.write("Error: Cannot parse hostname %s in %s\n" % (host_args.hostname, config_file))
+            exit(2)
+
+        addresses = get_addresses_to_use(host_args, parser)
+        if is_published(state, host_args, addresses, queue=queue):
+            continue
+
+        api_credentials = read_api_credentials(provider_class(host_args.provider), host_args)
+        if not api_credentials and not host_args.dry_run:
+            sys.stderr.write("Error: Cloud provider API credentials missing in %s, cannot continue.\n\n" %
+                             config_file)
+            exit(2)
+
+        # Providers are shared per group, a new instance is needed only for new credentials
+        group_key = (host_args.provider, api_credentials)
+        if group_key not in groups:
+            groups[group_key] = (create_provider(host_args.provider, host_args), api_credentials, [])
+        groups[group_key][2].append((host_args.hostname, addresses))
+
+    return list(groups.values())
+
+
+async def update_dns_async(provider, fqdn, addresses, dry_run, state=None, current_records=None, damper=None):
+    """
+    Async variant of update_dns()
+    :param current_records: dict, record type: tuple of record object and IP-address already read from zone listing.
+    None to read them from provider.
+    """
+    hostname_to_use, domain_to_use = split_hostname(fqdn)
+
+    # Changed since previous write? No need to read, write conditionally on nobody else having changed the records,
+    # or with an upsert.
+    etags = None if dry_run or current_records is not None else published_etags(provider, fqdn, addresses, state)
+    if etags or (not dry_run and current_records is None and is_upsert_enough(provider, fqdn, addresses, state)):
+        changes = [(record_type, ip_to_use, None) for record_type, ip_to_use in addresses.items()]
+    else:
+        # Need to do anything?
+        if current_records is None:
+            current_records = await provider.get_current_ips_from_dns_async(hostname_to_use, domain_to_use,
+                                                                            tuple(addresses))
+        changes = records_to_change(provider, fqdn, addresses, current_records, state)
+        if dry_run:
+            for _, ip_to_use, _ in changes:
+                print("--dry-run specified!\nWould update %s to have address of %s." % (fqdn, ip_to_use))
+            return bool(changes)
+
+    changes = damp_changes(provider, fqdn, addresses, changes, damper)
+    if not changes:
+        return False
+
+    # Go update!
+    if not provider.conditional_writes:
+        await provider.update_rrs_async(hostname_to_use, domain_to_use, changes)
+        records_changed(provider, fqdn, changes, state)
+        return True
+
+    try:
+        etags = await provider.update_rrs_conditional_async(hostname_to_use, domain_to_use, changes, etags or {
+            record_type: provider.record_etag(record) for record_type, _, record in changes})
+    except PreconditionFailed:
+        if not etags:
+            raise
+        current_records = await provider.get_current_ips_from_dns_async(hostname_to_use, domain_to_use,
+                                                                        tuple(addresses))
+        changes, etags = changed_records_to_write(provider, fqdn, addresses, changes, current_records, state)
+        if not changes:
+            return False
+        etags = await provider.update_rrs_conditional_async(hostname_to_use, domain_to_use, changes, etags)
+    records_changed(provider, fqdn, changes, state, etags)
+
+    return True
+
+
+async def update_hosts_async(provider, hosts, dry_run, state, zone_listing_min_hosts=DEFAULT_ZONE_LISTING_MIN_HOSTS,
+                             damper=None, updated=None):
+    """
+    Update all given hosts concurrently.
+    Zones having many of the hosts are read with a single paged listing, then only the records
+    differing from the desired addresses are changed.
+    :param provider: authenticated BaseCloud implementation to use
+    :param hosts: list of (hostname, dict of record type: IP-address)
+    :param dry_run: don't do any changes
+    :param state: PublishedState to record the addresses into
+    :param zone_listing_min_hosts: hosts in a zone needed to list the zone instead of reading host by host
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :param updated: list to append (hostname, dict of record type: IP-address) of the hosts changed into, optional
+    :return: list of hostnames failed to update
+    """
+    import asyncio
+
+    async def update_host(fqdn, addresses, current_records=None):
+        try:
+            if await update_dns_async(provider, fqdn, addresses, dry_run, state, current_records, damper) and \
+                    not dry_run and updated is not None:
+                updated.append((fqdn, addresses))
+        except Exception as exc:
+            sys.stderr.write("Error: Failed to update %s to have address of %s: %s\n" %
+                             (fqdn, ', '.join(addresses.values()), exc))
+            return fqdn
 
-def get_ipinfoio_address():
-    resp = requests.get('http://ipinfo.io/json')
-    data = resp.json()
-    if resp.status_code != requests.codes.ok:
         return None
 
-    return data['ip']
+    async def update_zone(domain, zone_hosts):
+        record_types = tuple(sorted({record_type for _, addresses in zone_hosts for record_type in addresses}))
+        try:
+            zone_records = await provider.get_zone_records_async(
+                domain, [split_hostname(fqdn)[0] for fqdn, _ in zone_hosts], record_types)
+        except Exception as exc:
+            sys.stderr.write("Error: Failed to list records of %s: %s\n" % (domain, exc))
+            return [fqdn for fqdn, _ in zone_hosts]
+
+        updates = []
+        for fqdn, addresses in zone_hosts:
+            hostname_to_use = split_hostname(fqdn)[0]
+            current_records = {record_type: zone_records.get((hostname_to_use, record_type), (None, None))
+                               for record_type in addresses}
+            updates.append(update_host(fqdn, addresses, current_records))
+
+        return await asyncio.gather(*updates)
+
+    zones = {}
+    for fqdn, addresses in hosts:
+        zones.setdefault(split_hostname(fqdn)[1], []).append((fqdn, addresses))
+
+    updates = []
+    for domain, zone_hosts in zones.items():
+        if len(zone_hosts) >= zone_listing_min_hosts:
+            updates.append(update_zone(domain, zone_hosts))
+        else:
+            updates.append(asyncio.gather(*[update_host(fqdn, addresses) for fqdn, addresses in zone_hosts]))
+
+    results = [result for zone_results in await asyncio.gather(*updates) for result in zone_results]
+
+    return [fqdn for fqdn in results if fqdn]
+
+
+def update_hosts(provider, api_credentials, hosts, args, state, damper=None, updated=None):
+    """
+    Authenticate once, then update hosts concurrently, at most --workers provider requests at a time.
+    :param provider: BaseCloud implementation to use
+    :param api_credentials: credentials to authenticate with, if there is no valid token
+    :param hosts: list of (hostname, dict of record type: IP-address)
+    :param args: parsed command-line arguments
+    :param state: PublishedState to record the addresses into
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :param updated: list to append (hostname, dict of record type: IP-address) of the hosts changed into, optional
+    :return: list of hostnames failed to update
+    """
+    import asyncio
+    import concurrent.futures
+
+    try:
+        authenticate(provider, api_credentials)
+    except Exception as exc:
+        sys.stderr.write("Error: Failed to authenticate for %s: %s\n" %
+                         (', '.join(fqdn for fqdn, _ in hosts), exc))
+        return [fqdn for fqdn, _ in hosts]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor, metrics.phase('update'):
+        provider.executor = executor
+        return asyncio.run(update_hosts_async(provider, hosts, args.dry_run, state,
+                                              args.zone_listing_min_hosts, damper, updated))
+
+
+def update_hosts_queued(provider, api_credentials, hosts, args, state, queue, damper=None, updated=None):
+    """
+    Update hosts along with the updates queued by earlier runs for the same provider account.
+    Failed and deferred updates are queued to be retried on the next run.
+    :param provider: BaseCloud implementation to use
+    :param api_credentials: credentials to authenticate with, if there is no valid token
+    :param hosts: list of (hostname, dict of record type: IP-address)
+    :param args: parsed command-line arguments
+    :param state: PublishedState to record the addresses into
+    :param queue: UpdateQueue of failed updates
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :param updated: list to append (hostname, dict of record type: IP-address) of the hosts changed into, optional
+    :return: int, number of failed hosts
+    """
+    if args.dry_run:
+        return len(update_hosts(provider, api_credentials, hosts, args, state, damper))
+
+    account = provider.account_key(api_credentials)
+    # Hosts being updated now have newer addresses than the ones queued for them
+    pending = queue.pending(provider.name, account, exclude={fqdn for fqdn, _ in hosts})
+    if not hosts and not pending:
+        return 0
+    for fqdn, addresses in pending:
+        print("Retrying queued update of %s to have address of %s" % (fqdn, ', '.join(addresses.values())))
+    failed = update_hosts(provider, api_credentials, hosts + pending, args, state, damper, updated)
+    queue.updated(provider.name, account, hosts + pending, failed, deferred_retries(provider, hosts + pending, damper))
+
+    return len(failed)
+
+
+def deferred_retries(provider, hosts, damper):
+    """
+    :param provider: BaseCloud implementation in use
+    :param hosts: list of (hostname, dict of record type: IP-address) updated
+    :param damper: UpdateDamper the hosts were updated with, None for no damping
+    :return: dict, hostname: time the deferred update of it can be retried
+    """
+    if not damper:
+        return {}
+    retry_ats = {fqdn: damper.retry_at(provider.name, *split_hostname(fqdn)) for fqdn, _ in hosts}
+
+    return {fqdn: retry_at for fqdn, retry_at in retry_ats.items() if retry_at}
+
+
+def update_providers(provider_names, provider_hosts, args, parser, state, queue, damper=None):
+    """
+    Update the same hosts into many providers concurrently. Each provider is loaded, authenticated and updated
+    in a thread of its own, a run takes as long as the slowest provider does.
+    Credentials of each provider are read from its default credentials file.
+    :param provider_names: list of names of the providers
+    :param provider_hosts: dict, provider name: list of (hostname, dict of record type: IP-address) to update
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param state: PublishedState to record the addresses into
+    :param queue: UpdateQueue of failed updates
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :return: list of names of the providers failed to update
+    """
+    import concurrent.futures
+    import contextlib
+
+    def update_provider(provider_name):
+        hosts = provider_hosts[provider_name]
+        if not hosts and not queue.pending(provider_name):
+            return 0
+
+        provider = create_provider(provider_name, args)
+        api_credentials = read_api_credentials(provider, args)
+        if not api_credentials and not args.dry_run:
+            sys.stderr.write("Error: Cloud provider API credentials missing for %s.\n" % provider_name)
+            return len(hosts) or 1
+        if args.debug_cloud_api:
+            provider.debug(True)
+
+        updated = []
+        failures = update_hosts_queued(provider, api_credentials, hosts, args, state, queue, damper, updated)
+
+        return failures + len(verify_propagation(args, parser, provider_name, updated))
+
+    failed = []
+    # State files are written once, after all providers are done
+    with state.batch(), damper.batch() if damper else contextlib.nullcontext(), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=len(provider_names)) as executor:
+        updates = {provider_name: executor.submit(update_provider, provider_name)
+                   for provider_name in provider_names}
+        for provider_name in provider_names:
+            try:
+                failures = updates[provider_name].result()
+            except Exception as exc:
+                sys.stderr.write("Error: Failed to update with %s: %s\n" % (provider_name, exc))
+                failures = 1
+            if failures:
+                print("%s: %d hosts failed to update." % (provider_name, failures))
+                failed.append(provider_name)
+            else:
+                print("%s: Done." % provider_name)
+
+    return failed
+
+
+def run_config_dir(args, parser):
+    """
+    Update DNS for all configurations in a directory within a single process.
+    Each provider group authenticates once, then hosts are updated concurrently.
+    Groups are processed one after another, as Pyrax keeps its identity in module globals.
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :return: int, number of failed hosts
+    """
+    state = PublishedState()
+    queue = UpdateQueue()
+    with metrics.phase('config'):
+        groups = read_config_dir(args.config_dir, args, parser, state, queue)
+    if not groups and not glob.glob(os.path.join(args.config_dir, '*.yaml')):
+        sys.stderr.write("Error: No configuration files in %s, cannot continue.\n\n" % args.config_dir)
+        exit(2)
+
+    damper = create_damper(args)
+    failures = 0
+    # Published addresses and damping decisions of all hosts are written once, at the end of the run
+    with state.batch(), damper.batch():
+        for provider, api_credentials, hosts in groups:
+            if args.debug_cloud_api:
+                provider.debug(True)
+            updated = []
+            failures += update_hosts_queued(provider, api_credentials, hosts, args, state, queue, damper, updated)
+            failures += len(verify_propagation(args, parser, provider.name, updated))
+
+    return failures
+
+
+def run_collector(provider, api_credentials, args, queue):
+    """
+    Receive address reports of hosts and update DNS for them in batches.
+    Reports are debounced, a burst of reports is applied together and hosts of a zone are updated together.
+    Failed and deferred updates are retried, and queued to survive a restart of the collector.
+    :param provider: BaseCloud implementation to use
+    :param api_credentials: credentials to authenticate with, if there is no valid token
+    :param args: parsed command-line arguments
+    :param queue: UpdateQueue of failed updates
+    :return:
+    """
+    import asyncio
+    import concurrent.futures
+    from clouddns.collector import Collector, read_tokens_file
+
+    state = PublishedState()
+    damper = create_damper(args)
+    tokens = read_tokens_file(args.collector_tokens)
+    account = None if args.dry_run else provider.account_key(api_credentials)
+
+    def apply_batch(hosts):
+        provider.call_policy.start()
+        try:
+            authenticate(provider, api_credentials)
+            with metrics.phase('update'), state.batch(), damper.batch():
+                failed = asyncio.run(update_hosts_async(provider, hosts, args.dry_run, state,
+                                                        args.zone_listing_min_hosts, damper))
+        except Exception as exc:
+            sys.stderr.write("Error: Failed to update %s: %s\n" % (', '.join(fqdn for fqdn, _ in hosts), exc))
+            failed = [fqdn for fqdn, _ in hosts]
+        deferred = deferred_retries(provider, hosts, damper)
+        if not args.dry_run:
+            queue.updated(provider.name, account, hosts, failed, deferred)
+        metrics.write()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        # Deferred updates are retried along with the failed ones
+        return failed + list(deferred)
+
+    listen_host, _, listen_port = args.collector.rpartition(':')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        provider.executor = executor
+        collector = Collector((listen_host or '0.0.0.0', int(listen_port)), tokens, apply_batch,
+                              args.collector_debounce, args.collector_tls_cert, args.collector_tls_key)
+        print("Collecting address reports of %d hosts at %s%s" % (len(tokens), args.collector,
+                                                                  ' with TLS' if args.collector_tls_cert else ''))
+        # Updates queued before a restart, or by other runs with the same account
+        for fqdn, addresses in [] if args.dry_run else queue.pending(provider.name, account):
+            print("Retrying queued update of %s to have address of %s" % (fqdn, ', '.join(addresses.values())))
+            collector.queue.put(fqdn, addresses)
+        sys.stdout.flush()
+        try:
+            collector.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def run_worker(provider, api_credentials, args, parser, state, queue, damper=None, interface_hostnames=None):
+    """
+    Keep running and update DNS whenever triggered. The provider stays loaded and authenticated between updates.
+    Each trigger reads the addresses again, and updates like a single run would. Exits once idle for
+    --worker-idle-timeout seconds, systemd socket activation starts the worker again on the next trigger.
+    :param provider: BaseCloud implementation to use
+    :param api_credentials: credentials to authenticate with, if there is no valid token
+    :param args: parsed command-line arguments
+    :param parser: argument parser for printing help on error
+    :param state: PublishedState of previous runs
+    :param queue: UpdateQueue of failed updates
+    :param damper: UpdateDamper to damp and rate limit updates with, optional
+    :param interface_hostnames: dict, interface: hostname, if addresses of many interfaces are published
+    :return:
+    """
+    from clouddns.worker import Worker, systemd_socket, bind_socket
+
+    policy = get_address_policy(args, parser) if interface_hostnames else None
+
+    def run_update():
+        # Every update has a deadline of its own
+        provider.call_policy.start()
+        try:
+            if interface_hostnames:
+                with metrics.phase('address'):
+                    hosts, skipped = get_interface_hosts(args, parser, interface_hostnames, policy)
+            else:
+                hosts, skipped = [(args.hostname, get_addresses_to_use(args, parser))], []
+        except SystemExit as exc:
+            # Failing to read the address ends a single run, the worker keeps running
+            return exc.code
+        hosts = [(fqdn, addresses) for fqdn, addresses in hosts
+                 if not is_published(state, args, addresses, fqdn=fqdn, queue=queue)]
+        if args.dns_precheck and hosts:
+            with metrics.phase('dns_precheck'):
+                hosts = precheck_hosts(args, parser, {provider.name: hosts}, state, queue)[provider.name]
+        updated = []
+        failures = update_hosts_queued(provider, api_credentials, hosts, args, state, queue, damper, updated)
+        failures += len(verify_propagation(args, parser, provider.name, updated))
+        metrics.write()
+
+        return 1 if failures or skipped else 0
+
+    sock = systemd_socket()
+    socket_path = None
+    if not sock:
+        try:
+            sock = bind_socket(args.worker_socket)
+        except OSError as exc:
+            sys.stderr.write("Error: Cannot listen on %s: %s\n" % (args.worker_socket, exc))
+            exit(1)
+        socket_path = args.worker_socket
+    print("Waiting for triggers at %s" % (socket_path or "socket of systemd"))
+    sys.stdout.flush()
+
+    try:
+        Worker(sock, run_update, args.worker_idle_timeout).serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        if socket_path:
+            os.unlink(socket_path)
+
+
+def trigger_worker(args):
+    """
+    Ask a worker to update DNS, instead of updating it directly. Output of the update is passed through.
+    :param args: parsed command-line arguments
+    :return: int, exit code of the update
+    """
+    from clouddns.worker import send_trigger
+
+    timeout = args.deadline + TRIGGER_TIMEOUT_MARGIN if args.deadline else None
+    try:
+        response = send_trigger(args.worker_socket, timeout=timeout)
+    except (OSError, ValueError) as exc:
+        sys.stderr.write("Error: Failed to trigger worker at %s: %s\n" % (args.worker_socket, exc))
+        return 1
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+
+    return response['status']
+
+
+def report_addresses(args, addresses):
+    """
+    Send the addresses to a collector instead of updating DNS directly
+    :param args: parsed command-line arguments
+    :param addresses: dict, record type: IP-address to set
+    :return: bool, True if collector accepted the report
+    """
+    from clouddns import http
+    from clouddns.collector import REPORT_PATH
+
+    report = {'hostname': args.hostname, 'addresses': addresses}
+    headers = {'user-agent': 'clouddns/0.1', 'Authorization': 'Bearer %s' % args.report_token}
+    try:
+        resp = http.post(args.report_to.rstrip('/') + REPORT_PATH, json=report, headers=headers)
+    except Exception as exc:
+        sys.stderr.write("Error: Failed to report to %s: %s\n" % (args.report_to, exc))
+        return False
+    if resp.status_code != 202:
+        sys.stderr.write("Error: Collector %s refused the report: %d %s\n" %
+                         (args.report_to, resp.status_code, resp.text))
+        return False
+
+    print("Reported %s to have address of %s." % (args.hostname, ', '.join(addresses.values())))
+
+    return True
+
+
+def enable_metrics(args, main_started):
+    """
+    Start collecting metrics, if requested. They are written out on exit, and after every update
+    in long-running modes. When not requested, measuring costs nothing.
+    :param args: parsed command-line arguments
+    :param main_started: time.perf_counter() at start of main()
+    :return:
+    """
+    if not args.metrics_file and not args.metrics_json:
+        return
+
+    metrics.enable(args.metrics_file, args.metrics_json)
+    metrics.observe('phase', ('import',), main_started - IMPORT_STARTED)
+    metrics.observe('phase', ('config',), time.perf_counter() - main_started)
 
 
 def main():
+    main_started = time.perf_counter()
     provider = None
-    default_hostname = str(socket.getfqdn())
-    default_credentials_filename = None
+    api_credentials = None
 
     parser = argparse.ArgumentParser(description='Update interface IP-address to a Cloud DNS')
     parser.add_argument('-p', '--provider',
-                        help='Cloud provider to use. Currently supported: Rackspace, Azure')
+                        help='Cloud provider to use. Currently supported: Rackspace, Azure, Route53. '
+                             'Comma-separated providers are updated concurrently.')
+    parser.add_argument('--provider-quorum', type=int, default=0, metavar="PROVIDERS",
+                        help='With many providers, number of them needing to succeed. Default: all of them')
     parser.add_argument('-i', '--interface',
                         help='The interface to read IP-address from to set into DNS')
+    parser.add_argument('--interfaces', metavar="INTERFACE=HOSTNAME,...",
+                        help='Publish addresses of many interfaces, each with its own hostname.')
+    parser.add_argument('--address-policy', metavar="RULES",
+                        help="How to choose, when an interface has many addresses. Comma-separated rules: "
+                             "non-deprecated, public, cidr:<network>, primary. Default: non-deprecated")
+    parser.add_argument('--address-family', choices=sorted(ADDRESS_FAMILY_RECORD_TYPES), default='ipv4',
+                        help="Maintain A-record (ipv4), AAAA-record (ipv6) or both (dual). Default: ipv4")
     parser.add_argument('--ip-address', metavar="IPV4-ADDRESS",
                         help="Don't try to read IP-address, just use a static one.")
+    parser.add_argument('--ipv6-address', metavar="IPV6-ADDRESS",
+                        help="Don't try to read IPv6-address, just use a static one.")
     parser.add_argument('--ip-address-detect-public', '-d', dest='detect_public_ip', action='store_true',
-                        help="Don't try to read IP-address, see what ipinfo.io detects.")
+                        help="Don't try to read IP-address, see what public IP-address sources detect.")
+    parser.add_argument('--ip-detect-sources', metavar="SOURCES", default=','.join(DEFAULT_IP_DETECT_SOURCES),
+                        help="Comma-separated public IP-address sources to query concurrently: ipinfo, aws, azure, "
+                             "stun, stun:<host>:<port> or URL of a HTTP echo service. Default: %s" %
+                             ','.join(DEFAULT_IP_DETECT_SOURCES))
+    parser.add_argument('--ipv6-detect-sources', metavar="SOURCES",
+                        default=','.join(DEFAULT_IPV6_DETECT_SOURCES),
+                        help="Comma-separated public IPv6-address sources to query concurrently. Default: %s" %
+                             ','.join(DEFAULT_IPV6_DETECT_SOURCES))
+    parser.add_argument('--ip-detect-timeout', metavar="SECONDS", type=float, default=DEFAULT_IP_DETECT_TIMEOUT,
+                        help="Seconds each public IP-address source has to answer. Default: %.1f" %
+                             DEFAULT_IP_DETECT_TIMEOUT)
+    parser.add_argument('--ip-detect-quorum', metavar="SOURCES", type=int, default=1,
+                        help="Number of public IP-address sources, which need to agree. Default: 1")
     parser.add_argument('--ip-address-from-platform', metavar="PLATFORM-TYPE",
                         dest='public_ip_from_platform',
                         help="Don't try to read IP-address, see what virtualisation platform has. "
                              "Works for AWS and Azure VMs.")
-    parser.add_argument('--hostname', default=default_hostname,
-                        help='The hostname to parse DNS zone and RR from. Default: %s' % default_hostname)
+    parser.add_argument('--hostname',
+                        help='The hostname to parse DNS zone and RR from. Default: FQDN of this host')
     parser.add_argument('--api-user',
                         help='Cloud provider API user to use for authentication')
     parser.add_argument('--api-key',
@@ -131,13 +1529,120 @@ def main():
                         help='JSON-file with Cloud provider API credentials.')
     parser.add_argument('--config', metavar="CONFIGURATION-FILE",
                         help='YAML-configuration to use. Any command-line arguments will override config-file.')
+    parser.add_argument('--config-dir', metavar="CONFIGURATION-DIRECTORY",
+                        help='Update all YAML-configurations (*.yaml) in given directory within one process.')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of hosts to update in parallel with --config-dir. Default: %d' %
+                             DEFAULT_WORKERS)
+    parser.add_argument('--zone-listing-min-hosts', type=int, default=DEFAULT_ZONE_LISTING_MIN_HOSTS,
+                        metavar="HOSTS",
+                        help='With --config-dir, read all records of a zone at once, if it has at least this many '
+                             'hosts to update. Default: %d' % DEFAULT_ZONE_LISTING_MIN_HOSTS)
+    parser.add_argument('--hold-down', type=int, default=DEFAULT_HOLD_DOWN, metavar="SECONDS",
+                        help="Write a new address only after it has stayed for this long. Default: %d" %
+                             DEFAULT_HOLD_DOWN)
+    parser.add_argument('--flap-half-life', type=int, default=DEFAULT_FLAP_HALF_LIFE, metavar="SECONDS",
+                        help="Suppress updates of a flapping address, flap penalty halving in this time. "
+                             "0 to disable. Default: %d" % DEFAULT_FLAP_HALF_LIFE)
+    parser.add_argument('--record-update-rate', type=int, default=DEFAULT_RECORD_UPDATE_RATE, metavar="UPDATES",
+                        help="Updates per hour allowed for a record. 0 for no limit. Default: %d" %
+                             DEFAULT_RECORD_UPDATE_RATE)
+    parser.add_argument('--zone-update-rate', type=int, default=DEFAULT_ZONE_UPDATE_RATE, metavar="UPDATES",
+                        help="Updates per hour allowed for a DNS zone. 0 for no limit. Default: %d" %
+                             DEFAULT_ZONE_UPDATE_RATE)
+    parser.add_argument('--report-to', metavar="URL",
+                        help="Don't update DNS, report the addresses to a collector at given URL.")
+    parser.add_argument('--report-token',
+                        help="Token to authenticate to collector with")
+    parser.add_argument('--collector', metavar="[ADDRESS]:PORT",
+                        help="Run a collector: receive address reports of hosts and update DNS for them in batches.")
+    parser.add_argument('--collector-tokens', metavar="TOKENS-FILE",
+                        help="JSON-file with tokens of hosts allowed to report to collector: {FQDN: token}")
+    parser.add_argument('--collector-tls-cert', metavar="CERT-FILE",
+                        help="Serve reports over HTTPS with the certificate in given PEM-file.")
+    parser.add_argument('--collector-tls-key', metavar="KEY-FILE",
+                        help="PEM-file of the private key of --collector-tls-cert, if not in the certificate file.")
+    parser.add_argument('--collector-debounce', type=float, default=DEFAULT_COLLECTOR_DEBOUNCE, metavar="SECONDS",
+                        help="Seconds to wait for more reports before updating DNS. Default: %.1f" %
+                             DEFAULT_COLLECTOR_DEBOUNCE)
+    parser.add_argument('--deadline', type=int, default=DEFAULT_DEADLINE, metavar="SECONDS",
+                        help="Seconds a run may spend on Cloud provider API calls, retries included. "
+                             "0 for no deadline. Default: %d" % DEFAULT_DEADLINE)
+    parser.add_argument('--api-retries', type=int, default=DEFAULT_API_RETRIES, metavar="RETRIES",
+                        help="Retries of a throttled or failed Cloud provider API call. Default: %d" %
+                             DEFAULT_API_RETRIES)
+    parser.add_argument('--api-timeout', type=int, default=DEFAULT_API_TIMEOUT, metavar="SECONDS",
+                        help="Seconds to wait for a single Cloud provider API request. Default: %d" %
+                             DEFAULT_API_TIMEOUT)
+    parser.add_argument('--circuit-failures', type=int, default=DEFAULT_CIRCUIT_FAILURES, metavar="FAILURES",
+                        help="Stop calling a failing Cloud provider API after this many failures in a row. "
+                             "0 to never stop. Default: %d" % DEFAULT_CIRCUIT_FAILURES)
+    parser.add_argument('--circuit-reset', type=int, default=DEFAULT_CIRCUIT_RESET, metavar="SECONDS",
+                        help="Seconds to wait before calling a failing Cloud provider API again. Default: %d" %
+                             DEFAULT_CIRCUIT_RESET)
+    parser.add_argument('--dns-precheck', action='store_true',
+                        help="Ask authoritative nameservers of the zone for the current address first. "
+                             "Cloud provider API is used only if the address differs.")
+    parser.add_argument('--dns-precheck-servers', metavar="ADDRESS[:PORT],...",
+                        help="Nameservers to ask with --dns-precheck and --verify-propagation. "
+                             "Default: nameservers of the zone")
+    parser.add_argument('--dns-precheck-timeout', type=float, default=DEFAULT_DNS_PRECHECK_TIMEOUT,
+                        metavar="SECONDS",
+                        help="Seconds to wait for nameservers to answer. Default: %.1f" % DEFAULT_DNS_PRECHECK_TIMEOUT)
+    parser.add_argument('--verify-propagation', action='store_true',
+                        help="After an update, wait for all authoritative nameservers of the zone to answer with "
+                             "the new address.")
+    parser.add_argument('--verify-propagation-timeout', type=int, default=DEFAULT_PROPAGATION_TIMEOUT,
+                        metavar="SECONDS",
+                        help="Seconds to wait for an update to propagate into nameservers. Default: %d" %
+                             DEFAULT_PROPAGATION_TIMEOUT)
     parser.add_argument('--dry-run', action='store_true',
                         help="Don't do any changes. Authenticate to Cloud provider and display what would be done.")
+    parser.add_argument('--state-max-age', type=int, default=DEFAULT_STATE_MAX_AGE, metavar="SECONDS",
+                        help="Trust the previously published address for this long without asking provider. "
+                             "0 to always ask. Default: %d" % DEFAULT_STATE_MAX_AGE)
+    parser.add_argument('--daemon', action='store_true',
+                        help="Keep running and update DNS whenever address of --interface changes.")
+    parser.add_argument('--worker', action='store_true',
+                        help="Keep running and update DNS whenever triggered with --trigger. "
+                             "Socket is passed by systemd socket activation, or created at --worker-socket.")
+    parser.add_argument('--worker-socket', metavar="SOCKET-FILE", default=DEFAULT_WORKER_SOCKET,
+                        help="Unix socket of the worker. Default: %s" % DEFAULT_WORKER_SOCKET)
+    parser.add_argument('--worker-idle-timeout', type=int, default=DEFAULT_WORKER_IDLE_TIMEOUT, metavar="SECONDS",
+                        help="Seconds without triggers before the worker exits. 0 to never exit. Default: %d" %
+                             DEFAULT_WORKER_IDLE_TIMEOUT)
+    parser.add_argument('--trigger', action='store_true',
+                        help="Don't update DNS, ask the worker at --worker-socket to do it.")
     parser.add_argument('--debug-cloud-api', action='store_true',
                         help="Display tons of information for Cloud provider API-access.")
+    parser.add_argument('--metrics-file', metavar="PROM-FILE",
+                        help="Write timing and API call metrics into a Prometheus textfile collector file.")
+    parser.add_argument('--metrics-json', action='store_true',
+                        help="Print timing and API call metrics as a JSON line.")
 
     args = parser.parse_args()
 
+    # Reading a directory of configuration files?
+    if args.config_dir:
+        if not os.path.isdir(args.config_dir):
+            sys.stderr.write("Error: Configuration directory %s doesn't exist, cannot continue.\n\n" %
+                             args.config_dir)
+            parser.print_help()
+            exit(2)
+        if args.config or args.daemon or args.worker:
+            sys.stderr.write("Error: --config-dir cannot be used with --config, --daemon or --worker, "
+                             "cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        if args.workers < 1:
+            sys.stderr.write("Error: Need at least one worker, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+
+        enable_metrics(args, main_started)
+        failures = run_config_dir(args, parser)
+        exit(1 if failures else 0)
+
     # Reading a configuration file?
     if args.config:
         if not os.path.isfile(args.config):
@@ -147,101 +1652,192 @@ def main():
 
         read_config_file(args.config, args)
 
+    # Triggering a worker? It does all the rest.
+    if args.trigger:
+        exit(trigger_worker(args))
+    enable_metrics(args, main_started)
+
+    # Reporting to a collector? No provider nor credentials needed.
+    if args.report_to:
+        if args.daemon or args.collector or args.worker:
+            sys.stderr.write("Error: --report-to cannot be used with --daemon, --collector or --worker, "
+                             "cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        if not args.report_token:
+            sys.stderr.write("Error: Need --report-token, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        if args.report_to.lower().startswith('http://'):
+            sys.stderr.write("Warning: Reporting to %s without TLS, the token and the addresses can be read and "
+                             "changed on the way. Use https://.\n" % args.report_to)
+
+        addresses = get_addresses_to_use(args, parser)
+        if not args.hostname:
+            args.hostname = socket.getfqdn()
+        state = PublishedState()
+        if is_published(state, args, addresses, REPORT_STATE_NAME):
+            exit(0)
+        if not report_addresses(args, addresses):
+            exit(1)
+        hostname_to_use, domain_to_use = split_hostname(args.hostname)
+        for record_type, ip_to_use in addresses.items():
+            state.published(REPORT_STATE_NAME, hostname_to_use, domain_to_use, ip_to_use, record_type)
+        exit(0)
+
     # Need a provider to continue
     if not args.provider:
         sys.stderr.write("Error: Need --provider, cannot continue.\n\n")
         parser.print_help()
         exit(2)
 
-    # Import the implementation of given provider
-    if args.provider == 'rackspace':
-        from clouddns.rackspace import Rackspace
-        provider = Rackspace()
-        default_credentials_filename = provider.default_credentials_file()
-    elif args.provider == 'azure':
-        from clouddns.azure import Azure
-        provider = Azure()
-        default_credentials_filename = provider.default_credentials_file()
-    else:
-        sys.stderr.write("Error: Unknown provider %s, cannot continue.\n\n" % args.provider)
-        parser.print_help()
-        exit(2)
-
-    # Confirm, that there exists credentials
-    if args.api_user and args.api_key:
-        api_credentials = (args.api_user, args.api_key)
-    elif args.api_credentials_file and args.api_credentials_file != default_credentials_filename:
-        # A credentials-file was given
-        api_credentials = provider._read_credentials_file(args.api_credentials_file)
-    elif default_credentials_filename and os.path.isfile(default_credentials_filename):
-        # Using default credentials file for given provider
-        api_credentials = provider._read_credentials_file(default_credentials_filename)
-    elif not args.dry_run:
-        sys.stderr.write("Error: Cloud provider API credentials missing, cannot continue.\n\n")
+    provider_names = get_provider_names(args, parser)
+    if len(provider_names) > 1:
+        # Each provider reads credentials of its own
+        if args.daemon or args.collector or args.worker or args.api_user or args.api_key or \
+                args.api_credentials_file:
+            sys.stderr.write("Error: Many providers cannot be used with --daemon, --collector, --worker or "
+                             "API credentials, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        if not 0 <= args.provider_quorum <= len(provider_names):
+            sys.stderr.write("Error: Quorum of %d providers out of %d, cannot continue.\n\n" %
+                             (args.provider_quorum, len(provider_names)))
+            parser.print_help()
+            exit(2)
+    args.provider = provider_names[0]
+    if args.worker and args.daemon:
+        sys.stderr.write("Error: --worker cannot be used with --daemon, cannot continue.\n\n")
         parser.print_help()
         exit(2)
 
-    # IPv4-address given on CLI?
-    if args.ip_address:
-        # Using static one. No need to check for interface.
-        ip_to_use = args.ip_address
-    elif args.detect_public_ip:
-        ip_to_use = get_ipinfoio_address()
-        if not ip_to_use:
-            sys.stderr.write("Error: Failed to get IPv4 address from ipinfo.io")
-            exit(1)
-    elif args.public_ip_from_platform:
-        if args.public_ip_from_platform.lower() == 'aws':
-            ip_to_use = provider.get_current_ipv4_from_aws_vm_metadata()
-        elif args.public_ip_from_platform.lower() == 'azure':
-            ip_to_use = provider.get_current_ipv4_from_azure_vm_metadata()
-        else:
-            sys.stderr.write("Error: Given platform '%s' not known.\n\n" % args.public_ip_from_platform)
+    interface_hostnames = get_interface_hostnames(args, parser)
+    if args.collector:
+        if args.daemon or args.worker or not args.collector_tokens or interface_hostnames:
+            sys.stderr.write("Error: --collector needs --collector-tokens and cannot be used with --daemon, "
+                             "--worker or --interfaces, cannot continue.\n\n")
             parser.print_help()
             exit(2)
-
-        if not ip_to_use:
-            sys.stderr.write("Error: Failed to get IPv4 address from platform '%s'" % args.public_ip_from_platform)
-            exit(1)
-    else:
-        # Detect, check that we have interface
-        if not args.interface:
-            sys.stderr.write("Error: Need interface to query IP-address for, cannot continue.\n\n")
+        if args.collector_tls_key and not args.collector_tls_cert:
+            sys.stderr.write("Error: --collector-tls-key needs --collector-tls-cert, cannot continue.\n\n")
             parser.print_help()
             exit(2)
+        addresses = None
+    elif interface_hostnames:
+        # Addresses and hostnames of all mapped interfaces
+        if args.interface or args.hostname or args.ip_address or args.ipv6_address or args.detect_public_ip or \
+                args.public_ip_from_platform:
+            sys.stderr.write("Error: --interfaces cannot be used with --interface, --hostname or other address "
+                             "sources, cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        get_record_types(args, parser)
+        addresses = None
+    elif args.daemon:
+        # Address is read from interface on every change. Check that we have interface
+        if not args.interface or args.ip_address or args.ipv6_address or args.detect_public_ip or \
+                args.public_ip_from_platform:
+            sys.stderr.write("Error: --daemon needs an interface to monitor and no other address source, "
+                             "cannot continue.\n\n")
+            parser.print_help()
+            exit(2)
+        get_record_types(args, parser)
+        addresses = None
+    elif args.worker:
+        # Address is read on every trigger
+        get_record_types(args, parser)
+        addresses = None
+    else:
+        addresses = get_addresses_to_use(args, parser)
+
+    # Check the FQDN hostname. Collector gets the hostnames from reports, --interfaces has them mapped.
+    if not args.collector and not interface_hostnames:
+        if not args.hostname:
+            args.hostname = socket.getfqdn()
+        hostname_to_use, domain_to_use = split_hostname(args.hostname)
+        if not hostname_to_use or not domain_to_use:
+            sys.stderr.write("Error: Cannot parse hostname %s\n" % args.hostname)
+            exit(2)
+
+    # Published this address recently? No need to even load the provider, unless earlier updates are queued.
+    state = PublishedState()
+    queue = UpdateQueue()
+    hosts = []
+    skipped = 0
+    if addresses:
+        hosts = [(args.hostname, addresses)]
+    if interface_hostnames and not args.daemon and not args.worker:
+        # Addresses of all interfaces with a single read
+        with metrics.phase('address'):
+            hosts, skipped = get_interface_hosts(args, parser, interface_hostnames, get_address_policy(args, parser))
+    provider_hosts = {provider_name: [(fqdn, host_addresses) for fqdn, host_addresses in hosts
+                                      if not is_published(state, args, host_addresses, provider_name, fqdn, queue)]
+                      for provider_name in provider_names}
+    if args.dns_precheck and any(provider_hosts.values()):
+        # Nameservers answering with the addresses already? No need to load the provider.
+        with metrics.phase('dns_precheck'):
+            provider_hosts = precheck_hosts(args, parser, provider_hosts, state, queue)
+    hosts = provider_hosts[args.provider]
+    if not any(provider_hosts.values()) and not args.collector and not args.daemon and not args.worker and \
+            not any(queue.pending(provider_name) for provider_name in provider_names):
+        exit(1 if skipped else 0)
 
-        ip_to_use = get_current_ip_from_interface(args.interface)
+    if len(provider_names) > 1:
+        # Address is detected once, then all providers are updated concurrently
+        failed = update_providers(provider_names, provider_hosts, args, parser, state, queue, create_damper(args))
+        succeeded = len(provider_names) - len(failed)
+        quorum = args.provider_quorum or len(provider_names)
+        print("Updated %d of %d providers, quorum is %d." % (succeeded, len(provider_names), quorum))
+        exit(1 if succeeded < quorum or skipped else 0)
+
+    # Import the implementation of given provider
+    provider = create_provider(args.provider, args)
 
-    # Check the FQDN hostname
-    hostname_to_use = args.hostname.split('.')[0]
-    domain_to_use = '.'.join(args.hostname.split('.')[1:])
-    if not hostname_to_use or not domain_to_use:
-        sys.stderr.write("Error: Cannot parse hostname %s\n" % args.hostname)
+    # Confirm, that there exists credentials
+    api_credentials = read_api_credentials(provider, args)
+    if not api_credentials and not args.dry_run:
+        sys.stderr.write("Error: Cloud provider API credentials missing, cannot continue.\n\n")
+        parser.print_help()
         exit(2)
 
     # Debug API?:
     if args.debug_cloud_api:
         provider.debug(True)
 
-    # Use the given credentials
-    # Check if we have a valid token in cache.
-    if not provider.is_authenticated():
-        provider.authenticate(api_credentials)
-
-    # Need to do anything?
-    current_rr, current_ip = provider.get_current_ip_from_dns(hostname_to_use, domain_to_use)
-    if current_ip and current_ip == ip_to_use:
-        print("No need to update! %s already has address of %s" % (args.hostname, ip_to_use))
+    if args.collector:
+        run_collector(provider, api_credentials, args, queue)
         exit(0)
 
-    if args.dry_run:
-        print("--dry-run specified!\nWould update %s to have address of %s. Quit." % (args.hostname, ip_to_use))
+    damper = create_damper(args)
+    if args.daemon:
+        run_daemon(provider, api_credentials, args, parser, state, queue, damper)
+        exit(0)
+    if args.worker:
+        run_worker(provider, api_credentials, args, parser, state, queue, damper, interface_hostnames)
         exit(0)
 
-    # Go update!
-    provider.update_rr(hostname_to_use, domain_to_use, ip_to_use, current_rr)
+    if interface_hostnames or len(hosts) != 1 or queue.pending(args.provider):
+        updated = []
+        failures = update_hosts_queued(provider, api_credentials, hosts, args, state, queue, damper, updated)
+        failures += len(verify_propagation(args, parser, provider.name, updated))
+        exit(1 if failures or skipped else 0)
 
-    print("Updated %s to have address of %s. Done." % (args.hostname, ip_to_use))
+    try:
+        authenticate(provider, api_credentials)
+        with metrics.phase('update'):
+            updated = update_dns(provider, args.hostname, addresses, args.dry_run, state, damper)
+    except Exception as exc:
+        sys.stderr.write("Error: Failed to update %s to have address of %s: %s\n" %
+                         (args.hostname, ', '.join(addresses.values()), exc))
+        if not args.dry_run:
+            # Any later run with the same account retries it
+            queue.put(provider.name, provider.account_key(api_credentials), args.hostname, addresses)
+        exit(1)
+    retry_at = deferred_retries(provider, [(args.hostname, addresses)], damper).get(args.hostname)
+    if retry_at and not args.dry_run:
+        queue.put(provider.name, provider.account_key(api_credentials), args.hostname, addresses, retry_at)
+    if updated and not args.dry_run and verify_propagation(args, parser, provider.name, [(args.hostname, addresses)]):
+        exit(1)
     exit(0)
 
 
@@ -1,3 +1,3 @@
-from .base_cloud import BaseCloud
+from .base_cloud import BaseCloud, PreconditionFailed
 
-__all__ = ['BaseCloud']
+__all__ = ['BaseCloud', 'PreconditionFailed']
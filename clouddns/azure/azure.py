@@ -4,13 +4,17 @@
 
 from azure.mgmt.dns import DnsManagementClient
 from azure.common.credentials import ServicePrincipalCredentials
+from msrest.authentication import BasicTokenAuthentication
+from msrest.exceptions import ClientRequestError
 from msrestazure.azure_exceptions import CloudError
 import os.path
 import sys
 import json
 from pathlib import Path
 import re
-from ..base_cloud import BaseCloud
+from ..base_cloud import BaseCloud, PreconditionFailed
+from ..call_policy import UNAVAILABLE
+from ..cache import JsonFileCache, default_cache_dir
 import logging
 
 # This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
@@ -30,27 +34,44 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# Seconds a zone in the on-disk zone index is trusted without listing the zones again
+ZONE_INDEX_TTL = 86400
+
+# Record sets per page when listing a whole zone. API maximum is 100.
+ZONE_LISTING_PAGE_SIZE = 100
+
+# Environment variable to override Azure Resource Manager URL with, for sovereign clouds and Azure Stack
+RESOURCE_MANAGER_URL_ENV = 'AZURE_RESOURCE_MANAGER_URL'
+
 
 class Azure(BaseCloud):
     """
     Azure DNS implementation
     See: https://docs.microsoft.com/en-us/python/api/overview/azure/dns?view=azure-python
     """
+    name = 'azure'
+    zone_lookup_method = '_get_zone_resource_group'
+    conditional_writes = True
     dns_client = None
-    dns_zone = None
-    dns_zone_rg = None
-
-    def is_authenticated(self):
-        if self.dns_client is not None:
-            return True
+    subscription_id = None
+    http_debug = False
 
-        return False
+    def __init__(self, zone_index_file=None, token_cache=None):
+        super().__init__(token_cache=token_cache)
+        # Resource group of each DNS zone seen, by zone name
+        self.dns_zone_rgs = {}
+        # Zones seen in a zone listing during this run, their resource groups are known to be current
+        self.dns_zones_listed = set()
+        # Persisted zone name --> resource group and zone ID, to avoid listing all zones on every run
+        if not zone_index_file:
+            zone_index_file = default_cache_dir() + "/azure-zones.json"
+        self.zone_index = JsonFileCache(zone_index_file, ttl=ZONE_INDEX_TTL)
 
-    def authenticate(self, api_creds):
+    def _login(self, api_creds):
         """
         See: https://docs.microsoft.com/en-us/python/azure/python-sdk-azure-authenticate?view=azure-python
         :param api_creds: tuple of access credentials, see _read_credentials_file()
-        :return:
+        :return: tuple, token data and its expiry
         """
         credentials = ServicePrincipalCredentials(
             client_id=api_creds[2],
@@ -60,8 +81,11 @@ class Azure(BaseCloud):
 
         self.dns_client = DnsManagementClient(
             credentials,
-            api_creds[1]
+            api_creds[1],
+            base_url=os.environ.get(RESOURCE_MANAGER_URL_ENV)
         )
+        self._configure_client()
+        self.subscription_id = api_creds[1]
 
         # Sanity: See that an access token exists.
         if not self.dns_client._client.config.credentials.token['is_mrrt']:
@@ -70,71 +94,309 @@ class Azure(BaseCloud):
 
         log.info("Authenticated into Azure ok")
 
-    def get_current_ip_from_dns(self, host, domain):
+        token = {
+            "subscription_id": api_creds[1],
+            "token": credentials.token
+        }
+
+        return token, float(credentials.token['expires_on'])
+
+    def _restore_token(self, token):
+        self.dns_client = DnsManagementClient(
+            BasicTokenAuthentication(token['token']),
+            token['subscription_id'],
+            base_url=os.environ.get(RESOURCE_MANAGER_URL_ENV)
+        )
+        self._configure_client()
+        self.subscription_id = token['subscription_id']
+
+    def _configure_client(self):
+        self.dns_client.config.enable_http_logger = self.http_debug
+        # Retries are done by call policy within the deadline, not by SDK on its own.
+        # SDK would retry any failed request three times, even when told to slow down.
+        # Without status retries, a failure is raised as CloudError having the response and its Retry-After.
+        self.dns_client.config.retry_policy.retries = 0
+        self.dns_client.config.retry_policy.policy.status_forcelist = []
+
+    def _call(self, func, *args, idempotent=True, **kwargs):
+        def call_with_timeout(*call_args, **call_kwargs):
+            # Every attempt may wait only for what is left of the deadline
+            if self.dns_client:
+                self.dns_client.config.connection.timeout = self.call_policy.request_timeout()
+
+            return func(*call_args, **call_kwargs)
+
+        return super()._call(call_with_timeout, *args, idempotent=idempotent, **kwargs)
+
+    def _transient_error(self, exc):
+        if isinstance(exc, ClientRequestError):
+            # Connection failed or timed out
+            return UNAVAILABLE, None
+
+        return super()._transient_error(exc)
+
+    def _token_identity(self, api_creds):
+        # Tenant, subscription and service principal
+        return "{0}/{1}/{2}".format(api_creds[0], api_creds[1], api_creds[2])
+
+    def get_current_ip_from_dns(self, host, domain, record_type='A'):
         """
         Get the current recurd
         :param host: hostname of the FQDN, without dot
         :param domain: domain part of the FQDN
+        :param record_type: A or AAAA
         :return: Object|None, currently set IP-address
         """
-        self.dns_zone = None
-        self.dns_zone_rg = None
-        zones = self.dns_client.zones.list()
-        for zone in zones:
-            if zone.name == domain:
-                self.dns_zone = zone
-                break
-        if not self.dns_zone:
-            log.error("Didn't find domain {0}".format(domain))
-            raise RuntimeError("Didn't find domain {0}".format(domain))
-
-        resource_group_match = re.search("/resourceGroups/([^/]+)/", self.dns_zone.id)
-        if not resource_group_match:
-            log.error("Invalid internal Azure resource ID for domain {0}".format(domain))
-            raise RuntimeError("Invalid internal Azure resource ID for domain {0}".format(domain))
-
-        self.dns_zone_rg = resource_group_match.group(1)
-
         try:
-            record_set = self.dns_client.record_sets.get(
-                self.dns_zone_rg,
-                self.dns_zone.name,
+            record_set = self._with_zone_resource_group(domain, lambda dns_zone_rg: self._call(
+                self.dns_client.record_sets.get,
+                dns_zone_rg,
+                domain,
                 host,
-                'A'
-            )
+                record_type
+            ))
         except CloudError as exc:
             if exc.status_code == 404:
-                log.debug("No A-record for {0}.{1}. Ignored.".format(host, domain))
+                log.debug("No {0}-record for {1}.{2}. Ignored.".format(record_type, host, domain))
                 # Nope, that record doesn't exist.
                 return None, None
 
-            log.exception("Failed to read A-record for {0}.{1}".format(host, domain))
+            log.exception("Failed to read {0}-record for {1}.{2}".format(record_type, host, domain))
             raise exc
 
-        current_ipv4 = record_set.arecords[0].ipv4_address
-        log.info("Current IPv4 address for {0}.{1} is {2}".format(host, domain, current_ipv4))
+        current_ip = self._record_set_ip(record_set, record_type)
+        log.info("Current {0} address for {1}.{2} is {3}".format(record_type, host, domain, current_ip))
 
         # Oh yes, we have that!
-        return record_set, current_ipv4
-
-    def update_rr(self, host, domain, ip, record_to_update):
-        record_set = self.dns_client.record_sets.create_or_update(
-            self.dns_zone_rg,
-            domain,
-            host,
-            'A',
-            {
+        return record_set, current_ip
+
+    def get_current_ips_from_dns(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Get the current records of multiple types for a host, record types read concurrently.
+        Record set listing can't be used: its name suffix filter matches only names below the host, not the host.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, record type: tuple of record object and IP-address, both None if there is no record
+        """
+        if len(record_types) == 1:
+            return {record_types[0]: self.get_current_ip_from_dns(host, domain, record_types[0])}
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(record_types)) as executor:
+            reads = {record_type: executor.submit(self.get_current_ip_from_dns, host, domain, record_type)
+                     for record_type in record_types}
+
+            return {record_type: read.result() for record_type, read in reads.items()}
+
+    async def get_current_ips_from_dns_async(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Async variant of get_current_ips_from_dns(), record types are read concurrently in executor
+        """
+        import asyncio
+
+        current_ips = await asyncio.gather(*[self.get_current_ip_from_dns_async(host, domain, record_type)
+                                             for record_type in record_types])
+
+        return dict(zip(record_types, current_ips))
+
+    def get_zone_records(self, domain, hosts, record_types=('A', 'AAAA')):
+        """
+        Get the current records of many hosts with a paged listing of all record sets in the zone
+        :param domain: domain part of the FQDNs
+        :param hosts: hostnames of the FQDNs, without dot
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, (hostname, record type): tuple of record object and IP-address
+        """
+        hosts = set(hosts)
+        # Pages are fetched while iterating. A failed listing is retried from the start.
+        record_sets = self._with_zone_resource_group(domain, lambda dns_zone_rg: self._call(lambda: list(
+            self.dns_client.record_sets.list_by_dns_zone(dns_zone_rg, domain, top=ZONE_LISTING_PAGE_SIZE)
+        )))
+
+        current = {}
+        for record_set in record_sets:
+            record_type = record_set.type.split('/')[-1]
+            if record_set.name not in hosts or record_type not in record_types:
+                continue
+            current[(record_set.name, record_type)] = (record_set, self._record_set_ip(record_set, record_type))
+        log.info("Listed {0} record sets of zone {1}, {2} of them for requested hosts".format(
+            len(record_sets), domain, len(current)))
+
+        return current
+
+    def update_rr(self, host, domain, ip, record_to_update, record_type='A'):
+        # Record set is written as a whole, a retried PUT has the same outcome
+        record_set = self._with_zone_resource_group(
+            domain, lambda dns_zone_rg: self._call(
+                self.dns_client.record_sets.create_or_update,
+                dns_zone_rg,
+                domain,
+                host,
+                record_type,
+                self._record_set_data(ip, record_type)
+            ))
+        log.info("Updated {0} address for {1}.{2} as {3}".format(record_type, host, domain, ip))
+
+        return record_set
+
+    def record_etag(self, record):
+        return record.etag if record else None
+
+    def update_rrs_conditional(self, host, domain, changes, etags):
+        """
+        Write record sets with If-Match on their ETags, or If-None-Match for new ones.
+        Azure has no batch API, each record set is a request of its own.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param changes: list of tuples: record type, IP-address, existing record object or None
+        :param etags: dict, record type: ETag the record set must still have. None for a new record set.
+        :return: dict, record type: ETag of the written record set
+        """
+        new_etags = {}
+        for record_type, ip, _ in changes:
+            etag = etags.get(record_type)
+            try:
+                record_set = self._with_zone_resource_group(
+                    domain, lambda dns_zone_rg: self._call(
+                        self.dns_client.record_sets.create_or_update,
+                        dns_zone_rg,
+                        domain,
+                        host,
+                        record_type,
+                        self._record_set_data(ip, record_type),
+                        if_match=etag,
+                        if_none_match=None if etag else '*'
+                    ))
+            except CloudError as exc:
+                if exc.status_code == 412:
+                    raise PreconditionFailed("{0}-record of {1}.{2} has been changed by someone else".format(
+                        record_type, host, domain))
+                raise
+            log.info("Updated {0} address for {1}.{2} as {3}".format(record_type, host, domain, ip))
+            new_etags[record_type] = record_set.etag
+
+        return new_etags
+
+    @staticmethod
+    def _record_set_ip(record_set, record_type):
+        if record_type == 'AAAA':
+            return record_set.aaaa_records[0].ipv6_address
+
+        return record_set.arecords[0].ipv4_address
+
+    @staticmethod
+    def _record_set_data(ip, record_type):
+        if record_type == 'AAAA':
+            return {
                 "ttl": 300,
-                "arecords": [
+                "aaaa_records": [
                     {
-                        "ipv4_address": ip
+                        "ipv6_address": ip
                     }
                 ]
             }
-        )
-        log.info("Updated IPv4 address for {0}.{1} as {2}".format(host, domain, ip))
 
-        return record_set
+        return {
+            "ttl": 300,
+            "arecords": [
+                {
+                    "ipv4_address": ip
+                }
+            ]
+        }
+
+    def _with_zone_resource_group(self, domain, operation):
+        """
+        Run an operation on a DNS zone.
+        If API says the zone is not there, it is looked up again and operation is retried once.
+        :param domain: name of the DNS zone
+        :param operation: function taking the resource group name as argument
+        :return: whatever operation returns
+        """
+        dns_zone_rg = self._get_zone_resource_group(domain)
+        try:
+            return operation(dns_zone_rg)
+        except CloudError as exc:
+            # Zone may have been moved or deleted since it was indexed. Retry with a fresh zone listing.
+            if exc.status_code != 404 or not self._revalidate_zone(domain, dns_zone_rg):
+                raise
+
+        return operation(self._get_zone_resource_group(domain))
+
+    def _get_zone_resource_group(self, domain):
+        """
+        Find the resource group a DNS zone is in.
+        Zone index is consulted first, all zones of the subscription are listed only on a miss.
+        :param domain: name of the DNS zone
+        :return: str, name of the resource group
+        """
+        if domain in self.dns_zone_rgs:
+            return self.dns_zone_rgs[domain]
+
+        indexed_zone = self.zone_index.get(self._zone_index_key(domain))
+        if indexed_zone:
+            log.debug("Zone {0} found from zone index in resource group {1}".format(domain, indexed_zone[0]))
+            self.dns_zone_rgs[domain] = indexed_zone[0]
+
+            return indexed_zone[0]
+
+        # Index all the zones while at it. Listing costs the same, no matter which zone is looked for.
+        dns_zone = None
+        zones_to_index = {}
+        zones = self._call(lambda: list(self.dns_client.zones.list()))
+        for zone in zones:
+            resource_group_match = re.search("/resourceGroups/([^/]+)/", zone.id)
+            if resource_group_match:
+                zones_to_index[self._zone_index_key(zone.name)] = (resource_group_match.group(1), zone.id)
+                self.dns_zones_listed.add(zone.name)
+            if zone.name == domain:
+                dns_zone = zone
+        self.zone_index.update(zones_to_index)
+
+        if not dns_zone:
+            log.error("Didn't find domain {0}".format(domain))
+            raise RuntimeError("Didn't find domain {0}".format(domain))
+
+        if self._zone_index_key(domain) not in zones_to_index:
+            log.error("Invalid internal Azure resource ID for domain {0}".format(domain))
+            raise RuntimeError("Invalid internal Azure resource ID for domain {0}".format(domain))
+
+        self.dns_zone_rgs[domain] = zones_to_index[self._zone_index_key(domain)][0]
+
+        return self.dns_zone_rgs[domain]
+
+    def _revalidate_zone(self, domain, dns_zone_rg):
+        """
+        Check a zone after API responded 404. If the zone isn't in the resource group anymore,
+        forget it and look it up again.
+        :param domain: name of the DNS zone
+        :param dns_zone_rg: resource group which was used
+        :return: bool, True if the zone was looked up again and is in a different resource group now
+        """
+        if domain in self.dns_zones_listed:
+            # Resource group is fresh from the API, it was the record which wasn't found
+            return False
+
+        # A single zone read is enough to tell a missing record from a missing zone
+        try:
+            self._call(self.dns_client.zones.get, dns_zone_rg, domain)
+            self.dns_zones_listed.add(domain)
+
+            return False
+        except CloudError as exc:
+            if exc.status_code != 404:
+                raise
+
+        log.debug("Zone {0} not found in resource group {1}, refreshing zone index".format(domain, dns_zone_rg))
+        self.dns_zone_rgs.pop(domain, None)
+        self.zone_index.invalidate(self._zone_index_key(domain))
+
+        return self._get_zone_resource_group(domain) != dns_zone_rg
+
+    def _zone_index_key(self, domain):
+        return "{0}/{1}".format(self.subscription_id, domain)
 
     @staticmethod
     def _read_credentials_file(creds_file):
@@ -162,5 +424,15 @@ class Azure(BaseCloud):
         return default_credentials_filename
 
     def debug(self, debugging):
-        #pyrax.set_http_debug(debugging)
-        pass
+        """
+        Log requests and responses of Azure SDK, as Pyrax does for Rackspace
+        :param debugging: bool
+        :return:
+        """
+        self.http_debug = debugging
+        http_logger = logging.getLogger('msrest.http_logger')
+        http_logger.setLevel(logging.DEBUG if debugging else logging.WARNING)
+        if debugging and not http_logger.handlers:
+            http_logger.addHandler(logging.StreamHandler())
+        if self.dns_client:
+            self.dns_client.config.enable_http_logger = debugging
@@ -18,39 +18,367 @@
 #
 # Copyright (c) Jari Turkia
 
-import requests
+import sys
+import time
+from .cache import JsonFileCache, default_cache_dir
+from .call_policy import CallPolicy, THROTTLED, UNAVAILABLE
+from .token_cache import TokenCache
 import logging
 
 log = logging.getLogger(__name__)
 
+# Seconds to wait for virtualisation platform metadata service
+DEFAULT_METADATA_TIMEOUT = 2.0
+METADATA_RETRIES = 1
+
+# Lifetime of AWS IMDSv2 session token, and seconds before expiry a new one is requested
+AWS_IMDS_TOKEN_TTL = 21600
+AWS_IMDS_TOKEN_MARGIN = 60
+
+
+class PreconditionFailed(RuntimeError):
+    """
+    Conditional write failed, record has been changed since its ETag was seen
+    """
+    pass
+
 
 class BaseCloud(object):
     """
     Abstract class to implement the intefrace for Cloud DNS providers
     """
 
-    def is_authenticated(self):
-        raise NotImplementedError("Base class doesn't have this.")
+    # Provider name as given in configuration
+    name = None
+
+    # Method looking up a DNS zone, measured separately in metrics. None if provider has no such lookup.
+    zone_lookup_method = None
+
+    # Provider can write a record conditionally on its ETag, see update_rrs_conditional()
+    conditional_writes = False
+
+    # Provider creates or replaces a record with a single write, update_rrs() doesn't need the existing record
+    upsert_writes = False
+
+    # AWS IMDSv2 session token, shared by all instances
+    _aws_imds_token_cache = None
+
+    def __init__(self, token_cache=None):
+        """
+        :param token_cache: TokenCache to keep authentication tokens in. Default: a file based one.
+        """
+        if token_cache is None:
+            token_cache = TokenCache()
+        self.token_cache = token_cache
+        # UNIX-timestamp of current authentication expiry
+        self.token_expires = None
+        # Thread pool for blocking calls of the async interface. None for the default one of the event loop.
+        self.executor = None
+        # Deadline, retries and circuit breaker of API calls
+        self.call_policy = CallPolicy(self.name)
+
+    def is_authenticated(self, api_creds=None):
+        """
+        See if there is a valid authentication, either already made or in the token cache.
+        Expiry is checked locally, a valid token costs no requests.
+        :param api_creds: tuple of access credentials the token would be for
+        :return: bool
+        """
+        if self.token_expires and self.token_expires - self.token_cache.refresh_margin > time.time():
+            return True
+        if not api_creds:
+            return False
+
+        token_key = self._token_cache_key(api_creds)
+        cached = self.token_cache.get(token_key)
+        if not cached:
+            return False
+
+        token, expires = cached
+        try:
+            self._restore_token(token)
+        except Exception as exc:
+            log.warning("Ignoring unusable cached token {0}: {1}".format(token_key, exc))
+            self.token_cache.invalidate(token_key)
+
+            return False
+
+        self.token_expires = expires
+        log.debug("Using cached token {0}".format(token_key))
+
+        return True
 
     def authenticate(self, api_creds):
+        """
+        Exchange API credentials for a token, and store it into token cache
+        :param api_creds: tuple of access credentials
+        :return:
+        """
+        token, expires = self._call(self._login, api_creds)
+        self.token_expires = expires
+        self.token_cache.put(self._token_cache_key(api_creds), token, expires)
+
+    def seconds_until_refresh(self):
+        """
+        Long-running modes should authenticate again after this, before the token expires.
+        :return: float, seconds. None if not authenticated.
+        """
+        if not self.token_expires:
+            return None
+
+        return max(0.0, self.token_expires - self.token_cache.refresh_margin - time.time())
+
+    def _call(self, func, *args, idempotent=True, **kwargs):
+        """
+        Make a provider API call within the deadline of the run, retrying transient failures
+        :param func: function making the call
+        :param idempotent: bool, the call can be repeated safely even if it was processed already
+        :return: whatever the function returns
+        """
+        return self.call_policy.call(func, args, kwargs, idempotent=idempotent, classify=self._transient_error)
+
+    def _transient_error(self, exc):
+        """
+        Tell a transient failure of an API call from a permanent one.
+        Default implementation looks at the HTTP-response of the exception, and connection errors of requests.
+        :param exc: exception raised by the call
+        :return: tuple, THROTTLED, UNAVAILABLE or None if call is not to be retried, and value of Retry-After or None
+        """
+        response = getattr(exc, 'response', None)
+        status_code = getattr(response, 'status_code', None)
+        if status_code:
+            retry_after = response.headers.get('Retry-After') if getattr(response, 'headers', None) else None
+            if status_code == 429:
+                return THROTTLED, retry_after
+            if status_code >= 500:
+                return UNAVAILABLE, retry_after
+
+            return None, None
+
+        # No need to import requests, if the provider library doesn't use it
+        requests = sys.modules.get('requests')
+        if requests and isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+            return UNAVAILABLE, None
+
+        return None, None
+
+    def _login(self, api_creds):
+        """
+        Authenticate with API credentials
+        :param api_creds: tuple of access credentials
+        :return: tuple, JSON-serializable token data and its expiry as UNIX-timestamp
+        """
         raise NotImplementedError("Base class doesn't have this.")
 
-    def get_current_ip_from_dns(self, host, domain):
+    def _restore_token(self, token):
+        """
+        Take a cached token into use without making any requests
+        :param token: token data as returned by _login()
+        :return:
+        """
         raise NotImplementedError("Base class doesn't have this.")
 
-    def update_rr(self, host, domain, ip, record_to_update):
+    def _token_identity(self, api_creds):
+        """
+        :param api_creds: tuple of access credentials
+        :return: str, non-secret part of credentials identifying the token owner
+        """
+        raise NotImplementedError("Base class doesn't have this.")
+
+    def account_key(self, api_creds):
+        """
+        :param api_creds: tuple of access credentials
+        :return: str, identifies the provider account, without revealing the credentials
+        """
+        return self._token_cache_key(api_creds)
+
+    def _token_cache_key(self, api_creds):
+        import hashlib
+
+        identity_hash = hashlib.sha256(self._token_identity(api_creds).encode('utf8')).hexdigest()
+
+        return "{0}.{1}".format(self.name, identity_hash[:16])
+
+    def get_current_ip_from_dns(self, host, domain, record_type='A'):
+        raise NotImplementedError("Base class doesn't have this.")
+
+    def update_rr(self, host, domain, ip, record_to_update, record_type='A'):
+        raise NotImplementedError("Base class doesn't have this.")
+
+    def get_current_ips_from_dns(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Get the current records of multiple types for a host.
+        Default implementation reads each type separately, providers able to read them at once override this.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, record type: tuple of record object and IP-address, both None if there is no record
+        """
+        return {record_type: self.get_current_ip_from_dns(host, domain, record_type)
+                for record_type in record_types}
+
+    def update_rrs(self, host, domain, changes):
+        """
+        Update multiple records of a host.
+        Default implementation updates each record separately, providers having a batch API override this.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param changes: list of tuples: record type, IP-address, existing record object or None to add one
+        :return:
+        """
+        for record_type, ip, record_to_update in changes:
+            self.update_rr(host, domain, ip, record_to_update, record_type)
+
+    def update_zone_rrs(self, domain, host_changes):
+        """
+        Update records of many hosts of a zone.
+        Default implementation updates host by host, providers able to change a zone in a single request override this.
+        :param domain: domain part of the FQDNs
+        :param host_changes: list of tuples: hostname, list of changes as for update_rrs()
+        :return:
+        """
+        for host, changes in host_changes:
+            self.update_rrs(host, domain, changes)
+
+    def record_etag(self, record):
+        """
+        :param record: record object as returned by get_current_ips_from_dns(), or None
+        :return: str, ETag of the record. None if there is no record or provider has no conditional writes.
+        """
+        return None
+
+    def update_rrs_conditional(self, host, domain, changes, etags):
+        """
+        Update multiple records of a host, only if they haven't been changed since their ETags were seen.
+        With ETags of previous writes remembered, there is no need to read the records before writing.
+        Implemented by providers having conditional_writes.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param changes: list of tuples: record type, IP-address, existing record object or None
+        :param etags: dict, record type: ETag the record must still have. None for a record which must not exist.
+        :return: dict, record type: ETag of the written record
+        :raises PreconditionFailed: a record has been changed, or created, by someone else
+        """
+        raise NotImplementedError("Base class doesn't have this.")
+
+    def get_zone_records(self, domain, hosts, record_types=('A', 'AAAA')):
+        """
+        Get the current records of many hosts at once. All records of the zone are listed page by page,
+        costing the same number of requests no matter how many hosts are looked for.
+        :param domain: domain part of the FQDNs
+        :param hosts: hostnames of the FQDNs, without dot
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, (hostname, record type): tuple of record object and IP-address. Missing records are left out.
+        """
         raise NotImplementedError("Base class doesn't have this.")
 
     def debug(self, debugging):
         raise NotImplementedError("Base class doesn't have this.")
 
+    async def get_current_ip_from_dns_async(self, host, domain, record_type='A'):
+        """
+        Async variant of get_current_ip_from_dns().
+        Default implementation runs the blocking call in executor, providers having an async API override this.
+        """
+        return await self.run_blocking(self.get_current_ip_from_dns, host, domain, record_type)
+
+    async def update_rr_async(self, host, domain, ip, record_to_update, record_type='A'):
+        """
+        Async variant of update_rr().
+        Default implementation runs the blocking call in executor, providers having an async API override this.
+        """
+        return await self.run_blocking(self.update_rr, host, domain, ip, record_to_update, record_type)
+
+    async def get_current_ips_from_dns_async(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Async variant of get_current_ips_from_dns()
+        """
+        return await self.run_blocking(self.get_current_ips_from_dns, host, domain, record_types)
+
+    async def update_rrs_async(self, host, domain, changes):
+        """
+        Async variant of update_rrs()
+        """
+        return await self.run_blocking(self.update_rrs, host, domain, changes)
+
+    async def update_rrs_conditional_async(self, host, domain, changes, etags):
+        """
+        Async variant of update_rrs_conditional()
+        """
+        return await self.run_blocking(self.update_rrs_conditional, host, domain, changes, etags)
+
+    async def get_zone_records_async(self, domain, hosts, record_types=('A', 'AAAA')):
+        """
+        Async variant of get_zone_records()
+        """
+        return await self.run_blocking(self.get_zone_records, domain, hosts, record_types)
+
+    async def run_blocking(self, func, *args):
+        """
+        Run a blocking function in executor without blocking the event loop
+        :param func: function to run
+        :param args: arguments for the function
+        :return: whatever the function returns
+        """
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
     @staticmethod
-    def get_current_ipv4_from_aws_vm_metadata():
+    def _get_aws_imds_token(timeout, refresh=False):
+        """
+        Get an IMDSv2 session token. Tokens are cached for their lifetime, a new one is requested only on expiry.
+        See: https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/configuring-instance-metadata-service.html
+        :param timeout: seconds to wait
+        :param refresh: don't use a cached token
+        :return: str, token. None if IMDSv2 is not available.
+        """
+        import requests
+        from . import http
+
+        if BaseCloud._aws_imds_token_cache is None:
+            BaseCloud._aws_imds_token_cache = JsonFileCache(default_cache_dir() + "/aws-imds-token.json",
+                                                            ttl=AWS_IMDS_TOKEN_TTL - AWS_IMDS_TOKEN_MARGIN)
+        if not refresh:
+            token = BaseCloud._aws_imds_token_cache.get('token')
+            if token:
+                return token
+
+        # No retries: IMDSv1 or a hop limit too low for IMDSv2 makes the PUT time out, not worth waiting for twice
+        headers = {'user-agent': 'clouddns/0.1', 'X-aws-ec2-metadata-token-ttl-seconds': str(AWS_IMDS_TOKEN_TTL)}
+        try:
+            resp = http.put('http://169.254.169.254/latest/api/token', headers=headers, timeout=timeout, retries=0)
+        except requests.RequestException as exc:
+            log.debug("No IMDSv2 token: {0}. Using IMDSv1.".format(exc))
+            return None
+        if not resp.ok:
+            log.debug("No IMDSv2 token, response {0}. Using IMDSv1.".format(resp.status_code))
+            return None
+
+        BaseCloud._aws_imds_token_cache.put('token', resp.text)
+
+        return resp.text
+
+    @staticmethod
+    def get_current_ipv4_from_aws_vm_metadata(timeout=DEFAULT_METADATA_TIMEOUT):
+        from . import http
+
         # https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/ec2-instance-metadata.html
         metadata_url = 'http://169.254.169.254/latest/meta-data/public-ipv4'
         headers = {'user-agent': 'clouddns/0.1'}
-        resp = requests.get(metadata_url, headers=headers)
-        if resp.status_code != requests.codes.ok:
+        token = BaseCloud._get_aws_imds_token(timeout)
+        if token:
+            headers['X-aws-ec2-metadata-token'] = token
+        resp = http.get(metadata_url, headers=headers, timeout=timeout, retries=METADATA_RETRIES)
+        if resp.status_code == 401 and token:
+            # Token was revoked or instance was stopped and started
+            token = BaseCloud._get_aws_imds_token(timeout, refresh=True)
+            if token:
+                headers['X-aws-ec2-metadata-token'] = token
+            else:
+                del headers['X-aws-ec2-metadata-token']
+            resp = http.get(metadata_url, headers=headers, timeout=timeout, retries=METADATA_RETRIES)
+        if not resp.ok:
             return None
 
         data = resp.content
@@ -59,12 +387,14 @@ class BaseCloud(object):
         return data
 
     @staticmethod
-    def get_current_ipv4_from_azure_vm_metadata():
+    def get_current_ipv4_from_azure_vm_metadata(timeout=DEFAULT_METADATA_TIMEOUT):
+        from . import http
+
         # https://docs.microsoft.com/en-us/azure/virtual-machines/windows/instance-metadata-service
         metadata_url = 'http://169.254.169.254/metadata/instance?api-version=2018-10-01'
         headers = {'user-agent': 'clouddns/0.1', 'Metadata': 'true'}
-        resp = requests.get(metadata_url, headers=headers)
-        if resp.status_code != requests.codes.ok:
+        resp = http.get(metadata_url, headers=headers, timeout=timeout, retries=METADATA_RETRIES)
+        if not resp.ok:
             return None
 
         # Extract data from JSON
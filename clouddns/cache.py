@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import contextlib
+import copy
+import fcntl
+import os
+import json
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def default_cache_dir():
+    """
+    Directory for cached data. Systemd sets $CACHE_DIRECTORY for units having CacheDirectory=.
+    :return: str, directory name
+    """
+    if os.environ.get('CACHE_DIRECTORY'):
+        return os.environ['CACHE_DIRECTORY'].split(':')[0]
+    if os.environ.get('XDG_CACHE_HOME'):
+        return os.environ['XDG_CACHE_HOME'] + "/cloud-dyndns"
+
+    return os.path.expanduser('~') + "/.cache/cloud-dyndns"
+
+
+def write_json_atomic(filename, data):
+    """
+    Write JSON into a file, which is rw- only for the current user.
+    Data is written into a temporary file first and renamed over the target. A reader never sees a partial file.
+    :param filename:
+    :param data:
+    :return:
+    """
+    import tempfile
+
+    directory = os.path.dirname(filename) or '.'
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with open(fd, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+class JsonFileCache(object):
+    """
+    Key-value store persisted into a JSON-file. Each entry has its storage time for expiry.
+    The file may be shared by many processes. Writes are done under a lock file, on top of the entries re-read
+    from the file, not to lose the entries written by others. Changes by others are seen on the next read.
+    Within batch() the file stays locked and all changes are written once, at the end of the batch.
+    """
+
+    def __init__(self, filename, ttl=None, durable=False):
+        """
+        :param filename: file to store the entries into
+        :param ttl: seconds an entry is valid, None for no expiry
+        :param durable: failing to write raises OSError. Otherwise the store is a cache, and a failure is only logged.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.durable = durable
+        self._lock = threading.Lock()
+        self._entries = None
+        # Identity of the file the entries were read from
+        self._file_id = None
+        # Nesting depth of batch(), changes are written when the outermost batch ends
+        self._batch_depth = 0
+        self._batch_changed = False
+        self._batch_lock = None
+
+    def get(self, key, max_age=None):
+        """
+        :param key:
+        :param max_age: seconds the entry is valid, overrides TTL of the cache
+        :return: stored value, None if not found or expired
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry:
+            return None
+        if max_age is not None and entry['stored'] + max_age < time.time():
+            log.debug("Cache entry {0} in {1} has expired".format(key, self.filename))
+            return None
+
+        return entry['value']
+
+    def put(self, key, value):
+        self.update({key: value})
+
+    def update(self, values):
+        """
+        Store multiple entries with a single write
+        :param values: dict of key-value pairs
+        :return:
+        """
+        def store(entries):
+            now = time.time()
+            for key, value in values.items():
+                entries[key] = {'stored': now, 'value': value}
+            return True
+
+        self._modify(store)
+
+    def modify(self, keys, change):
+        """
+        Read, change and store entries as one step, no other process can change them in between
+        :param keys: keys of the entries to change
+        :param change: function taking a dict of key: stored value, None if not found, returning a dict of
+        key: value to store. Values equal to the stored ones are not written.
+        :return:
+        """
+        def store(entries):
+            stored = {key: entries[key]['value'] if key in entries else None for key in keys}
+            # Changed in place by caller, compared with the stored ones afterwards
+            values = change(copy.deepcopy(stored))
+            values = {key: value for key, value in values.items()
+                      if key not in entries or value != entries[key]['value']}
+            now = time.time()
+            for key, value in values.items():
+                entries[key] = {'stored': now, 'value': value}
+            return bool(values)
+
+        self._modify(store)
+
+    def keys(self):
+        """
+        :return: list of keys stored, expired ones included
+        """
+        with self._lock:
+            return list(self._load())
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Write all changes made within the block with a single write at its end. The file stays locked
+        for the whole block, other processes wait to write until then. Batches can be nested.
+        :return:
+        """
+        with self._lock:
+            if not self._batch_depth:
+                lock = contextlib.ExitStack()
+                try:
+                    lock.enter_context(self._file_lock())
+                except OSError as exc:
+                    self._write_failed(exc)
+                    lock = None
+                self._batch_lock = lock
+                self._batch_changed = False
+            self._batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if not self._batch_depth and self._batch_lock:
+                    with self._batch_lock:
+                        try:
+                            if self._batch_changed:
+                                self._write(self._load())
+                        except OSError as exc:
+                            self._write_failed(exc)
+                    self._batch_lock = None
+
+    def invalidate(self, key):
+        def remove(entries):
+            return entries.pop(key, None) is not None
+
+        self._modify(remove)
+
+    def _modify(self, change):
+        """
+        Change the entries in file. Other processes are locked out from re-reading the file until it is written.
+        :param change: function changing the dict of entries in place, returning True if there was a change
+        :return:
+        """
+        with self._lock:
+            if self._batch_lock:
+                # File is locked by the batch, and written when it ends
+                if change(self._load()):
+                    self._batch_changed = True
+                return
+            try:
+                with self._file_lock():
+                    entries = self._load()
+                    if change(entries):
+                        self._write(entries)
+            except OSError as exc:
+                self._write_failed(exc)
+
+    def _write(self, entries):
+        write_json_atomic(self.filename, entries)
+        self._file_id = self._stat()
+
+    def _write_failed(self, exc):
+        if self.durable:
+            # Whatever is in memory, the file didn't get it
+            self._entries = None
+            raise exc
+        # A cache is an optimization, failing to write one is not fatal.
+        log.warning("Failed to write cache file {0}: {1}".format(self.filename, exc))
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self.filename) or '.', mode=0o700, exist_ok=True)
+        fd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing releases the lock
+            os.close(fd)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+
+        # A write replaces the file, giving it a new inode
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        file_id = self._stat()
+        if self._entries is not None and file_id == self._file_id:
+            return self._entries
+
+        self._entries = {}
+        self._file_id = file_id
+        if file_id is not None:
+            try:
+                with open(self.filename, 'rt', encoding='utf8') as fp:
+                    self._entries = json.load(fp)
+            except (OSError, ValueError) as exc:
+                log.warning("Ignoring unreadable cache file {0}: {1}".format(self.filename, exc))
+
+        return self._entries
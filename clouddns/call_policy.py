@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds a run may spend on provider API calls, retries included. 0 for no deadline.
+DEFAULT_DEADLINE = 300
+
+# Retries of a failed API call
+DEFAULT_API_RETRIES = 3
+
+# Seconds to wait for a single API request
+DEFAULT_API_TIMEOUT = 30
+
+# Consecutive failed calls to open the circuit, and seconds until a call is tried again
+DEFAULT_CIRCUIT_FAILURES = 5
+DEFAULT_CIRCUIT_RESET = 60
+
+# Kinds of transient errors
+# Provider refused the request without processing it, any request can be retried
+THROTTLED = 'throttled'
+# Provider failed or didn't answer, request may have been processed. Only idempotent requests can be retried.
+UNAVAILABLE = 'unavailable'
+
+# Circuit breakers by provider name, shared by all instances
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+class CircuitOpen(RuntimeError):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while provider API is down. After a number of consecutive failures the circuit opens,
+    and calls fail without making requests. Once reset time has passed, a single call is let through
+    to see if the API is back.
+    """
+
+    def __init__(self, name, failures=DEFAULT_CIRCUIT_FAILURES, reset=DEFAULT_CIRCUIT_RESET):
+        """
+        :param name: name of the provider
+        :param failures: consecutive failures to open the circuit. 0 to never open.
+        :param reset: seconds the circuit stays open
+        """
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: float, 0 if a call can be made. Otherwise seconds until circuit will let a call through.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            wait = self.opened_at + self.reset - time.monotonic()
+            if wait > 0 or self.trial_running:
+                return max(wait, 1.0)
+            self.trial_running = True
+
+            return 0
+
+    def succeeded(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info("Circuit of {0} closed, API is responding again".format(self.name))
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.trial_running = False
+            if self.failures and self.consecutive_failures >= self.failures:
+                if self.opened_at is None:
+                    log.warning("Circuit of {0} opened after {1} failures".format(
+                        self.name, self.consecutive_failures))
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """
+        End a call let through by allow(), whatever the outcome. Circuit stays as it is.
+        :return:
+        """
+        with self.lock:
+            self.trial_running = False
+
+
+def get_circuit_breaker(name, failures=DEFAULT_CIRCUIT_FAILURES, reset=DEFAULT_CIRCUIT_RESET):
+    """
+    :return: CircuitBreaker of the provider, shared within the process
+    """
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(name, failures, reset)
+        breaker = _circuit_breakers[name]
+        breaker.failures = failures
+        breaker.reset = reset
+
+    return breaker
+
+
+class CallPolicy(object):
+    """
+    Deadline, retries and circuit breaker for provider API calls
+    """
+
+    def __init__(self, name, deadline=DEFAULT_DEADLINE, retries=DEFAULT_API_RETRIES, timeout=DEFAULT_API_TIMEOUT,
+                 circuit_failures=DEFAULT_CIRCUIT_FAILURES, circuit_reset=DEFAULT_CIRCUIT_RESET):
+        """
+        :param name: name of the provider
+        :param deadline: seconds a run may spend on API calls. 0 for no deadline.
+        :param retries: retries of a failed call
+        :param timeout: seconds to wait for a single request
+        :param circuit_failures: consecutive failures to open the circuit. 0 to never open.
+        :param circuit_reset: seconds the circuit stays open
+        """
+        self.name = name
+        self.deadline = deadline
+        self.retries = retries
+        self.timeout = timeout
+        self.circuit_breaker = get_circuit_breaker(name, circuit_failures, circuit_reset)
+        self.deadline_at = None
+        self.start()
+
+    def start(self):
+        """
+        Start a new run, deadline counts from now. Long-running modes call this for every update.
+        :return:
+        """
+        self.deadline_at = time.monotonic() + self.deadline if self.deadline else None
+
+    def remaining(self):
+        """
+        :return: float, seconds left until deadline. None if there is no deadline.
+        """
+        if self.deadline_at is None:
+            return None
+
+        return self.deadline_at - time.monotonic()
+
+    def request_timeout(self):
+        """
+        :return: float, seconds a request can wait for response without passing the deadline
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return self.timeout
+
+        return max(1.0, min(self.timeout, remaining))
+
+    def call(self, func, args=(), kwargs=None, idempotent=True, classify=None):
+        """
+        Make an API call. Transient failures are retried with backoff, honoring the wait provider asks for.
+        A request, which may have been processed, is retried only if it is idempotent.
+        :param func: function making the call
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        :param idempotent: bool, repeating the call has the same effect as doing it once
+        :param classify: function taking an exception, returning tuple of THROTTLED, UNAVAILABLE or None for
+        permanent errors, and seconds provider asked to wait or None
+        :return: whatever the function returns
+        """
+        from .http import backoff_delay, parse_retry_after
+
+        attempt = 0
+        while True:
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded("Deadline of {0} seconds for {1} API calls exceeded".format(
+                    self.deadline, self.name))
+            circuit_wait = self.circuit_breaker.allow()
+            if circuit_wait:
+                raise CircuitOpen("{0} API is failing, not trying again for {1:.0f} seconds".format(
+                    self.name, circuit_wait))
+
+            try:
+                result = func(*args, **(kwargs or {}))
+            except Exception as exc:
+                kind, retry_after = classify(exc) if classify else (None, None)
+                if kind == UNAVAILABLE:
+                    self.circuit_breaker.failed()
+                else:
+                    # API answered, it's up. Throttling refuses the request, it doesn't fail it.
+                    self.circuit_breaker.succeeded()
+                if kind is None or (kind == UNAVAILABLE and not idempotent) or attempt >= self.retries:
+                    raise
+
+                # Provider knows best when it's ready again, Retry-After is honored in full
+                retry_after = parse_retry_after(retry_after)
+                delay = backoff_delay(attempt) if retry_after is None else retry_after
+                remaining = self.remaining()
+                if remaining is not None and delay >= remaining:
+                    if retry_after is not None:
+                        raise DeadlineExceeded("{0} API asked to wait {1:.0f} seconds, only {2:.0f} seconds left "
+                                               "of the deadline: {3}".format(self.name, delay, remaining, exc)) from exc
+                    log.debug("No time left to retry {0} API call: {1}".format(self.name, exc))
+                    raise
+                log.info("{0} API call failed: {1}. Retrying in {2:.2f} s".format(self.name, exc, delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            else:
+                self.circuit_breaker.succeeded()
+            finally:
+                # No way out of a trial call may leave the circuit waiting for it
+                self.circuit_breaker.release()
+
+            return result
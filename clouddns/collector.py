@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import hmac
+import ipaddress
+import json
+import os.path
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for more reports before applying the pending ones
+DEFAULT_DEBOUNCE = 5.0
+
+# Seconds a report may wait at most, even if new reports keep arriving
+MAX_DEBOUNCE_WAIT = 60.0
+
+# Seconds to wait before retrying failed updates
+RETRY_DELAY = 60.0
+
+# Largest accepted report, in bytes
+MAX_REPORT_SIZE = 4096
+
+# Seconds a client may take for the TLS handshake and for sending its report
+REQUEST_TIMEOUT = 10
+
+REPORT_PATH = '/report'
+RECORD_TYPES = {'A': ipaddress.IPv4Address, 'AAAA': ipaddress.IPv6Address}
+
+
+def read_tokens_file(tokens_file):
+    """
+    Read per-host tokens
+    :param tokens_file: JSON-file with an object of FQDN: token
+    :return: dict, FQDN: token
+    """
+    if not os.path.isfile(tokens_file):
+        log.error("Collector tokens file {0} doesn't exist!".format(tokens_file))
+        raise RuntimeError("Collector tokens file {0} doesn't exist!".format(tokens_file))
+
+    with open(tokens_file, 'rt', encoding='utf8') as fp:
+        tokens = json.load(fp)
+    log.debug("Loaded {0} host tokens from {1}".format(len(tokens), tokens_file))
+
+    return {fqdn.lower(): token for fqdn, token in tokens.items()}
+
+
+def parse_report(body):
+    """
+    Validate a report sent by a host
+    :param body: request body, JSON: {"hostname": FQDN, "addresses": {record type: IP-address}}
+    :return: tuple, FQDN and dict of record type: IP-address
+    """
+    report = json.loads(body)
+    fqdn = report['hostname'].lower()
+    addresses = report['addresses']
+    if not isinstance(addresses, dict) or not addresses:
+        raise ValueError("No addresses in report of {0}".format(fqdn))
+    for record_type, ip in addresses.items():
+        if record_type not in RECORD_TYPES:
+            raise ValueError("Unknown record type {0}".format(record_type))
+        # Anything else than an address of the record type is refused
+        RECORD_TYPES[record_type](ip)
+
+    return fqdn, addresses
+
+
+class ReportQueue(object):
+    """
+    Pending reports. A newer report of a host replaces the older one.
+    Reports are released in a batch once there has been no new reports for the debounce period.
+    """
+
+    def __init__(self, debounce=DEFAULT_DEBOUNCE, max_wait=MAX_DEBOUNCE_WAIT):
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.pending = {}
+        self.first_report = None
+        self.last_report = None
+        self.condition = threading.Condition()
+
+    def put(self, fqdn, addresses):
+        with self.condition:
+            self.pending[fqdn] = addresses
+            now = time.monotonic()
+            if self.first_report is None:
+                self.first_report = now
+            self.last_report = now
+            self.condition.notify()
+
+    def requeue(self, hosts):
+        """
+        Put back hosts, which failed to update. Reports received meanwhile take precedence.
+        :param hosts: list of (FQDN, dict of record type: IP-address)
+        :return:
+        """
+        with self.condition:
+            if not self.pending:
+                # Nothing new arrived, delay the retry
+                retry_at = time.monotonic() + RETRY_DELAY
+                self.first_report = retry_at - self.max_wait
+                self.last_report = retry_at - self.debounce
+            for fqdn, addresses in hosts:
+                self.pending.setdefault(fqdn, addresses)
+            self.condition.notify()
+
+    def _due_in(self):
+        # Seconds until pending reports are due, None if nothing is pending
+        if not self.pending:
+            return None
+
+        return max(0.0, min(self.last_report + self.debounce, self.first_report + self.max_wait) - time.monotonic())
+
+    def get_batch(self, timeout=None):
+        """
+        Wait for a batch of reports to become due
+        :param timeout: seconds to wait, None to wait forever
+        :return: list of (FQDN, dict of record type: IP-address), empty on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                due_in = self._due_in()
+                if due_in == 0:
+                    break
+                wait = due_in
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+
+            batch = sorted(self.pending.items())
+            self.pending = {}
+            self.first_report = self.last_report = None
+
+        return batch
+
+
+class CollectorRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'clouddns-collector/0.1'
+    timeout = REQUEST_TIMEOUT
+
+    def handle(self):
+        if self.server.tls:
+            # Handshake is done here, in the thread of the request. A slow client doesn't stall accepting others.
+            try:
+                self.request.do_handshake()
+            except OSError as exc:
+                log.debug("TLS handshake with {0} failed: {1}".format(self.client_address[0], exc))
+                return
+        super().handle()
+
+    def do_POST(self):
+        if self.path != REPORT_PATH:
+            self._respond(404, "Not found")
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        if not 0 < length <= MAX_REPORT_SIZE:
+            self._respond(400, "Invalid report size")
+            return
+        try:
+            fqdn, addresses = parse_report(self.rfile.read(length))
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            self._respond(400, "Invalid report: {0}".format(exc))
+            return
+
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer '):
+            self._respond(401, "Token missing")
+            return
+        host_token = self.server.tokens.get(fqdn)
+        if not host_token or not hmac.compare_digest(host_token.encode('utf8'),
+                                                     authorization[len('Bearer '):].encode('utf8')):
+            log.warning("Refused report of {0} from {1}".format(fqdn, self.client_address[0]))
+            self._respond(403, "Not allowed")
+            return
+
+        log.info("Report of {0} from {1}: {2}".format(fqdn, self.client_address[0], addresses))
+        self.server.queue.put(fqdn, addresses)
+        self._respond(202, "Accepted")
+
+    def _respond(self, status, message):
+        body = json.dumps({'message': message}).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("{0} {1}".format(self.client_address[0], format % args))
+
+
+class Collector(object):
+    """
+    HTTP-service receiving address reports of hosts.
+    Reports are debounced and applied in batches, hosts of a zone being updated together.
+    Only the collector needs Cloud provider credentials.
+    """
+
+    def __init__(self, listen_address, tokens, apply_batch, debounce=DEFAULT_DEBOUNCE, tls_cert=None, tls_key=None):
+        """
+        :param listen_address: tuple, address and port to listen on
+        :param tokens: dict, FQDN: token the host authenticates with
+        :param apply_batch: function taking a list of (FQDN, dict of record type: IP-address),
+        returning list of FQDNs failed to update
+        :param debounce: seconds to wait for more reports before applying
+        :param tls_cert: PEM-file of the certificate to serve HTTPS with, None for plain HTTP
+        :param tls_key: PEM-file of the private key of the certificate, None if it is in the certificate file
+        """
+        self.queue = ReportQueue(debounce)
+        self.apply_batch = apply_batch
+        self.server = ThreadingHTTPServer(listen_address, CollectorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.tls = bool(tls_cert)
+        if tls_cert:
+            import ssl
+
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(tls_cert, tls_key)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True,
+                                                     do_handshake_on_connect=False)
+        self.server.tokens = tokens
+        self.server.queue = self.queue
+        self.stopping = threading.Event()
+
+    @property
+    def server_address(self):
+        return self.server.server_address
+
+    def serve_forever(self):
+        """
+        Serve reports until stop() is called
+        :return:
+        """
+        server_thread = threading.Thread(target=self.server.serve_forever, name='collector-http', daemon=True)
+        server_thread.start()
+        log.info("Collecting address reports at {0}:{1}".format(*self.server_address[:2]))
+        try:
+            while not self.stopping.is_set():
+                self.apply_due(timeout=1.0)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def apply_due(self, timeout=None):
+        """
+        Apply a batch of reports once it is due
+        :param timeout: seconds to wait for a batch
+        :return: int, number of hosts in the batch
+        """
+        batch = self.queue.get_batch(timeout)
+        if not batch:
+            return 0
+
+        log.info("Applying reports of {0} hosts".format(len(batch)))
+        try:
+            failed = set(self.apply_batch(batch))
+        except Exception as exc:
+            log.error("Failed to apply reports: {0}".format(exc))
+            failed = {fqdn for fqdn, _ in batch}
+        if failed:
+            self.queue.requeue([(fqdn, addresses) for fqdn, addresses in batch if fqdn in failed])
+
+        return len(batch)
+
+    def stop(self):
+        self.stopping.set()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import math
+import threading
+import time
+from .cache import JsonFileCache
+from .state import default_state_dir
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds a new address needs to stay before it is written. 0 to write immediately.
+DEFAULT_HOLD_DOWN = 0
+
+# Flap damping, as in BGP route flap damping: every address change adds a penalty, which decays
+# exponentially. Updates of a record are suppressed once penalty reaches SUPPRESS_LIMIT, and allowed
+# again only after it has decayed below REUSE_LIMIT.
+DEFAULT_FLAP_HALF_LIFE = 900
+FLAP_PENALTY = 1000.0
+SUPPRESS_LIMIT = 2000.0
+REUSE_LIMIT = 750.0
+
+# Writes per hour allowed for a record and for a zone, and the bursts allowed on top
+DEFAULT_RECORD_UPDATE_RATE = 12
+DEFAULT_ZONE_UPDATE_RATE = 120
+RECORD_BURST = 3
+ZONE_BURST = 30
+
+
+class UpdateDamper(object):
+    """
+    Damp and rate limit DNS updates of flapping addresses.
+    State is persisted, damping works the same for a daemon and for separate oneshot runs.
+    """
+
+    def __init__(self, state_file=None, hold_down=DEFAULT_HOLD_DOWN, flap_half_life=DEFAULT_FLAP_HALF_LIFE,
+                 record_update_rate=DEFAULT_RECORD_UPDATE_RATE, zone_update_rate=DEFAULT_ZONE_UPDATE_RATE):
+        """
+        :param state_file: file to persist damping state in
+        :param hold_down: seconds a new address needs to stay unchanged before it is written
+        :param flap_half_life: seconds for flap penalty to decay by half. 0 to disable flap damping.
+        :param record_update_rate: writes per hour allowed for a record. 0 for no limit.
+        :param zone_update_rate: writes per hour allowed for a zone. 0 for no limit.
+        """
+        if not state_file:
+            state_file = default_state_dir() + "/damping.json"
+        self.store = JsonFileCache(state_file)
+        self.hold_down = hold_down
+        self.flap_half_life = flap_half_life
+        self.record_update_rate = record_update_rate
+        self.zone_update_rate = zone_update_rate
+        self.lock = threading.Lock()
+        # Time the deferred update can be retried, by record
+        self.deferred = {}
+
+    def filter(self, provider_name, host, domain, addresses, changes):
+        """
+        Observe the addresses of a host and decide which of the needed changes can be written now
+        :param provider_name: name of the cloud provider
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param addresses: dict, record type: IP-address the host has now
+        :param changes: list of tuples: record type, IP-address, existing record object or None
+        :return: tuple, list of changes allowed to be written and list of (record type, IP-address, reason)
+        for the deferred ones
+        """
+        now = time.time()
+        to_change = {record_type for record_type, _, _ in changes}
+        allowed = []
+        deferred = []
+        zone_key = "{0}/{1}".format(provider_name, domain)
+        record_keys = {record_type: "{0}/{1}/{2}/{3}".format(provider_name, domain, host, record_type)
+                       for record_type in addresses}
+
+        def decide(stored):
+            # Other processes sharing the state file are locked out until the decision is stored
+            zone = stored[zone_key] or {}
+            updated = {}
+            for record_type, ip in addresses.items():
+                record_key = record_keys[record_type]
+                record = self._observe(stored[record_key] or {}, ip, now)
+                updated[record_key] = record
+                if record_type not in to_change:
+                    # DNS has the address already, any pending candidate is void
+                    record.pop('candidate_since', None)
+                    self.deferred.pop(record_key, None)
+                    continue
+
+                retry_in, reason = self._decide(record, zone, now)
+                if retry_in:
+                    log.info("Deferred update of {0}-record of {1}.{2} to {3}: {4}".format(
+                        record_type, host, domain, ip, reason))
+                    self.deferred[record_key] = now + retry_in
+                    deferred.append((record_type, ip, reason))
+                    continue
+
+                self.deferred.pop(record_key, None)
+                self._take_token(record, self.record_update_rate, RECORD_BURST, now)
+                self._take_token(zone, self.zone_update_rate, ZONE_BURST, now)
+                allowed.extend(change for change in changes if change[0] == record_type)
+            updated[zone_key] = zone
+
+            return updated
+
+        with self.lock:
+            self.store.modify([zone_key] + list(record_keys.values()), decide)
+
+        return allowed, deferred
+
+    def batch(self):
+        """
+        :return: context manager, the decisions made within it are written into the state file at once
+        """
+        return self.store.batch()
+
+    def next_retry(self):
+        """
+        Deferred updates already due are forgotten. They have been retried since, or the host hasn't needed them.
+        :return: float, seconds until the earliest deferred update can be retried. None if nothing is deferred.
+        """
+        now = time.time()
+        with self.lock:
+            self.deferred = {record_key: retry_at for record_key, retry_at in self.deferred.items() if retry_at > now}
+
+            return min(self.deferred.values()) - now if self.deferred else None
+
+    def is_deferred(self, provider_name, host, domain):
+        """
+        :return: bool, True if any record of the host has a deferred update
+        """
+        prefix = "{0}/{1}/{2}/".format(provider_name, domain, host)
+        with self.lock:
+            return any(record_key.startswith(prefix) for record_key in self.deferred)
+
+    def retry_at(self, provider_name, host, domain):
+        """
+        :return: float, time the earliest deferred update of the host can be retried. None if nothing is deferred.
+        """
+        prefix = "{0}/{1}/{2}/".format(provider_name, domain, host)
+        now = time.time()
+        with self.lock:
+            retry_ats = [retry_at for record_key, retry_at in self.deferred.items()
+                         if record_key.startswith(prefix) and retry_at > now]
+
+        return min(retry_ats) if retry_ats else None
+
+    def _observe(self, record, ip, now):
+        """
+        Track the address seen, accumulating flap penalty on every change
+        """
+        if record.get('ip') == ip:
+            return record
+
+        if record.get('ip') and self.flap_half_life:
+            record['penalty'] = self._penalty(record, now) + FLAP_PENALTY
+            record['penalty_at'] = now
+        record['ip'] = ip
+        record['candidate_since'] = now
+
+        return record
+
+    def _decide(self, record, zone, now):
+        """
+        :return: tuple, seconds to wait before the update can be written (0 to write it now) and the reason
+        """
+        penalty = self._penalty(record, now)
+        if record.get('suppressed') and penalty < REUSE_LIMIT:
+            record['suppressed'] = False
+        elif not record.get('suppressed') and penalty >= SUPPRESS_LIMIT:
+            record['suppressed'] = True
+        if record.get('suppressed'):
+            # Whole seconds, the penalty has decayed below the limit by then, not to it
+            reuse_in = max(1.0, math.ceil(self.flap_half_life * math.log2(penalty / REUSE_LIMIT)))
+            return reuse_in, "suppressed as flapping, retrying in {0:.0f} seconds".format(reuse_in)
+
+        # No candidate: address was seen already before the previous write
+        stable_for = now - record['candidate_since'] if 'candidate_since' in record else self.hold_down
+        if stable_for < self.hold_down:
+            return self.hold_down - stable_for, "in hold-down for {0:.0f} seconds".format(self.hold_down - stable_for)
+
+        for bucket, rate, burst, what in ((record, self.record_update_rate, RECORD_BURST, 'record'),
+                                          (zone, self.zone_update_rate, ZONE_BURST, 'zone')):
+            refill_in = self._token_wait(bucket, rate, burst, now)
+            if refill_in:
+                return refill_in, "{0} update rate exceeded, retrying in {1:.0f} seconds".format(what, refill_in)
+
+        return 0, None
+
+    def _penalty(self, record, now):
+        if not self.flap_half_life or not record.get('penalty'):
+            return 0.0
+
+        return record['penalty'] * 0.5 ** ((now - record['penalty_at']) / self.flap_half_life)
+
+    @staticmethod
+    def _tokens(bucket, rate, burst, now):
+        # Full bucket on first use
+        if 'tokens' not in bucket:
+            return float(burst)
+
+        return min(float(burst), bucket['tokens'] + (now - bucket['tokens_at']) * rate / 3600.0)
+
+    def _token_wait(self, bucket, rate, burst, now):
+        """
+        :return: float, seconds until bucket has a token. 0 if it has one now.
+        """
+        if not rate:
+            return 0
+
+        tokens = self._tokens(bucket, rate, burst, now)
+        if tokens >= 1:
+            return 0
+
+        return (1 - tokens) * 3600.0 / rate
+
+    def _take_token(self, bucket, rate, burst, now):
+        if not rate:
+            return
+
+        bucket['tokens'] = self._tokens(bucket, rate, burst, now) - 1
+        bucket['tokens_at'] = now
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import ipaddress
+import os
+import selectors
+import socket
+import struct
+import time
+from .cache import JsonFileCache, default_cache_dir
+import logging
+
+log = logging.getLogger(__name__)
+
+DNS_PORT = 53
+
+# Seconds to wait for the nameservers to answer
+DEFAULT_TIMEOUT = 1.0
+
+# Seconds the nameservers of a zone are trusted without asking them again
+NAMESERVER_CACHE_TTL = 86400
+
+# Seconds to wait for an update to propagate into all nameservers
+DEFAULT_PROPAGATION_TIMEOUT = 120
+
+# Seconds between polls of the nameservers not serving an update yet
+PROPAGATION_POLL_INTERVAL = 1.0
+
+RESOLV_CONF = '/etc/resolv.conf'
+
+QTYPES = {'A': 1, 'NS': 2, 'AAAA': 28}
+QCLASS_IN = 1
+
+# Header flags
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+RCODE_MASK = 0x000f
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+
+def build_query(query_id, name, record_type, recursion_desired=False):
+    """
+    :param query_id: 16-bit ID to match the response with
+    :param name: domain name to ask for
+    :param record_type: A, AAAA or NS
+    :param recursion_desired: ask a recursive resolver, not an authoritative server
+    :return: bytes, DNS query message
+    """
+    header = struct.pack('!HHHHHH', query_id, FLAG_RD if recursion_desired else 0, 1, 0, 0, 0)
+    question = b''.join(struct.pack('!B', len(label)) + label
+                        for label in name.rstrip('.').encode('idna').split(b'.') if label)
+
+    return header + question + b'\0' + struct.pack('!HH', QTYPES[record_type], QCLASS_IN)
+
+
+def _read_name(message, offset):
+    """
+    Read a possibly compressed domain name
+    :return: tuple, name and offset after it
+    """
+    labels = []
+    end_offset = None
+    for _ in range(128):
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            # Pointer to a name earlier in the message
+            if end_offset is None:
+                end_offset = offset + 2
+            offset = struct.unpack_from('!H', message, offset)[0] & 0x3fff
+            continue
+        if not length:
+            return '.'.join(labels).lower(), end_offset if end_offset is not None else offset + 1
+        labels.append(message[offset + 1:offset + 1 + length].decode('ascii', 'replace'))
+        offset += 1 + length
+
+    raise ValueError("Too many labels in a name")
+
+
+def parse_response(message):
+    """
+    :param message: bytes, DNS response message
+    :return: tuple, query ID, header flags and list of answer records: (name, record type, TTL, value).
+    Values of A and AAAA are addresses, values of NS are names. Other record types are left out.
+    """
+    query_id, flags, question_count, answer_count, _, _ = struct.unpack_from('!HHHHHH', message)
+    offset = 12
+    for _ in range(question_count):
+        _, offset = _read_name(message, offset)
+        offset += 4
+
+    record_types = {qtype: record_type for record_type, qtype in QTYPES.items()}
+    answers = []
+    for _ in range(answer_count):
+        name, offset = _read_name(message, offset)
+        qtype, _, ttl, length = struct.unpack_from('!HHIH', message, offset)
+        offset += 10
+        record_type = record_types.get(qtype)
+        if record_type == 'A' and length == 4:
+            answers.append((name, record_type, ttl, str(ipaddress.IPv4Address(message[offset:offset + 4]))))
+        elif record_type == 'AAAA' and length == 16:
+            answers.append((name, record_type, ttl, str(ipaddress.IPv6Address(message[offset:offset + 16]))))
+        elif record_type == 'NS':
+            answers.append((name, record_type, ttl, _read_name(message, offset)[0]))
+        offset += length
+
+    return query_id, flags, answers
+
+
+def query_servers(servers, name, record_type, timeout=DEFAULT_TIMEOUT, recursion_desired=False):
+    """
+    Send the same query to many servers at once and collect the answers until all have answered,
+    or the time is up
+    :param servers: list of (IP-address, port)
+    :param name: domain name to ask for
+    :param record_type: A, AAAA or NS
+    :param timeout: seconds to wait for the answers
+    :param recursion_desired: ask recursive resolvers, not authoritative servers
+    :return: dict, (IP-address, port): set of values in answer. Servers not answering are left out.
+    """
+    name = name.rstrip('.').lower()
+    selector = selectors.DefaultSelector()
+    answers = {}
+    try:
+        for server in servers:
+            family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            query_id = struct.unpack('!H', os.urandom(2))[0]
+            try:
+                sock.setblocking(False)
+                sock.sendto(build_query(query_id, name, record_type, recursion_desired), tuple(server))
+            except OSError as exc:
+                log.debug("Failed to query nameserver {0}: {1}".format(server[0], exc))
+                sock.close()
+                continue
+            selector.register(sock, selectors.EVENT_READ, (tuple(server), query_id))
+
+        deadline = time.monotonic() + timeout
+        while selector.get_map() and time.monotonic() < deadline:
+            for key, _ in selector.select(deadline - time.monotonic()):
+                server, query_id = key.data
+                try:
+                    message, _ = key.fileobj.recvfrom(4096)
+                except OSError as exc:
+                    # Like port unreachable, no answer is coming
+                    log.debug("Failed to query nameserver {0}: {1}".format(server[0], exc))
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                try:
+                    response_id, flags, records = parse_response(message)
+                except (ValueError, struct.error, IndexError) as exc:
+                    log.debug("Bad answer from nameserver {0}: {1}".format(server[0], exc))
+                    continue
+                if response_id != query_id or not flags & FLAG_QR:
+                    # Not an answer to our query, keep waiting
+                    continue
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                rcode = flags & RCODE_MASK
+                if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN) or flags & FLAG_TC or \
+                        (not recursion_desired and not flags & FLAG_AA):
+                    log.debug("Unusable answer from nameserver {0}, flags {1:#06x}".format(server[0], flags))
+                    continue
+                answers[server] = {value for record_name, answer_type, _, value in records
+                                   if record_name == name and answer_type == record_type}
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+    return answers
+
+
+def parse_server(server, default_port=DNS_PORT):
+    """
+    :param server: IP-address with optional port: 192.0.2.53, 192.0.2.53:5353, 2001:db8::53 or [2001:db8::53]:5353
+    :param default_port: port, if none is given
+    :return: tuple, IP-address and port
+    :raises ValueError: not an IP-address
+    """
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']')
+        port = port.lstrip(':')
+    elif server.count(':') == 1:
+        host, _, port = server.partition(':')
+    else:
+        host, port = server, ''
+
+    return str(ipaddress.ip_address(host)), int(port) if port else default_port
+
+
+def format_server(server):
+    """
+    :param server: tuple, IP-address and port
+    :return: str, IP-address, with the port only if it isn't the DNS port. Reverse of parse_server().
+    """
+    address, port = server
+    if port == DNS_PORT:
+        return address
+
+    return "[{0}]:{1}".format(address, port) if ':' in address else "{0}:{1}".format(address, port)
+
+
+def read_resolvers(resolv_conf=RESOLV_CONF):
+    """
+    :return: list of (IP-address, port) of the recursive resolvers of this host
+    """
+    resolvers = []
+    try:
+        with open(resolv_conf, 'rt') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    # Zone index of a link-local address is not needed
+                    resolvers.append((fields[1].split('%')[0], DNS_PORT))
+    except OSError as exc:
+        log.debug("Cannot read resolvers from {0}: {1}".format(resolv_conf, exc))
+
+    return resolvers or [('127.0.0.1', DNS_PORT)]
+
+
+class AuthoritativeResolver(object):
+    """
+    Ask the authoritative nameservers of a zone directly, no caches of recursive resolvers in between.
+    Nameservers of a zone are discovered once and cached.
+    """
+
+    def __init__(self, servers=None, resolvers=None, timeout=DEFAULT_TIMEOUT, port=DNS_PORT, cache_file=None):
+        """
+        :param servers: list of (IP-address, port) to ask instead of discovering the nameservers
+        :param resolvers: list of (IP-address, port) of recursive resolvers for discovery. Default: resolv.conf
+        :param timeout: seconds to wait for the answers
+        :param port: port of the discovered nameservers
+        :param cache_file: file to cache the nameservers of zones into
+        """
+        self.servers = servers
+        self.resolvers = resolvers
+        self.timeout = timeout
+        self.port = port
+        if not cache_file:
+            cache_file = default_cache_dir() + "/nameservers.json"
+        self.cache = JsonFileCache(cache_file, ttl=NAMESERVER_CACHE_TTL)
+
+    def nameservers(self, zone):
+        """
+        :param zone: name of the DNS zone
+        :return: list of (IP-address, port) of the authoritative nameservers of the zone
+        """
+        if self.servers:
+            return self.servers
+
+        cached = self.cache.get(zone.lower())
+        if cached:
+            return [tuple(server) for server in cached]
+
+        # Any resolver answering will do
+        names = set()
+        for ns_names in query_servers(self.resolvers or read_resolvers(), zone, 'NS', self.timeout,
+                                      recursion_desired=True).values():
+            names |= ns_names
+        servers = []
+        for ns_name in sorted(names):
+            try:
+                for _, _, _, _, address in socket.getaddrinfo(ns_name, self.port, type=socket.SOCK_DGRAM):
+                    if (address[0], self.port) not in servers:
+                        servers.append((address[0], self.port))
+            except OSError as exc:
+                log.debug("Cannot resolve nameserver {0} of {1}: {2}".format(ns_name, zone, exc))
+        if not servers:
+            log.warning("No nameservers found for zone {0}".format(zone))
+            return []
+
+        log.debug("Nameservers of {0}: {1}".format(zone, ', '.join(address for address, _ in servers)))
+        self.cache.put(zone.lower(), servers)
+
+        return servers
+
+    def query(self, zone, fqdn, record_type):
+        """
+        Ask all the nameservers of the zone at once
+        :param zone: name of the DNS zone
+        :param fqdn: name to ask for
+        :param record_type: A or AAAA
+        :return: dict, (IP-address, port) of nameserver: set of addresses answered
+        """
+        return query_servers(self.nameservers(zone), fqdn, record_type, self.timeout)
+
+    def has_addresses(self, zone, fqdn, addresses):
+        """
+        See if the nameservers answer with the given addresses. Each of the nameservers must answer,
+        and have the address and nothing else, for all of the record types.
+        :param zone: name of the DNS zone
+        :param fqdn: name to ask for
+        :param addresses: dict, record type: IP-address
+        :return: bool, False also when it isn't known: a nameserver not answering may serve anything
+        """
+        for record_type, ip in addresses.items():
+            answers = self.query(zone, fqdn, record_type)
+            if not answers:
+                if not self.servers:
+                    # Nameservers of the zone may have changed since they were cached
+                    self.cache.invalidate(zone.lower())
+                return False
+            silent = [server for server in map(tuple, self.nameservers(zone)) if server not in answers]
+            if silent:
+                log.debug("Nameservers {0} didn't answer for {1}, its {2}-record is not known".format(
+                    ', '.join(format_server(server) for server in silent), fqdn, record_type))
+                return False
+            for server, answered in answers.items():
+                if answered != {str(ipaddress.ip_address(ip))}:
+                    log.debug("Nameserver {0} has {1}-record {2} for {3}".format(
+                        server[0], record_type, ', '.join(sorted(answered)) or 'missing', fqdn))
+                    return False
+
+        return True
+
+    def wait_for_addresses(self, zone, fqdn, addresses, timeout=DEFAULT_PROPAGATION_TIMEOUT,
+                           interval=PROPAGATION_POLL_INTERVAL):
+        """
+        Poll all the nameservers of the zone at once, until each of them answers with the addresses
+        for all of the record types, or the time is up. Nameservers having the addresses are not asked again.
+        :param zone: name of the DNS zone
+        :param fqdn: name to ask for
+        :param addresses: dict, record type: IP-address
+        :param timeout: seconds to wait for the nameservers
+        :param interval: seconds between polls
+        :return: dict, (IP-address, port) of nameserver: seconds it took to answer with the addresses,
+        None if it didn't by the timeout. Empty, if the zone has no known nameservers.
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        addresses = {record_type: str(ipaddress.ip_address(ip)) for record_type, ip in addresses.items()}
+        # Nameserver: record types it doesn't serve yet
+        pending = {server: set(addresses) for server in self.nameservers(zone)}
+        consistent = {}
+        while pending:
+            for record_type, ip in addresses.items():
+                servers = [server for server, record_types in pending.items() if record_type in record_types]
+                if not servers:
+                    continue
+                answers = query_servers(servers, fqdn, record_type,
+                                        max(0.0, min(self.timeout, deadline - time.monotonic())))
+                for server, answered in answers.items():
+                    if answered == {ip}:
+                        pending[server].discard(record_type)
+
+            now = time.monotonic()
+            for server in [server for server, record_types in pending.items() if not record_types]:
+                consistent[server] = now - started
+                del pending[server]
+            if not pending or now >= deadline:
+                break
+            time.sleep(min(interval, deadline - now))
+
+        for server in pending:
+            log.debug("Nameserver {0} didn't answer with {1} for {2} in {3} seconds".format(
+                server[0], ', '.join(addresses.values()), fqdn, timeout))
+            consistent[server] = None
+
+        return consistent
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import random
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Connections kept alive per host
+DEFAULT_POOL_SIZE = 16
+
+# Seconds to wait for connection and for response
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Retries on connection failure, timeout, 429 and 5xx
+DEFAULT_RETRIES = 2
+
+# Exponential backoff: first retry is done within BACKOFF_BASE seconds, never waiting more than BACKOFF_CAP.
+# Retry-After of a server is honored as is, the cap is only for the backoff of our own.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10.0
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Shared HTTP session. Connections are kept alive and reused by all threads.
+    :return: requests.Session
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+            log.debug("Created shared HTTP session with pool size of {0}".format(DEFAULT_POOL_SIZE))
+
+    return _session
+
+
+def backoff_delay(attempt):
+    """
+    Seconds to wait before a retry. Full jitter: a random delay up to an exponentially growing limit.
+    :param attempt: number of the retry, starting from 0
+    :return: float, seconds
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def parse_retry_after(retry_after):
+    """
+    :param retry_after: value of Retry-After -header, seconds or HTTP-date. None if server sent none.
+    :return: float, seconds server asked to wait. None if there is no usable value.
+    """
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        log.debug("Ignoring unparseable Retry-After: {0}".format(retry_after))
+
+        return None
+
+
+def request(method, url, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """
+    Make a request with the shared session. Transient failures are retried with jittered exponential backoff.
+    :param method: HTTP method
+    :param url: URL to request
+    :param retries: number of retries after the first attempt
+    :param timeout: seconds, or tuple of connect and read timeouts
+    :param kwargs: passed to requests
+    :return: requests.Response of the last attempt
+    """
+    import requests
+
+    session = get_session()
+    for attempt in range(retries + 1):
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            log.debug("{0} {1} failed: {2}. Retrying in {3:.2f} s".format(method, url, exc, delay))
+            time.sleep(delay)
+            continue
+
+        if resp.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+            return resp
+
+        retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+        if retry_after is not None and retry_after > BACKOFF_CAP:
+            # Not worth waiting for without a deadline, caller gets the response
+            return resp
+        delay = backoff_delay(attempt) if retry_after is None else retry_after
+        log.debug("{0} {1} responded {2}. Retrying in {3:.2f} s".format(method, url, resp.status_code, delay))
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import ipaddress
+import socket
+from .netlink import InterfaceAddress, IFA_F_SECONDARY, IFA_F_TEMPORARY, IFA_F_DADFAILED, IFA_F_DEPRECATED, \
+    IFA_F_TENTATIVE, RT_SCOPE_LINK
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS_POLICY = 'non-deprecated'
+
+# Address families by record type
+RECORD_TYPE_FAMILIES = {'A': socket.AF_INET, 'AAAA': socket.AF_INET6}
+
+
+def read_addresses():
+    """
+    Read addresses of all interfaces at once.
+    On Linux this is a single netlink dump, elsewhere netifaces is asked interface by interface.
+    :return: dict, interface name: list of InterfaceAddress
+    """
+    if hasattr(socket, 'AF_NETLINK'):
+        from .netlink import dump_addresses
+
+        addresses = dump_addresses()
+    else:
+        addresses = _read_netifaces_addresses()
+
+    by_iface = {}
+    for address in addresses:
+        by_iface.setdefault(address.iface, []).append(address)
+
+    return by_iface
+
+
+def _read_netifaces_addresses():
+    import netifaces
+
+    addresses = []
+    for iface in netifaces.interfaces():
+        ifaddresses = netifaces.ifaddresses(iface)
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for addr in ifaddresses.get(family, []):
+                # Link-local addresses have the scope appended: fe80::1%eth0
+                ip = ipaddress.ip_address(addr['addr'].split('%')[0])
+                netmask = addr.get('netmask', '').split('/')[-1]
+                if family == socket.AF_INET:
+                    prefixlen = ipaddress.ip_network("0.0.0.0/{0}".format(netmask or '32')).prefixlen
+                else:
+                    prefixlen = int(netmask) if netmask.isdigit() else 128
+                addresses.append(InterfaceAddress(iface, family, str(ip), prefixlen,
+                                                  scope=RT_SCOPE_LINK if ip.is_link_local else 0))
+
+    return addresses
+
+
+class AddressPolicy(object):
+    """
+    Choose the address to publish, when an interface has more than one.
+    Policy is a comma-separated list of rules:
+    * non-deprecated: leave out deprecated IPv6-addresses, their preferred lifetime is over
+    * public: leave out private addresses: RFC 1918, unique local IPv6 and others not globally reachable
+    * cidr:<network>: use only addresses in the network. Applies to addresses of the same family only.
+    * primary: pick the primary address of those left, instead of failing on many addresses
+    Link-local, tentative and failed addresses, and temporary IPv6 privacy addresses are never used.
+    """
+
+    RULES = ('non-deprecated', 'public', 'primary')
+
+    def __init__(self, policy=None):
+        """
+        :param policy: str, comma-separated rules. None for the default policy.
+        """
+        if policy is None:
+            policy = DEFAULT_ADDRESS_POLICY
+        self.non_deprecated = False
+        self.public = False
+        self.primary = False
+        self.networks = []
+        for rule in (rule.strip() for rule in policy.split(',')):
+            if not rule:
+                continue
+            if rule.startswith('cidr:'):
+                try:
+                    self.networks.append(ipaddress.ip_network(rule[len('cidr:'):], strict=False))
+                except ValueError as exc:
+                    raise ValueError("Invalid network in address policy rule {0}: {1}".format(rule, exc))
+            elif rule in self.RULES:
+                setattr(self, rule.replace('-', '_'), True)
+            else:
+                raise ValueError("Unknown address policy rule {0}".format(rule))
+
+    def select(self, addresses, record_type='A'):
+        """
+        :param addresses: list of InterfaceAddress of an interface
+        :param record_type: A for IPv4-addresses, AAAA for IPv6-addresses
+        :return: list of IP-addresses the policy allows, at most one if primary is requested
+        """
+        family = RECORD_TYPE_FAMILIES[record_type]
+        networks = [network for network in self.networks if network.version == (4 if record_type == 'A' else 6)]
+        unusable = IFA_F_TENTATIVE | IFA_F_DADFAILED
+        if family == socket.AF_INET6:
+            unusable |= IFA_F_TEMPORARY
+        if self.non_deprecated:
+            unusable |= IFA_F_DEPRECATED
+
+        candidates = []
+        for address in addresses:
+            if address.family != family or address.scope == RT_SCOPE_LINK or address.flags & unusable:
+                continue
+            ip = ipaddress.ip_address(address.address)
+            if ip.is_link_local or (self.public and not ip.is_global):
+                continue
+            if networks and not any(ip in network for network in networks):
+                continue
+            candidates.append(address)
+
+        if self.primary and len(candidates) > 1:
+            # Kernel lists the primary address first, IPv4 secondary addresses have a flag
+            primaries = [address for address in candidates
+                         if family == socket.AF_INET6 or not address.flags & IFA_F_SECONDARY]
+            candidates = (primaries or candidates)[:1]
+
+        return [address.address for address in candidates]
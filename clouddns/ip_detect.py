@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import ipaddress
+import os
+import socket
+import struct
+import time
+from .base_cloud import BaseCloud
+from .cache import JsonFileCache, default_cache_dir
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds each source has to answer
+DEFAULT_SOURCE_TIMEOUT = 3.0
+
+DEFAULT_SOURCES = ('ipinfo', 'https://api.ipify.org', 'https://icanhazip.com', 'stun')
+
+# Sources reachable over IPv6 only, the answer is the IPv6-address
+DEFAULT_IPV6_SOURCES = ('https://api6.ipify.org', 'https://ipv6.icanhazip.com', 'stun')
+
+DEFAULT_STUN_SERVER = 'stun.l.google.com:19302'
+
+# Weight of the latest measurement in a source's latency average
+LATENCY_SMOOTHING = 0.3
+
+STUN_BINDING_REQUEST = 0x0001
+STUN_BINDING_RESPONSE = 0x0101
+STUN_MAGIC_COOKIE = 0x2112A442
+STUN_ATTR_MAPPED_ADDRESS = 0x0001
+STUN_ATTR_XOR_MAPPED_ADDRESS = 0x0020
+
+
+def get_ipinfoio_address(timeout):
+    from . import http
+
+    resp = http.get('http://ipinfo.io/json', timeout=timeout)
+    if not resp.ok:
+        return None
+
+    return resp.json()['ip']
+
+
+def get_http_echo_address(url, timeout):
+    """
+    Ask an HTTP-service, which responds with the client address as plain text
+    :param url: URL of the service
+    :param timeout: seconds to wait
+    :return: str, IP-address. None on failure.
+    """
+    from . import http
+
+    resp = http.get(url, timeout=timeout)
+    if not resp.ok:
+        return None
+
+    return resp.text.strip()
+
+
+def get_stun_address(server, timeout, family=4):
+    """
+    Send a STUN binding request, see RFC 5389
+    :param server: host:port of the STUN-server
+    :param timeout: seconds to wait
+    :param family: IP version to send the request over, 4 or 6
+    :return: str, IP-address the server sees. None on failure.
+    """
+    host, _, port = server.rpartition(':')
+    host = host.strip('[]')
+    transaction_id = os.urandom(12)
+    request = struct.pack('!HHI', STUN_BINDING_REQUEST, 0, STUN_MAGIC_COOKIE) + transaction_id
+
+    address_family = socket.AF_INET6 if family == 6 else socket.AF_INET
+    server_address = socket.getaddrinfo(host, int(port), address_family, socket.SOCK_DGRAM)[0][4]
+    with socket.socket(address_family, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(request, server_address)
+        response, _ = sock.recvfrom(2048)
+
+    msg_type, msg_len, cookie = struct.unpack_from('!HHI', response)
+    if msg_type != STUN_BINDING_RESPONSE or cookie != STUN_MAGIC_COOKIE or response[8:20] != transaction_id:
+        return None
+
+    offset = 20
+    while offset + 4 <= 20 + msg_len:
+        attr_type, attr_len = struct.unpack_from('!HH', response, offset)
+        value = response[offset + 4:offset + 4 + attr_len]
+        # IPv4 address family is 0x01, IPv6 0x02
+        if attr_type == STUN_ATTR_XOR_MAPPED_ADDRESS and value[1] == 0x01:
+            xor_address = struct.unpack_from('!I', value, 4)[0] ^ STUN_MAGIC_COOKIE
+            return str(ipaddress.IPv4Address(xor_address))
+        if attr_type == STUN_ATTR_XOR_MAPPED_ADDRESS and value[1] == 0x02:
+            # IPv6-address is XORed with magic cookie and transaction ID
+            xor_key = struct.pack('!I', STUN_MAGIC_COOKIE) + transaction_id
+            return str(ipaddress.IPv6Address(bytes(a ^ b for a, b in zip(value[4:20], xor_key))))
+        if attr_type == STUN_ATTR_MAPPED_ADDRESS and value[1] == 0x01:
+            return str(ipaddress.IPv4Address(value[4:8]))
+        if attr_type == STUN_ATTR_MAPPED_ADDRESS and value[1] == 0x02:
+            return str(ipaddress.IPv6Address(value[4:20]))
+        # Attributes are padded to 32 bits
+        offset += 4 + ((attr_len + 3) & ~3)
+
+    return None
+
+
+class PublicIpDetector(object):
+    """
+    Race multiple sources of public IP-address. Sources are queried in parallel, each having its own deadline.
+    The first valid answer is used, or the first one reported by quorum of sources.
+    Latency of each source is remembered, the fastest ones are started first on next run.
+    """
+
+    def __init__(self, sources=DEFAULT_SOURCES, timeout=DEFAULT_SOURCE_TIMEOUT, quorum=1, latency_file=None,
+                 family=4):
+        """
+        :param sources: list of source names: ipinfo, aws, azure, stun, stun:<host>:<port> or an HTTP(S) echo URL
+        :param timeout: seconds each source has to answer
+        :param quorum: number of sources, which need to agree on the address
+        :param latency_file: file to remember source latencies in
+        :param family: IP version to detect, 4 or 6
+        """
+        self.sources = list(sources)
+        self.timeout = timeout
+        self.quorum = quorum
+        self.family = family
+        if not latency_file:
+            latency_file = default_cache_dir() + "/ip-sources.json"
+        self.latencies = JsonFileCache(latency_file)
+
+        for source in self.sources:
+            # Fail early on typos
+            self._source_function(source)
+
+    def _source_function(self, source):
+        if source == 'ipinfo':
+            return lambda: get_ipinfoio_address(self.timeout)
+        if source in ('aws', 'azure') and self.family != 4:
+            raise ValueError("Public IP-address source {0} has only IPv4-addresses".format(source))
+        if source == 'aws':
+            return lambda: BaseCloud.get_current_ipv4_from_aws_vm_metadata(timeout=self.timeout)
+        if source == 'azure':
+            return lambda: BaseCloud.get_current_ipv4_from_azure_vm_metadata(timeout=self.timeout)
+        if source == 'stun':
+            return lambda: get_stun_address(DEFAULT_STUN_SERVER, self.timeout, self.family)
+        if source.startswith('stun:'):
+            return lambda: get_stun_address(source[len('stun:'):], self.timeout, self.family)
+        if source.startswith('http://') or source.startswith('https://'):
+            return lambda: get_http_echo_address(source, self.timeout)
+
+        raise ValueError("Unknown public IP-address source {0}".format(source))
+
+    def _query(self, source):
+        start = time.monotonic()
+        ip = self._source_function(source)()
+        if isinstance(ip, bytes):
+            ip = ip.decode('ascii')
+
+        # Anything else than an address of requested family is a failure
+        if self.family == 6:
+            ip = str(ipaddress.IPv6Address(ip))
+        else:
+            ip = str(ipaddress.IPv4Address(ip))
+
+        return ip, time.monotonic() - start
+
+    def _latency_key(self, source):
+        # Same source can have very different latency over IPv6
+        return source if self.family == 4 else "{0} ipv6".format(source)
+
+    def _sources_by_latency(self):
+        def latency(source):
+            measured = self.latencies.get(self._latency_key(source))
+            return measured if measured is not None else self.timeout
+
+        # Stable sort, sources without history keep their configured order
+        return sorted(self.sources, key=latency)
+
+    def detect(self):
+        """
+        :return: str, IP-address. None if no address got quorum before deadline.
+        """
+        import queue
+        import threading
+
+        # Daemon threads, the slower sources are simply abandoned once there is an answer
+        answers = queue.Queue()
+        pending = self._sources_by_latency()
+        for source in pending:
+            threading.Thread(target=self._query_into, args=(source, answers), daemon=True,
+                             name="ip-detect-{0}".format(source)).start()
+
+        votes = {}
+        measured = {}
+        deadline = time.monotonic() + self.timeout
+        detected_ip = None
+        while pending and not detected_ip:
+            try:
+                source, ip, elapsed = answers.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                log.debug("Deadline passed waiting for {0}".format(', '.join(pending)))
+                break
+
+            pending.remove(source)
+            measured[source] = elapsed
+            if not ip:
+                continue
+            votes[ip] = votes.get(ip, 0) + 1
+            if votes[ip] >= self.quorum:
+                detected_ip = ip
+
+        if not detected_ip:
+            for source in pending:
+                # Didn't make it in time
+                measured[source] = self.timeout
+        self._remember_latencies(measured)
+
+        return detected_ip
+
+    def _query_into(self, source, answers):
+        """
+        Query a source in a thread
+        :param source: source name
+        :param answers: queue to put (source, IP-address or None, seconds elapsed) into
+        :return:
+        """
+        try:
+            ip, elapsed = self._query(source)
+        except Exception as exc:
+            log.debug("Public IP-address source {0} failed: {1}".format(source, exc))
+            # Failing source is as good as a timed out one
+            answers.put((source, None, self.timeout))
+            return
+
+        log.debug("Public IP-address source {0} answered {1} in {2:.3f} s".format(source, ip, elapsed))
+        answers.put((source, ip, elapsed))
+
+    def _remember_latencies(self, measured):
+        averages = {}
+        for source, elapsed in measured.items():
+            key = self._latency_key(source)
+            previous = self.latencies.get(key)
+            if previous is None:
+                averages[key] = elapsed
+            else:
+                averages[key] = LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * previous
+        if averages:
+            self.latencies.update(averages)
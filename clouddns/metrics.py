@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import sys
+import threading
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# BaseCloud methods to measure. Provider's zone lookup is measured as zone_lookup, see BaseCloud.zone_lookup_method.
+PROVIDER_METHODS = ('is_authenticated', 'authenticate', 'get_current_ip_from_dns', 'get_current_ips_from_dns',
+                    'get_zone_records', 'update_rr', 'update_rrs', 'update_zone_rrs', 'update_rrs_conditional')
+
+PROMETHEUS_PREFIX = 'clouddns'
+
+
+class _NullTimer(object):
+    """
+    Timer of disabled metrics, does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, kind, labels):
+        self.metrics = metrics
+        self.kind = kind
+        self.labels = labels
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Exiting successfully is not an error
+        failed = exc_type is not None and not (exc_type is SystemExit and not exc_value.code)
+        self.metrics.observe(self.kind, self.labels, time.perf_counter() - self.started, failed)
+        return False
+
+
+class Metrics(object):
+    """
+    Call counts, durations and errors of run phases and Cloud provider API methods.
+    Also time it took for updates to propagate into each authoritative nameserver.
+    Disabled by default. When disabled, phase() returns a shared no-op timer and providers are not wrapped.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics_file = None
+        self.json_line = False
+        # (kind, labels): [calls, seconds, errors]
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def enable(self, metrics_file=None, json_line=False):
+        """
+        Start collecting, and write the metrics out on exit
+        :param metrics_file: Prometheus textfile collector file to write, optional
+        :param json_line: print a JSON line into stdout
+        :return:
+        """
+        if not self.enabled:
+            import atexit
+
+            atexit.register(self.write)
+        self.enabled = True
+        self.metrics_file = metrics_file
+        self.json_line = json_line
+
+    def phase(self, name):
+        """
+        Measure a phase of a run:
+            with metrics.phase('authenticate'):
+                ...
+        :param name: name of the phase
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+
+        return _Timer(self, 'phase', (name,))
+
+    def observe(self, kind, labels, seconds, failed=False):
+        """
+        :param kind: phase, api or propagation
+        :param labels: tuple, phase name, provider and method names, or provider name and nameserver address
+        :param seconds: duration of the call, or time to propagate
+        :param failed: the call failed, or the update didn't propagate in time
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            counter = self.counters.setdefault((kind, labels), [0, 0.0, 0])
+            counter[0] += 1
+            counter[1] += seconds
+            if failed:
+                counter[2] += 1
+
+    def instrument(self, provider):
+        """
+        Measure API methods of a provider. Nothing is done when disabled.
+        :param provider: BaseCloud implementation
+        :return: the same provider
+        """
+        if not self.enabled:
+            return provider
+
+        methods = {method_name: method_name for method_name in PROVIDER_METHODS}
+        if provider.zone_lookup_method:
+            methods['zone_lookup'] = provider.zone_lookup_method
+        for metric_name, method_name in methods.items():
+            setattr(provider, method_name, self._timed(provider.name, metric_name, getattr(provider, method_name)))
+
+        return provider
+
+    def _timed(self, provider_name, metric_name, method):
+        def timed(*args, **kwargs):
+            with _Timer(self, 'api', (provider_name, metric_name)):
+                return method(*args, **kwargs)
+
+        return timed
+
+    def write(self):
+        """
+        Write out the metrics collected so far. Long-running modes call this after every update.
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        if self.metrics_file:
+            try:
+                self._write_prometheus(self.metrics_file)
+            except OSError as exc:
+                log.error("Failed to write metrics into {0}: {1}".format(self.metrics_file, exc))
+        if self.json_line:
+            import json
+
+            print(json.dumps(self.as_dict(), sort_keys=True))
+            sys.stdout.flush()
+
+    def as_dict(self):
+        data = {'timestamp': time.time(), 'phases': {}, 'api': {}, 'propagation': {}}
+        with self.lock:
+            for (kind, labels), (calls, seconds, errors) in sorted(self.counters.items()):
+                values = {'calls': calls, 'seconds': round(seconds, 6), 'errors': errors}
+                if kind == 'phase':
+                    data['phases'][labels[0]] = values
+                else:
+                    data[kind].setdefault(labels[0], {})[labels[1]] = values
+
+        return data
+
+    def prometheus_text(self):
+        """
+        :return: str, metrics in Prometheus text exposition format
+        """
+        families = (
+            ('phase', ('phase',), 'phase_calls_total', 'Runs of a phase', 0),
+            ('phase', ('phase',), 'phase_seconds_total', 'Seconds spent in a phase', 1),
+            ('phase', ('phase',), 'phase_errors_total', 'Failed runs of a phase', 2),
+            ('api', ('provider', 'method'), 'api_calls_total', 'Calls of a provider API method', 0),
+            ('api', ('provider', 'method'), 'api_seconds_total', 'Seconds spent in a provider API method', 1),
+            ('api', ('provider', 'method'), 'api_errors_total', 'Failed calls of a provider API method', 2),
+            ('propagation', ('provider', 'nameserver'), 'propagation_checks_total',
+             'Updates waited for to propagate into a nameserver', 0),
+            ('propagation', ('provider', 'nameserver'), 'propagation_seconds_total',
+             'Seconds updates took to propagate into a nameserver', 1),
+            ('propagation', ('provider', 'nameserver'), 'propagation_timeouts_total',
+             'Updates not propagated into a nameserver in time', 2),
+        )
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for family_kind, label_names, name, help_text, index in families:
+            lines.append("# HELP {0}_{1} {2}".format(PROMETHEUS_PREFIX, name, help_text))
+            lines.append("# TYPE {0}_{1} counter".format(PROMETHEUS_PREFIX, name))
+            for (kind, labels), values in counters:
+                if kind != family_kind:
+                    continue
+                label_text = ','.join('{0}="{1}"'.format(label_name, label)
+                                      for label_name, label in zip(label_names, labels))
+                lines.append("{0}_{1}{{{2}}} {3}".format(PROMETHEUS_PREFIX, name, label_text, values[index]))
+        lines.append("# HELP {0}_last_run_timestamp_seconds Time metrics were written".format(PROMETHEUS_PREFIX))
+        lines.append("# TYPE {0}_last_run_timestamp_seconds gauge".format(PROMETHEUS_PREFIX))
+        lines.append("{0}_last_run_timestamp_seconds {1:.3f}".format(PROMETHEUS_PREFIX, time.time()))
+
+        return '\n'.join(lines) + '\n'
+
+    def _write_prometheus(self, metrics_file):
+        import tempfile
+
+        # Textfile collector may read the file any time, replace it atomically.
+        # Collector ignores the temporary file, it doesn't end with .prom.
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(metrics_file) or '.', prefix='.tmp-')
+        try:
+            with open(fd, 'wt', encoding='utf8') as fp:
+                fp.write(self.prometheus_text())
+            os.chmod(tmp_filename, 0o644)
+            os.replace(tmp_filename, metrics_file)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+
+# Metrics of this process
+metrics = Metrics()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import errno
+import select
+import socket
+import struct
+import logging
+
+log = logging.getLogger(__name__)
+
+# See: linux/netlink.h and linux/rtnetlink.h
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# See: linux/if_addr.h
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_SECONDARY = 0x01
+IFA_F_TEMPORARY = IFA_F_SECONDARY
+IFA_F_DADFAILED = 0x08
+IFA_F_DEPRECATED = 0x20
+IFA_F_TENTATIVE = 0x40
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_HOST = 254
+
+# See: linux/if_link.h
+IFLA_IFNAME = 3
+
+NLMSG_HDR = struct.Struct('=LHHLL')
+NLMSG_ERR = struct.Struct('=i')
+IFADDRMSG = struct.Struct('=BBBBI')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR = struct.Struct('=HH')
+U32 = struct.Struct('=I')
+
+
+def _nlmsg_align(length):
+    return (length + 3) & ~3
+
+
+class InterfaceAddress(object):
+    """
+    An address of a network interface, as reported by kernel
+    """
+
+    def __init__(self, iface, family, address, prefixlen, flags=0, scope=RT_SCOPE_UNIVERSE):
+        """
+        :param iface: name of the interface
+        :param family: socket.AF_INET or socket.AF_INET6
+        :param address: IP-address as str
+        :param prefixlen: length of network prefix
+        :param flags: IFA_F_* flags
+        :param scope: RT_SCOPE_* scope
+        """
+        self.iface = iface
+        self.family = family
+        self.address = address
+        self.prefixlen = prefixlen
+        self.flags = flags
+        self.scope = scope
+
+    def __repr__(self):
+        return "{0}/{1} on {2} (flags 0x{3:x}, scope {4})".format(self.address, self.prefixlen, self.iface,
+                                                                 self.flags, self.scope)
+
+
+def dump_addresses():
+    """
+    Get all addresses of all interfaces with a single RTM_GETADDR dump request
+    :return: list of InterfaceAddress, in kernel order: the primary address of an interface comes first
+    """
+    names = dict(socket.if_nameindex())
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        seq = 1
+        sock.send(NLMSG_HDR.pack(NLMSG_HDR.size + IFADDRMSG.size, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) +
+                  IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        addresses = []
+        while not _parse_dump(sock.recv(65536), seq, names, addresses):
+            pass
+    finally:
+        sock.close()
+    log.debug("Interface addresses: {0}".format(addresses))
+
+    return addresses
+
+
+def _parse_dump(data, seq, names, addresses):
+    """
+    Parse a part of dump response into addresses
+    :return: bool, True when the dump is done
+    """
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        msg_len, msg_type, _, msg_seq, _ = NLMSG_HDR.unpack_from(data, offset)
+        if msg_len < NLMSG_HDR.size:
+            break
+        if msg_seq != seq:
+            # Not a response to this request
+            pass
+        elif msg_type == NLMSG_DONE:
+            return True
+        elif msg_type == NLMSG_ERROR:
+            error, = NLMSG_ERR.unpack_from(data, offset + NLMSG_HDR.size)
+            if error:
+                raise OSError(-error, "Netlink address dump failed")
+        elif msg_type == RTM_NEWADDR:
+            address = _parse_address(data[offset + NLMSG_HDR.size:offset + msg_len], names)
+            if address:
+                addresses.append(address)
+        offset += _nlmsg_align(msg_len)
+
+    return False
+
+
+def _parse_address(data, names):
+    family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(data)
+    if family not in (socket.AF_INET, socket.AF_INET6):
+        return None
+
+    attributes = {}
+    offset = IFADDRMSG.size
+    while offset + RTATTR.size <= len(data):
+        attr_len, attr_type = RTATTR.unpack_from(data, offset)
+        if attr_len < RTATTR.size:
+            break
+        attributes[attr_type] = data[offset + RTATTR.size:offset + attr_len]
+        offset += _nlmsg_align(attr_len)
+
+    # IFA_LOCAL is the address of the interface, IFA_ADDRESS can be the peer of a point-to-point link
+    address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+    if not address:
+        return None
+    if IFA_FLAGS in attributes:
+        # 32-bit flags, the 8-bit ones in header can't hold them all
+        flags, = U32.unpack_from(attributes[IFA_FLAGS])
+
+    return InterfaceAddress(names.get(index, str(index)), family, socket.inet_ntop(family, address), prefixlen,
+                            flags, scope)
+
+
+class AddressMonitor(object):
+    """
+    Subscribe to kernel address change notifications (RTM_NEWADDR / RTM_DELADDR) for a set of interfaces.
+    Waiting for a change costs nothing, the process sleeps in the kernel until an event is delivered.
+    Interfaces are monitored by name: an interface may not exist yet, and a re-created one gets a new index.
+    """
+
+    def __init__(self, ifaces, ipv4=True, ipv6=False):
+        """
+        :param ifaces: name of the interface, or list of names
+        :param ipv4: subscribe to IPv4-address changes
+        :param ipv6: subscribe to IPv6-address changes
+        """
+        if isinstance(ifaces, str):
+            ifaces = [ifaces]
+        self.names = set(ifaces)
+        # Interface index: name, of the monitored interfaces existing now
+        self.ifaces = {}
+        groups = RTMGRP_LINK | (RTMGRP_IPV4_IFADDR if ipv4 else 0) | (RTMGRP_IPV6_IFADDR if ipv6 else 0)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, groups))
+        # Resolved after subscribing, not to miss an interface appearing in between
+        self._resolve()
+        log.debug("Subscribed to address changes of interfaces {0}".format(', '.join(ifaces)))
+
+    def _resolve(self):
+        """
+        Look up the indexes of the monitored interfaces
+        :return: bool, True if they changed
+        """
+        ifaces = {index: name for index, name in socket.if_nameindex() if name in self.names}
+        changed = ifaces != self.ifaces
+        if changed:
+            log.debug("Monitored interfaces by index: {0}".format(ifaces))
+        self.ifaces = ifaces
+
+        return changed
+
+    def close(self):
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wait_for_change(self, timeout=None):
+        """
+        Block until an address of a monitored interface is added or removed.
+        All events queued at the time of wake-up are consumed, a burst of changes is reported only once.
+        :param timeout: seconds to wait, None to wait forever
+        :return: bool, True if an interface had address changes, False on timeout or unrelated events
+        """
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+
+        changed = False
+        while True:
+            try:
+                data = self.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                if exc.errno != errno.ENOBUFS:
+                    raise
+                # Socket buffer overflowed and events were dropped. Anything may have changed,
+                # addresses are read again with a dump.
+                log.warning("Address change events were lost, reading all addresses again")
+                self._resolve()
+                changed = True
+                continue
+            changed = self._parse(data) or changed
+
+        return changed
+
+    def _parse(self, data):
+        changed = False
+        offset = 0
+        while offset + NLMSG_HDR.size <= len(data):
+            msg_len, msg_type, _, _, _ = NLMSG_HDR.unpack_from(data, offset)
+            if msg_len < NLMSG_HDR.size:
+                break
+            if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                name = self._link_name(data[offset + NLMSG_HDR.size:offset + msg_len])
+                # Link up and down are reported with RTM_NEWLINK too, only a new index counts as a change
+                if name in self.names and self._resolve():
+                    log.debug("Interface {0} appeared, was removed or re-created".format(name))
+                    changed = True
+            elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                family, _, _, _, index = IFADDRMSG.unpack_from(data, offset + NLMSG_HDR.size)
+                if index not in self.ifaces:
+                    # Interface may have been re-created before its RTM_NEWLINK was read
+                    self._resolve()
+                if index in self.ifaces:
+                    log.debug("Address {0} on interface {1}".format(
+                        'added' if msg_type == RTM_NEWADDR else 'removed', self.ifaces[index]))
+                    changed = True
+            offset += _nlmsg_align(msg_len)
+
+        return changed
+
+    @staticmethod
+    def _link_name(data):
+        """
+        :param data: RTM_NEWLINK or RTM_DELLINK message, without the header
+        :return: str, name of the interface. None if the message has none.
+        """
+        offset = IFINFOMSG.size
+        while offset + RTATTR.size <= len(data):
+            attr_len, attr_type = RTATTR.unpack_from(data, offset)
+            if attr_len < RTATTR.size:
+                break
+            if attr_type == IFLA_IFNAME:
+                return data[offset + RTATTR.size:offset + attr_len].split(b'\0', 1)[0].decode('utf8', 'replace')
+            offset += _nlmsg_align(attr_len)
+
+        return None
@@ -3,14 +3,19 @@
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
 import pyrax
+import pyrax.clouddns
 import pyrax.exceptions
-import pytz
+import pyrax.http
 import os.path
 import sys
 import json
-from tzlocal import get_localzone
+import threading
+from datetime import datetime, timezone
 from pathlib import Path
 from ..base_cloud import BaseCloud
+from ..call_policy import THROTTLED, UNAVAILABLE
+from ..cache import JsonFileCache, default_cache_dir
+from ..http import get_session, DEFAULT_TIMEOUT
 import logging
 
 # This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
@@ -30,48 +35,81 @@ import logging
 
 log = logging.getLogger(__name__)
 
+# Provider making the Pyrax calls of this thread, see Rackspace._call()
+_calling = threading.local()
+
+
+def _session_request(method):
+    """
+    Pyrax does module level requests.get() etc. for each call, opening a new connection every time.
+    Route the calls via a shared session, which keeps connections alive.
+    Pyrax sets no timeouts, a request may wait only for what is left of the deadline of the calling provider.
+    """
+    def request(uri, **kwargs):
+        provider = getattr(_calling, 'provider', None)
+        kwargs.setdefault('timeout', provider.call_policy.request_timeout() if provider else DEFAULT_TIMEOUT)
+        resp = get_session().request(method, uri, **kwargs)
+        if provider:
+            provider.last_response.retry_after = resp.headers.get('Retry-After')
+
+        return resp
+
+    return request
+
+
+# Installed once, shared by all the instances
+pyrax.http.req_methods = {method: _session_request(method)
+                          for method in ("HEAD", "GET", "POST", "PUT", "DELETE", "PATCH")}
+
 
 class Rackspace(BaseCloud):
     """
     Rackspace Cloud DNS implementation
     """
 
-    # Rackspace API token cache file.
-    # Same format than Let's Encrypt tool acme.sh has for Rackspace DNS plugin.
-    token_file = '/tmp/.acme.rackspace.%s.token' % os.geteuid()
+    name = 'rackspace'
+    zone_lookup_method = '_get_domain'
 
-    def is_authenticated(self):
-        """
-        We do cache the authentication token, which is get by exchanging API credentials.
-        If the cache exists and is still valid, no authentication is made.
-        :return:
-        """
-        if not os.path.isfile(self.token_file):
-            # No data in cache --> no token --> not authenticated
-            return False
+    def __init__(self, domain_cache_file=None, token_cache=None):
+        super().__init__(token_cache=token_cache)
+        # Domain objects resolved during this run, by domain name
+        self.domains = {}
+        # Persisted domain name --> domain ID. IDs don't change, entries are dropped only when API says NotFound.
+        if not domain_cache_file:
+            domain_cache_file = default_cache_dir() + "/rackspace-domains.json"
+        self.domain_cache = JsonFileCache(domain_cache_file)
+        # Retry-After of the latest response, Pyrax exceptions don't carry the headers
+        self.last_response = threading.local()
 
-        data = json.load(open(self.token_file))
-        token = data['access']['token']['id']
-        tenant_id = data['access']['token']['tenant']['id']
-        tenant_name = data['access']['token']['tenant']['name']
-
-        pyrax.settings._settings['default']["identity_class"] = pyrax.rax_identity.RaxIdentity
+    def _call(self, func, *args, idempotent=True, **kwargs):
+        # Requests Pyrax makes during the call are subject to the call policy of this provider
+        previous = getattr(_calling, 'provider', None)
+        _calling.provider = self
         try:
-            pyrax.auth_with_token(token, tenant_id=tenant_id, tenant_name=tenant_name)
-        except pyrax.exceptions.AuthenticationFailed:
-            return False
+            return super()._call(func, *args, idempotent=idempotent, **kwargs)
+        finally:
+            _calling.provider = previous
+
+    def _transient_error(self, exc):
+        if isinstance(exc, pyrax.exceptions.ClientException):
+            # Rackspace answers 413 Over Limit when rate limited
+            if exc.code in (413, 429):
+                return THROTTLED, getattr(self.last_response, 'retry_after', None)
+            if isinstance(exc.code, int) and exc.code >= 500:
+                return UNAVAILABLE, getattr(self.last_response, 'retry_after', None)
 
-        return True
+            return None, None
 
-    def authenticate(self, api_creds):
+        return super()._transient_error(exc)
+
+    def _login(self, api_creds):
         pyrax.set_setting('identity_type', 'rackspace')
         pyrax.set_credentials(api_creds[0], password=api_creds[1], authenticate=True)
 
-        # Construct the authentication response body and store it as JSON.
-        local_tz = get_localzone()
-        expiry_in_utc = pyrax.identity.expires.astimezone(local_tz)
-        expiry_in_utc = expiry_in_utc.astimezone(pytz.utc)
+        # Naive datetime of Pyrax is in local time
+        expires = pyrax.identity.expires.timestamp()
 
+        # Construct the authentication response body to be cached as JSON, _restore_token() parses it
         json_out = {
             "access": {
                 "token": {
@@ -80,7 +118,7 @@ class Rackspace(BaseCloud):
                         "name": pyrax.identity.tenant_name,
                         "id": pyrax.identity.tenant_id,
                     },
-                    "expires": expiry_in_utc.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+                    "expires": datetime.fromtimestamp(expires, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
                 },
                 "user": {
                     "id": pyrax.identity.user['id'],
@@ -91,62 +129,208 @@ class Rackspace(BaseCloud):
             }
         }
 
-        log.info("Authenticated into Azure ok")
-        # The file is rw- only for the current user.
-        with open(os.open(self.token_file, os.O_CREAT | os.O_WRONLY, 0o600), 'w') as fp:
-            json.dump(json_out, fp)
+        log.info("Authenticated into Rackspace ok")
+
+        return json_out, expires
+
+    def _restore_token(self, token):
+        """
+        Set up Pyrax from a cached authentication response.
+        This is what pyrax.auth_with_token() does, minus the request validating the token.
+        :param token: authentication response body
+        :return:
+        """
+        pyrax.settings._settings['default']["identity_class"] = pyrax.rax_identity.RaxIdentity
+        identity = pyrax.rax_identity.RaxIdentity()
+        identity._parse_response(token)
+        identity.authenticated = True
+
+        pyrax.identity = identity
+        pyrax.regions = tuple(identity.regions)
+        pyrax.services = tuple(identity.services.keys())
+        pyrax.connect_to_services()
 
-        log.debug("Saved authentication data into cache file {0}".format(self.token_file))
+    def _token_identity(self, api_creds):
+        # API user
+        return api_creds[0]
 
-    def get_current_ip_from_dns(self, host, domain):
+    def get_current_ip_from_dns(self, host, domain, record_type='A'):
         """
         Get the current recurd
         :param host: hostname of the FQDN, without dot
         :param domain: domain part of the FQDN
+        :param record_type: A or AAAA
         :return: Object|None, currently set IP-address
         """
 
-        # Find the given domain
-        domain_object = pyrax.cloud_dns.find(name=domain)
+        return self._with_domain(domain, lambda domain_object: self._search_record(
+            domain_object, host, domain, record_type))
+
+    def get_current_ips_from_dns(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Get the current records of multiple types for a host. Domain is looked up only once.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, record type: tuple of record object and IP-address, both None if there is no record
+        """
+
+        return self._with_domain(domain, lambda domain_object: {
+            record_type: self._search_record(domain_object, host, domain, record_type)
+            for record_type in record_types})
 
+    def get_zone_records(self, domain, hosts, record_types=('A', 'AAAA')):
+        """
+        Get the current records of many hosts with a paged listing of all records in the domain
+        :param domain: domain part of the FQDNs
+        :param hosts: hostnames of the FQDNs, without dot
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, (hostname, record type): tuple of record object and IP-address
+        """
+        return self._with_domain(domain, lambda domain_object: self._list_zone_records(
+            domain_object, domain, hosts, record_types))
+
+    def _list_zone_records(self, domain_object, domain, hosts, record_types):
+        names = {'%s.%s' % (host, domain): host for host in hosts}
+        current = {}
+        records_listed = 0
+        # Iterator requests the next page of 100 records when needed. A failed listing is retried from the start.
+        records = self._call(lambda: list(pyrax.cloud_dns.get_record_iterator(domain_object)))
+        for record in records:
+            records_listed += 1
+            if record.name not in names or record.type not in record_types:
+                continue
+            key = (names[record.name], record.type)
+            if key in current:
+                log.error("Multiple {0}-records for {1} in domain {2}.".format(record.type, key[0], domain))
+                raise RuntimeError("Multiple {0}-records for {1} in domain {2}.".format(record.type, key[0], domain))
+            current[key] = (record, record.data)
+        log.info("Listed {0} records of domain {1}, {2} of them for requested hosts".format(
+            records_listed, domain, len(current)))
+
+        return current
+
+    def _search_record(self, domain_object, host, domain, record_type):
         # Find the given host
-        current = domain_object.search_records('A', name='%s.%s' % (host, domain))
+        current = self._call(domain_object.search_records, record_type, name='%s.%s' % (host, domain))
         if not len(current):
-            return None
+            return None, None
 
         if len(current) > 1:
-            log.error("Multiple records for {0} in domain {1}.".format(host, domain))
-            raise RuntimeError("Multiple records for {0} in domain {1}.".format(host, domain))
+            log.error("Multiple {0}-records for {1} in domain {2}.".format(record_type, host, domain))
+            raise RuntimeError("Multiple {0}-records for {1} in domain {2}.".format(record_type, host, domain))
 
-        current_ipv4 = current[0].data
-        log.info("Current IPv4 address for {0}.{1} is {2}".format(host, domain, current_ipv4))
+        current_ip = current[0].data
+        log.info("Current {0} address for {1}.{2} is {3}".format(record_type, host, domain, current_ip))
 
-        return current[0], current_ipv4
+        return current[0], current_ip
 
-    def update_rr(self, host, domain, ip, record_to_update):
+    def update_rr(self, host, domain, ip, record_to_update, record_type='A'):
         """
         Update existing DNS-record
         :param host: hostname of the FQDN, without dot
         :param domain: domain part of the FQDN
-        :param ip: IPv4-address to update
+        :param ip: IP-address to update
         :param record_to_update: existing DNS-record object to update, if None - add a record
+        :param record_type: A or AAAA
         :return:
         """
 
-        # Find the given domain
-        domain_object = pyrax.cloud_dns.find(name=domain)
-
         if record_to_update:
-            # Update!
-            domain_object.update_record(record_to_update, ip)
-            log.info("Updated IPv4 address for {0}.{1} as {2}".format(host, domain, ip))
+            # Update! Record knows its domain, no need to look it up.
+            self._call(record_to_update.update, data=ip)
+            log.info("Updated {0} address for {1}.{2} as {3}".format(record_type, host, domain, ip))
         else:
             # Add!
-            rec = {'type': 'A',
+            rec = {'type': record_type,
                    'name': '%s.%s' % (host, domain),
                    'data': ip}
-            domain_object.add_record(rec)
-            log.info("Added RR for IPv4 address {0}.{1} as {2}".format(host, domain, ip))
+            # Adding is not idempotent, a POST which may have been processed is not retried
+            self._with_domain(domain, lambda domain_object: self._call(domain_object.add_record, rec,
+                                                                       idempotent=False))
+            log.info("Added RR for {0} address {1}.{2} as {3}".format(record_type, host, domain, ip))
+
+    def update_rrs(self, host, domain, changes):
+        """
+        Update multiple records of a host. All additions are done in one request, all updates in another.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param changes: list of tuples: record type, IP-address, existing record object or None to add one
+        :return:
+        """
+
+        existing_records = [record_to_update for _, _, record_to_update in changes if record_to_update]
+        records_to_update = [{'id': record_to_update.id,
+                              'name': record_to_update.name,
+                              'data': ip}
+                             for _, ip, record_to_update in changes if record_to_update]
+        records_to_add = [{'type': record_type,
+                           'name': '%s.%s' % (host, domain),
+                           'data': ip}
+                          for record_type, ip, record_to_update in changes if not record_to_update]
+
+        if records_to_update:
+            # Records know their domain, no need to look it up
+            self._call(self._domain_object(domain, existing_records[0].domain_id).update_records, records_to_update)
+            log.info("Updated {0} records for {1}.{2}".format(len(records_to_update), host, domain))
+        if records_to_add:
+            self._with_domain(domain, lambda domain_object: self._call(domain_object.add_records, records_to_add,
+                                                                       idempotent=False))
+            log.info("Added {0} records for {1}.{2}".format(len(records_to_add), host, domain))
+
+    def _with_domain(self, domain, operation):
+        """
+        Run an operation on a domain.
+        If a cached domain ID is not found anymore, the domain is looked up again and operation is retried once.
+        :param domain: name of the domain
+        :param operation: function taking the domain object as argument
+        :return: whatever operation returns
+        """
+        domain_object, from_cache = self._get_domain(domain)
+        try:
+            return operation(domain_object)
+        except pyrax.exceptions.NotFound:
+            if not from_cache:
+                raise
+
+        # Domain was deleted and re-created since its ID was cached
+        log.debug("Cached ID {0} of domain {1} not found, looking it up again".format(domain_object.id, domain))
+        self.domains.pop(domain, None)
+        self.domain_cache.invalidate(self._domain_cache_key(domain))
+        domain_object, _ = self._get_domain(domain)
+
+        return operation(domain_object)
+
+    def _get_domain(self, domain):
+        """
+        Find a domain. Domains already seen in this run or cached on disk cost no requests.
+        :param domain: name of the domain
+        :return: tuple, domain object and bool telling if the ID came from cache without checking it from API
+        """
+        if domain in self.domains:
+            return self.domains[domain]
+
+        domain_id = self.domain_cache.get(self._domain_cache_key(domain))
+        if domain_id:
+            log.debug("Domain {0} found from domain cache with ID {1}".format(domain, domain_id))
+            self.domains[domain] = (self._domain_object(domain, domain_id), True)
+        else:
+            # Find the given domain
+            domain_object = self._call(pyrax.cloud_dns.find, name=domain)
+            self.domain_cache.put(self._domain_cache_key(domain), domain_object.id)
+            self.domains[domain] = (domain_object, False)
+
+        return self.domains[domain]
+
+    @staticmethod
+    def _domain_object(domain, domain_id):
+        # Pyrax needs only the ID to address a domain
+        return pyrax.clouddns.CloudDNSDomain(pyrax.cloud_dns._manager, {'id': domain_id, 'name': domain},
+                                             loaded=True)
+
+    def _domain_cache_key(self, domain):
+        # Domain IDs are per account
+        return "{0}/{1}".format(pyrax.identity.tenant_id, domain)
 
     @staticmethod
     def _read_credentials_file(creds_file):
@@ -0,0 +1,3 @@
+from .route53 import Route53
+
+__all__ = ['Route53']
\ No newline at end of file
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import boto3
+import botocore.config
+import botocore.exceptions
+import os.path
+import json
+from pathlib import Path
+from ..base_cloud import BaseCloud
+from ..call_policy import THROTTLED, UNAVAILABLE
+from ..cache import JsonFileCache, default_cache_dir
+import logging
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+log = logging.getLogger(__name__)
+
+# Environment variable to override Route 53 API endpoint with. Same as boto3 uses on its own since version 1.28.
+ENDPOINT_URL_ENV = 'AWS_ENDPOINT_URL_ROUTE_53'
+
+# Route 53 is a global service, its API is signed for this region
+ROUTE53_REGION = 'us-east-1'
+
+# Changes in a single ChangeResourceRecordSets call. API maximum is 1000.
+MAX_CHANGES_PER_BATCH = 1000
+
+# Record sets to read when looking for the records of a host. A and AAAA sort first among the types of a name.
+HOST_LISTING_MAX_ITEMS = 10
+
+# Record sets per page when listing a whole zone. API maximum is 300.
+ZONE_LISTING_PAGE_SIZE = 300
+
+# TTL of written records
+RECORD_TTL = 300
+
+# Error codes of throttled requests. Route 53 responds to them with 400, not 429.
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'PriorRequestNotComplete')
+
+
+class Route53(BaseCloud):
+    """
+    AWS Route 53 implementation.
+    Records are written with UPSERT, there is no need to read them first. Changes of many hosts in a zone
+    are applied atomically with a single ChangeResourceRecordSets call.
+    See: https://docs.aws.amazon.com/Route53/latest/APIReference/API_ChangeResourceRecordSets.html
+    """
+    name = 'route53'
+    zone_lookup_method = '_get_hosted_zone_id'
+    upsert_writes = True
+    route53_client = None
+    access_key_id = None
+
+    def __init__(self, zone_cache_file=None, token_cache=None):
+        super().__init__(token_cache=token_cache)
+        # Hosted zone IDs resolved during this run, by zone name
+        self.hosted_zone_ids = {}
+        # Persisted zone name --> hosted zone ID. IDs don't change, entries are dropped only when API says
+        # NoSuchHostedZone.
+        if not zone_cache_file:
+            zone_cache_file = default_cache_dir() + "/route53-zones.json"
+        self.zone_cache = JsonFileCache(zone_cache_file)
+        # Changes waiting to be written with a single call, by zone name. See update_rrs_async().
+        self.pending_batches = {}
+
+    def is_authenticated(self, api_creds=None):
+        """
+        Requests are signed with the credentials, there is no token to get. A client is all it takes.
+        :param api_creds: tuple of access credentials
+        :return: bool
+        """
+        if self.route53_client:
+            return True
+        if not api_creds:
+            return False
+
+        self.authenticate(api_creds)
+
+        return True
+
+    def authenticate(self, api_creds):
+        """
+        Create the API client. No requests are made, invalid credentials fail the first call.
+        :param api_creds: tuple, access key ID and secret access key
+        :return:
+        """
+        # Retries are done by call policy within the deadline, not by botocore on its own
+        config = botocore.config.Config(
+            region_name=ROUTE53_REGION,
+            connect_timeout=self.call_policy.timeout,
+            read_timeout=self.call_policy.timeout,
+            retries={'max_attempts': 0}
+        )
+        self.route53_client = boto3.session.Session().client(
+            'route53',
+            aws_access_key_id=api_creds[0],
+            aws_secret_access_key=api_creds[1],
+            endpoint_url=os.environ.get(ENDPOINT_URL_ENV),
+            config=config
+        )
+        self.access_key_id = api_creds[0]
+        log.info("Using Route 53 with access key {0}".format(self.access_key_id))
+
+    def _transient_error(self, exc):
+        if isinstance(exc, botocore.exceptions.ClientError):
+            metadata = exc.response.get('ResponseMetadata', {})
+            status_code = metadata.get('HTTPStatusCode', 0)
+            retry_after = metadata.get('HTTPHeaders', {}).get('retry-after')
+            if status_code == 429 or exc.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+                return THROTTLED, retry_after
+            if status_code >= 500:
+                return UNAVAILABLE, retry_after
+
+            return None, None
+        if isinstance(exc, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+            # Connection failed or timed out
+            return UNAVAILABLE, None
+
+        return None, None
+
+    def _token_identity(self, api_creds):
+        # Access key ID, secret access key is not needed to tell accounts apart
+        return api_creds[0]
+
+    def get_current_ip_from_dns(self, host, domain, record_type='A'):
+        """
+        Get the current record
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_type: A or AAAA
+        :return: tuple, record set and IP-address, both None if there is no record
+        """
+        return self.get_current_ips_from_dns(host, domain, (record_type,))[record_type]
+
+    def get_current_ips_from_dns(self, host, domain, record_types=('A', 'AAAA')):
+        """
+        Get the current records of multiple types for a host with a single request.
+        Record sets are listed starting from the name of the host.
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, record type: tuple of record object and IP-address, both None if there is no record
+        """
+        record_name = self._record_name(host, domain)
+        response = self._with_hosted_zone_id(domain, lambda hosted_zone_id: self._call(
+            self.route53_client.list_resource_record_sets,
+            HostedZoneId=hosted_zone_id,
+            StartRecordName=record_name,
+            MaxItems=str(HOST_LISTING_MAX_ITEMS)
+        ))
+
+        current = {record_type: (None, None) for record_type in record_types}
+        for record_set in response['ResourceRecordSets']:
+            if record_set['Name'].lower() != record_name.lower():
+                # Listing continues with the next names
+                break
+            if record_set['Type'] not in current or not self._is_simple(record_set):
+                continue
+            current_ip = record_set['ResourceRecords'][0]['Value']
+            log.info("Current {0} address for {1}.{2} is {3}".format(record_set['Type'], host, domain, current_ip))
+            current[record_set['Type']] = (record_set, current_ip)
+
+        return current
+
+    def get_zone_records(self, domain, hosts, record_types=('A', 'AAAA')):
+        """
+        Get the current records of many hosts with a paged listing of all record sets in the zone
+        :param domain: domain part of the FQDNs
+        :param hosts: hostnames of the FQDNs, without dot
+        :param record_types: list of record types, A and/or AAAA
+        :return: dict, (hostname, record type): tuple of record object and IP-address
+        """
+        names = {self._record_name(host, domain).lower(): host for host in hosts}
+        # Pages are fetched while iterating. A failed listing is retried from the start.
+        record_sets = self._with_hosted_zone_id(domain, lambda hosted_zone_id: self._call(lambda: [
+            record_set
+            for page in self.route53_client.get_paginator('list_resource_record_sets').paginate(
+                HostedZoneId=hosted_zone_id, PaginationConfig={'PageSize': ZONE_LISTING_PAGE_SIZE})
+            for record_set in page['ResourceRecordSets']
+        ]))
+
+        current = {}
+        for record_set in record_sets:
+            host = names.get(record_set['Name'].lower())
+            if host is None or record_set['Type'] not in record_types or not self._is_simple(record_set):
+                continue
+            current[(host, record_set['Type'])] = (record_set, record_set['ResourceRecords'][0]['Value'])
+        log.info("Listed {0} record sets of zone {1}, {2} of them for requested hosts".format(
+            len(record_sets), domain, len(current)))
+
+        return current
+
+    def update_rr(self, host, domain, ip, record_to_update, record_type='A'):
+        self.update_rrs(host, domain, [(record_type, ip, record_to_update)])
+
+    def update_rrs(self, host, domain, changes):
+        """
+        Update multiple records of a host with a single request
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param changes: list of tuples: record type, IP-address, existing record object or None
+        :return:
+        """
+        self.update_zone_rrs(domain, [(host, changes)])
+
+    def update_zone_rrs(self, domain, host_changes):
+        """
+        Update records of many hosts of a zone with UPSERTs in a single ChangeResourceRecordSets call.
+        Route 53 applies the changes of a call atomically, all of them or none.
+        :param domain: domain part of the FQDNs
+        :param host_changes: list of tuples: hostname, list of changes as for update_rrs()
+        :return:
+        """
+        changes = [{
+            'Action': 'UPSERT',
+            'ResourceRecordSet': {
+                'Name': self._record_name(host, domain),
+                'Type': record_type,
+                'TTL': RECORD_TTL,
+                'ResourceRecords': [{'Value': ip}],
+            },
+        } for host, changes_of_host in host_changes for record_type, ip, _ in changes_of_host]
+
+        for offset in range(0, len(changes), MAX_CHANGES_PER_BATCH):
+            batch = changes[offset:offset + MAX_CHANGES_PER_BATCH]
+            # UPSERT of the same records has the same outcome, a retried call is harmless
+            self._with_hosted_zone_id(domain, lambda hosted_zone_id: self._call(
+                self.route53_client.change_resource_record_sets,
+                HostedZoneId=hosted_zone_id,
+                ChangeBatch={'Comment': 'cloud-dyndns', 'Changes': batch}
+            ))
+            for change in batch:
+                record_set = change['ResourceRecordSet']
+                log.info("Updated {0} address for {1} as {2}".format(
+                    record_set['Type'], record_set['Name'].rstrip('.'), record_set['ResourceRecords'][0]['Value']))
+
+    async def update_rrs_async(self, host, domain, changes):
+        """
+        Changes of hosts in the same zone made concurrently, as in --config-dir and collector modes,
+        are coalesced into a single ChangeResourceRecordSets call.
+        """
+        import asyncio
+
+        batch = self.pending_batches.get(domain)
+        if batch is not None:
+            # A batch of the zone is being collected, join it
+            future = asyncio.get_running_loop().create_future()
+            batch.append((host, changes, future))
+            return await future
+
+        batch = self.pending_batches[domain] = [(host, changes, None)]
+        # Let the other updates ready to run join the batch
+        await asyncio.sleep(0)
+        del self.pending_batches[domain]
+
+        try:
+            await self.run_blocking(self.update_zone_rrs, domain,
+                                    [(batch_host, batch_changes) for batch_host, batch_changes, _ in batch])
+        except Exception as exc:
+            for _, _, future in batch[1:]:
+                future.set_exception(exc)
+            raise
+        for _, _, future in batch[1:]:
+            future.set_result(None)
+
+    @staticmethod
+    def _record_name(host, domain):
+        return "{0}.{1}.".format(host, domain)
+
+    @staticmethod
+    def _is_simple(record_set):
+        # Alias records and records of routing policies are not maintained by us
+        return 'SetIdentifier' not in record_set and record_set.get('ResourceRecords')
+
+    def _with_hosted_zone_id(self, domain, operation):
+        """
+        Run an operation on a hosted zone.
+        If API says the zone is not there, it is looked up again and operation is retried once.
+        :param domain: name of the DNS zone
+        :param operation: function taking the hosted zone ID as argument
+        :return: whatever operation returns
+        """
+        hosted_zone_id = self._get_hosted_zone_id(domain)
+        try:
+            return operation(hosted_zone_id)
+        except botocore.exceptions.ClientError as exc:
+            # Zone may have been deleted and created again since its ID was cached
+            if exc.response.get('Error', {}).get('Code') != 'NoSuchHostedZone':
+                raise
+            log.debug("Hosted zone {0} of {1} not found, looking it up again".format(hosted_zone_id, domain))
+            self.hosted_zone_ids.pop(domain, None)
+            self.zone_cache.invalidate(self._zone_cache_key(domain))
+
+        return operation(self._get_hosted_zone_id(domain))
+
+    def _get_hosted_zone_id(self, domain):
+        """
+        Find the ID of a public hosted zone
+        :param domain: name of the DNS zone
+        :return: str, hosted zone ID
+        """
+        if domain in self.hosted_zone_ids:
+            return self.hosted_zone_ids[domain]
+
+        hosted_zone_id = self.zone_cache.get(self._zone_cache_key(domain))
+        if hosted_zone_id:
+            log.debug("Hosted zone {0} found from zone cache with ID {1}".format(domain, hosted_zone_id))
+            self.hosted_zone_ids[domain] = hosted_zone_id
+
+            return hosted_zone_id
+
+        # Zones are listed in order of name, starting from the one looked for
+        response = self._call(self.route53_client.list_hosted_zones_by_name, DNSName=domain, MaxItems='10')
+        for hosted_zone in response['HostedZones']:
+            if hosted_zone['Name'].rstrip('.').lower() != domain.lower():
+                break
+            if hosted_zone.get('Config', {}).get('PrivateZone'):
+                continue
+            # ID is like /hostedzone/Z1D633PJN98FT9
+            hosted_zone_id = hosted_zone['Id'].split('/')[-1]
+            self.zone_cache.put(self._zone_cache_key(domain), hosted_zone_id)
+            self.hosted_zone_ids[domain] = hosted_zone_id
+
+            return hosted_zone_id
+
+        log.error("Didn't find domain {0}".format(domain))
+        raise RuntimeError("Didn't find domain {0}".format(domain))
+
+    def _zone_cache_key(self, domain):
+        return "{0}/{1}".format(self.access_key_id, domain)
+
+    @staticmethod
+    def _read_credentials_file(creds_file):
+        """
+        Read given credentials file
+        :param creds_file:
+        :return: tuple, access key ID and secret access key
+        """
+        if not os.path.isfile(creds_file):
+            log.error("AWS credentials file {0} doesn't exist!".format(creds_file))
+            raise RuntimeError("AWS credentials file {0} doesn't exist!".format(creds_file))
+
+        data = json.load(open(creds_file))
+        log.debug("Loaded AWS credentials from {0}".format(creds_file))
+
+        return data['access-key-id'], data['secret-access-key']
+
+    @staticmethod
+    def default_credentials_file():
+        if 'HOME' in os.environ:
+            default_credentials_filename = os.environ['HOME'] + "/.route53.auth"
+        else:
+            default_credentials_filename = str(Path.home()) + "/.route53.auth"
+
+        return default_credentials_filename
+
+    def debug(self, debugging):
+        """
+        Log requests and responses of botocore, as Pyrax does for Rackspace
+        :param debugging: bool
+        :return:
+        """
+        if debugging:
+            boto3.set_stream_logger('botocore.endpoint', logging.DEBUG)
+            boto3.set_stream_logger('botocore.parsers', logging.DEBUG)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+from .cache import JsonFileCache
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def default_state_dir():
+    """
+    Directory for persistent state. Systemd sets $STATE_DIRECTORY for units having StateDirectory=.
+    :return: str, directory name
+    """
+    if os.environ.get('STATE_DIRECTORY'):
+        return os.environ['STATE_DIRECTORY'].split(':')[0]
+    if os.environ.get('XDG_STATE_HOME'):
+        return os.environ['XDG_STATE_HOME'] + "/cloud-dyndns"
+
+    return os.path.expanduser('~') + "/.local/state/cloud-dyndns"
+
+
+class PublishedState(object):
+    """
+    Remember the IP-address last published into DNS for each record.
+    A fresh entry with the same address means there is no need to ask the provider.
+    For providers having conditional writes, ETag of the record is remembered along with the address.
+    """
+
+    def __init__(self, state_file=None):
+        if not state_file:
+            state_file = default_state_dir() + "/published.json"
+        self.store = JsonFileCache(state_file, durable=True)
+
+    @staticmethod
+    def _key(provider_name, host, domain, record_type='A'):
+        return "{0}/{1}/{2}/{3}".format(provider_name, domain, host, record_type)
+
+    def is_published(self, provider_name, host, domain, ip, max_age, record_type='A'):
+        """
+        See if given address was published for the record recently enough
+        :param provider_name: name of the cloud provider
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param ip: IP-address to compare with
+        :param max_age: seconds a published address is trusted without checking it from provider
+        :param record_type: A or AAAA
+        :return: bool
+        """
+        if not max_age:
+            return False
+
+        published_ip = self.store.get(self._key(provider_name, host, domain, record_type), max_age=max_age)
+        if published_ip != ip:
+            return False
+
+        log.debug("{0} address {1} of {2}.{3} was recently published to {4}".format(
+            record_type, ip, host, domain, provider_name))
+
+        return True
+
+    def published(self, provider_name, host, domain, ip, record_type='A', etag=None):
+        """
+        Record the address as published (or verified from provider) now
+        :param provider_name: name of the cloud provider
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param ip: IP-address in DNS
+        :param record_type: A or AAAA
+        :param etag: ETag of the record having the address, optional
+        :return:
+        """
+        key = self._key(provider_name, host, domain, record_type)
+        if not etag:
+            self.store.put(key, ip)
+            return
+
+        # ETag is stored with the address it was seen with. An ETag of any other address is stale.
+        self.store.update({key: ip, key + "/etag": [ip, etag]})
+
+    def batch(self):
+        """
+        :return: context manager, the addresses recorded within it are written into the state file at once
+        """
+        return self.store.batch()
+
+    def published_etag(self, provider_name, host, domain, record_type='A'):
+        """
+        Address last published for the record and ETag the record got, no matter how long ago
+        :param provider_name: name of the cloud provider
+        :param host: hostname of the FQDN, without dot
+        :param domain: domain part of the FQDN
+        :param record_type: A or AAAA
+        :return: tuple, IP-address and ETag. ETag is None if not known.
+        """
+        key = self._key(provider_name, host, domain, record_type)
+        published_ip = self.store.get(key)
+        etag_entry = self.store.get(key + "/etag")
+        if not published_ip or not etag_entry or etag_entry[0] != published_ip:
+            return published_ip, None
+
+        return published_ip, etag_entry[1]
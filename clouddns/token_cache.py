@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import json
+import threading
+import time
+from .cache import default_cache_dir, write_json_atomic
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds before expiry a token is considered due for refresh
+DEFAULT_REFRESH_MARGIN = 300
+
+
+class FileTokenStorage(object):
+    """
+    Store tokens as JSON-files in a directory, one file per key.
+    Files are rw- only for the current user and replaced atomically. Concurrent instances never see a partial file.
+    """
+
+    def __init__(self, directory=None):
+        if not directory:
+            directory = default_cache_dir() + "/tokens"
+        self.directory = directory
+
+    def _filename(self, key):
+        return "{0}/{1}.json".format(self.directory, key)
+
+    def load(self, key):
+        filename = self._filename(key)
+        if not os.path.isfile(filename):
+            return None
+
+        try:
+            with open(filename, 'rt', encoding='utf8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as exc:
+            log.warning("Ignoring unreadable token cache file {0}: {1}".format(filename, exc))
+
+        return None
+
+    def save(self, key, data):
+        write_json_atomic(self._filename(key), data)
+        log.debug("Saved authentication data into cache file {0}".format(self._filename(key)))
+
+    def delete(self, key):
+        try:
+            os.unlink(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+
+class MemoryTokenStorage(object):
+    """
+    Store tokens in process memory only
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            return self._tokens.get(key)
+
+    def save(self, key, data):
+        with self._lock:
+            self._tokens[key] = data
+
+    def delete(self, key):
+        with self._lock:
+            self._tokens.pop(key, None)
+
+
+class TokenCache(object):
+    """
+    Cache of authentication tokens with their expiry times.
+    Expiry is checked locally, a cached token which is still valid doesn't need any request to verify it.
+    """
+
+    def __init__(self, storage=None, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        """
+        :param storage: storage backend with load(), save() and delete(). Default: FileTokenStorage
+        :param refresh_margin: seconds before expiry a token is no longer handed out
+        """
+        if storage is None:
+            storage = FileTokenStorage()
+        self.storage = storage
+        self.refresh_margin = refresh_margin
+
+    def get(self, key):
+        """
+        :param key:
+        :return: tuple, token data and expiry as UNIX-timestamp. None if no token valid for refresh margin.
+        """
+        entry = self.storage.load(key)
+        if not entry:
+            return None
+        if entry['expires'] - self.refresh_margin < time.time():
+            log.debug("Cached token {0} is expired or about to expire".format(key))
+            return None
+
+        return entry['token'], entry['expires']
+
+    def put(self, key, token, expires):
+        """
+        :param key:
+        :param token: JSON-serializable token data
+        :param expires: UNIX-timestamp of token expiry
+        :return:
+        """
+        try:
+            self.storage.save(key, {'expires': expires, 'token': token})
+        except OSError as exc:
+            # Next run will simply authenticate again
+            log.warning("Failed to cache token {0}: {1}".format(key, exc))
+
+    def invalidate(self, key):
+        self.storage.delete(key)
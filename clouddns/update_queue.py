@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import time
+from .cache import JsonFileCache
+from .state import default_state_dir
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait before retrying a failed update, doubled on every failure up to the cap
+RETRY_BASE = 30
+RETRY_CAP = 3600
+
+
+class UpdateQueue(object):
+    """
+    Durable queue of DNS updates, which failed and are to be retried. Kept in state directory, survives reboots.
+    Updates of a host are coalesced: only the latest addresses are kept, an address superseded
+    before it could be written never reaches the provider.
+    """
+
+    def __init__(self, queue_file=None):
+        if not queue_file:
+            queue_file = default_state_dir() + "/pending.json"
+        self.store = JsonFileCache(queue_file, durable=True)
+
+    @staticmethod
+    def _key(provider_name, fqdn):
+        return "{0}/{1}".format(provider_name, fqdn)
+
+    def put(self, provider_name, account, fqdn, addresses, retry_at=None):
+        """
+        Queue an update, which failed or was deferred. Replaces any update of the host queued earlier.
+        :param provider_name: name of the cloud provider
+        :param account: identity of the provider account to update with, see BaseCloud.account_key()
+        :param fqdn: hostname to update
+        :param addresses: dict, record type: IP-address to set
+        :param retry_at: time the deferred update can be retried. None for a failed update, retried with backoff.
+        :return:
+        """
+        key = self._key(provider_name, fqdn)
+        entry = self._entry(self.store.get(key) or {}, account, fqdn, addresses, time.time(), retry_at)
+        self.store.put(key, entry)
+        log.info("Queued update of {0} to {1}, retrying in {2:.0f} seconds".format(
+            fqdn, ', '.join(addresses.values()), entry['retry_at'] - time.time()))
+
+    @staticmethod
+    def _entry(entry, account, fqdn, addresses, now, retry_at=None):
+        # Address changes restart the backoff, retrying the same addresses backs off.
+        # A deferred update didn't fail, it is retried when allowed.
+        attempts = entry.get('attempts', 0) if entry.get('addresses') == addresses else 0
+        if retry_at is None:
+            attempts += 1
+            retry_at = now + min(RETRY_CAP, RETRY_BASE * 2 ** (attempts - 1))
+
+        return {
+            'account': account,
+            'fqdn': fqdn,
+            'addresses': addresses,
+            'attempts': attempts,
+            'retry_at': retry_at,
+        }
+
+    def updated(self, provider_name, account, hosts, failed, deferred=None):
+        """
+        Record the outcome of updating many hosts with a single write: failed and deferred updates are queued,
+        queued updates of the other hosts are done.
+        :param provider_name: name of the cloud provider
+        :param account: identity of the provider account updated with
+        :param hosts: list of (hostname, dict of record type: IP-address) updated
+        :param failed: hostnames failed to update
+        :param deferred: dict, hostname: time the deferred update of it can be retried, optional
+        :return:
+        """
+        deferred = deferred or {}
+        now = time.time()
+        entries = {}
+        with self.store.batch():
+            queued = set(self.store.keys())
+            for fqdn, addresses in hosts:
+                key = self._key(provider_name, fqdn)
+                if fqdn not in failed and fqdn not in deferred:
+                    if key in queued:
+                        self.store.invalidate(key)
+                    continue
+                retry_at = None if fqdn in failed else deferred[fqdn]
+                entries[key] = self._entry(self.store.get(key) or {}, account, fqdn, addresses, now, retry_at)
+            if entries:
+                self.store.update(entries)
+        if entries:
+            log.info("Queued {0} failed or deferred updates for retrying".format(len(entries)))
+
+    def remove(self, provider_name, fqdn):
+        """
+        Forget a queued update of the host. It was done, or the host has got other addresses since.
+        :param provider_name: name of the cloud provider
+        :param fqdn: hostname
+        :return:
+        """
+        self.store.invalidate(self._key(provider_name, fqdn))
+
+    def pending(self, provider_name, account=None, due=False, exclude=()):
+        """
+        :param provider_name: name of the cloud provider
+        :param account: identity of the provider account. None for any account.
+        :param due: only the updates, whose backoff is over
+        :param exclude: hostnames to leave out, they have newer addresses to update
+        :return: list of (hostname, dict of record type: IP-address)
+        """
+        now = time.time()
+
+        return [(entry['fqdn'], entry['addresses']) for entry in self._entries(provider_name, account)
+                if entry['fqdn'] not in exclude and (not due or entry['retry_at'] <= now)]
+
+    def is_backing_off(self, provider_name, fqdn, addresses):
+        """
+        :return: bool, True if an update of the host to these addresses failed recently and is not due yet
+        """
+        entry = self.store.get(self._key(provider_name, fqdn))
+
+        return bool(entry) and entry['addresses'] == addresses and entry['retry_at'] > time.time()
+
+    def next_retry(self, provider_name, account=None):
+        """
+        :return: float, seconds until the next queued update is due. None if nothing is queued.
+        """
+        retry_ats = [entry['retry_at'] for entry in self._entries(provider_name, account)]
+        if not retry_ats:
+            return None
+
+        return max(0.0, min(retry_ats) - time.time())
+
+    def _entries(self, provider_name, account):
+        prefix = self._key(provider_name, '')
+        entries = [self.store.get(key) for key in self.store.keys() if key.startswith(prefix)]
+
+        return [entry for entry in entries if entry and (account is None or entry['account'] == account)]
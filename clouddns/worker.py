@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import logging
+
+log = logging.getLogger(__name__)
+
+# Unix socket of the worker, when not started by systemd
+DEFAULT_SOCKET_PATH = '/run/cloud-dyndns/worker.sock'
+
+# Seconds without triggers before the worker exits. systemd starts it again on the next trigger.
+DEFAULT_IDLE_TIMEOUT = 300
+
+# First file descriptor passed by systemd socket activation, see sd_listen_fds(3)
+SD_LISTEN_FDS_START = 3
+
+# Largest accepted trigger request, in bytes
+MAX_REQUEST_SIZE = 4096
+
+TRIGGER_COMMANDS = ('update',)
+
+
+def systemd_socket():
+    """
+    Socket passed by systemd socket activation. The environment is cleared, not to be inherited by child processes.
+    :return: socket.socket, None if not socket activated
+    """
+    listen_pid = os.environ.pop('LISTEN_PID', None)
+    listen_fds = os.environ.pop('LISTEN_FDS', None)
+    os.environ.pop('LISTEN_FDNAMES', None)
+    if listen_pid != str(os.getpid()) or not listen_fds:
+        return None
+
+    if int(listen_fds) > 1:
+        log.warning("Got {0} sockets from systemd, using only the first one".format(listen_fds))
+
+    return socket.socket(fileno=SD_LISTEN_FDS_START)
+
+
+def bind_socket(socket_path):
+    """
+    Listen on a Unix socket of our own. A stale socket file of an earlier worker is replaced.
+    Only the user running the worker may connect.
+    :param socket_path: path of the socket file
+    :return: socket.socket
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    sock.listen()
+
+    return sock
+
+
+def send_trigger(socket_path, command='update', timeout=None):
+    """
+    Ask a worker to run an update, and wait for it to finish
+    :param socket_path: Unix socket of the worker
+    :param command: what to do, see TRIGGER_COMMANDS
+    :param timeout: seconds to wait for the update, None to wait forever
+    :return: dict, response of the worker: status as exit code, stdout and stderr of the update
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'command': command}).encode('utf8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+
+    return json.loads(response)
+
+
+class Worker(object):
+    """
+    Resident process running updates on trigger. Provider clients, authentication tokens and caches stay
+    loaded between the updates, a trigger costs a few milliseconds of IPC plus the provider API calls.
+    Triggers are handled one at a time, a trigger arriving during an update waits for its turn.
+    """
+
+    def __init__(self, sock, run_update, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        :param sock: listening socket to accept triggers from
+        :param run_update: function without arguments, running an update and returning the exit code of it
+        :param idle_timeout: seconds to wait for a trigger before exiting, 0 to wait forever
+        """
+        self.sock = sock
+        self.run_update = run_update
+        self.idle_timeout = idle_timeout
+
+    def serve(self):
+        """
+        Serve triggers until idle for too long
+        :return: int, number of triggers served
+        """
+        served = 0
+        self.sock.settimeout(self.idle_timeout or None)
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                log.info("No triggers in {0} seconds, exiting".format(self.idle_timeout))
+                return served
+            with conn:
+                self.handle(conn)
+            served += 1
+
+    def handle(self, conn):
+        """
+        Run an update for a trigger and respond with the outcome of it
+        :param conn: connected socket of the trigger
+        :return:
+        """
+        conn.settimeout(1.0)
+        try:
+            request = b''
+            while b'\n' not in request and len(request) <= MAX_REQUEST_SIZE:
+                data = conn.recv(MAX_REQUEST_SIZE)
+                if not data:
+                    break
+                request += data
+            command = json.loads(request)['command']
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            log.warning("Invalid trigger: {0}".format(exc))
+            self._respond(conn, {'status': 2, 'stdout': '', 'stderr': "Error: Invalid trigger\n"})
+            return
+        if command not in TRIGGER_COMMANDS:
+            self._respond(conn, {'status': 2, 'stdout': '', 'stderr': "Error: Unknown command %s\n" % command})
+            return
+
+        # Output of the update goes both to the trigger and to the log of the worker
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                status = self.run_update()
+            except SystemExit as exc:
+                # Update exits on a failed check like a single run does, the worker keeps serving
+                if exc.code is None or isinstance(exc.code, int):
+                    status = exc.code or 0
+                else:
+                    sys.stderr.write("%s\n" % exc.code)
+                    status = 1
+            except Exception as exc:
+                sys.stderr.write("Error: Update failed: %s\n" % exc)
+                status = 1
+        sys.stdout.write(stdout.getvalue())
+        sys.stderr.write(stderr.getvalue())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self._respond(conn, {'status': status, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()})
+
+    @staticmethod
+    def _respond(conn, response):
+        try:
+            conn.settimeout(1.0)
+            conn.sendall(json.dumps(response).encode('utf8') + b'\n')
+        except OSError as exc:
+            # Trigger gave up waiting, the update is done anyway
+            log.debug("Failed to respond to trigger: {0}".format(exc))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import json
+import threading
+import time
+import pytest
+from clouddns import cache
+from clouddns.cache import JsonFileCache
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """
+    Files written by JsonFileCache, in order
+    """
+    written = []
+    write_json_atomic = cache.write_json_atomic
+
+    def counting_write(filename, data):
+        written.append(filename)
+        write_json_atomic(filename, data)
+
+    monkeypatch.setattr(cache, 'write_json_atomic', counting_write)
+
+    return written
+
+
+def read_values(filename):
+    with open(filename) as fp:
+        return {key: entry['value'] for key, entry in json.load(fp).items()}
+
+
+def test_put_writes_every_time(tmp_path, writes):
+    store = JsonFileCache(str(tmp_path / 'store.json'))
+    store.put('a', 1)
+    store.put('b', 2)
+    assert len(writes) == 2
+
+
+def test_batch_writes_once_at_end(tmp_path, writes):
+    filename = str(tmp_path / 'store.json')
+    store = JsonFileCache(filename, durable=True)
+    with store.batch():
+        for index in range(10):
+            store.put("key-{0}".format(index), index)
+        # Changes are seen within the batch
+        assert store.get('key-3') == 3
+        assert not writes
+    assert writes == [filename]
+    assert read_values(filename)['key-9'] == 9
+
+
+def test_nested_batch_writes_at_outermost_end(tmp_path, writes):
+    store = JsonFileCache(str(tmp_path / 'store.json'))
+    with store.batch():
+        with store.batch():
+            store.put('a', 1)
+        assert not writes
+        store.put('b', 2)
+    assert len(writes) == 1
+
+
+def test_batch_without_changes_doesnt_write(tmp_path, writes):
+    store = JsonFileCache(str(tmp_path / 'store.json'))
+    with store.batch():
+        store.get('a')
+    assert not writes
+
+
+def test_batch_is_written_when_block_raises(tmp_path, writes):
+    filename = str(tmp_path / 'store.json')
+    store = JsonFileCache(filename)
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            store.put('a', 1)
+            raise RuntimeError("failed")
+    assert read_values(filename) == {'a': 1}
+
+
+def test_batch_keeps_entries_of_others(tmp_path):
+    filename = str(tmp_path / 'store.json')
+    JsonFileCache(filename).put('other', 1)
+    store = JsonFileCache(filename)
+    with store.batch():
+        store.put('mine', 2)
+    assert read_values(filename) == {'other': 1, 'mine': 2}
+
+
+def test_modify_skips_unchanged_values(tmp_path, writes):
+    store = JsonFileCache(str(tmp_path / 'store.json'))
+    store.put('a', {'ip': '192.0.2.1'})
+
+    def same(stored):
+        stored['a']['ip'] = '192.0.2.1'
+        return stored
+
+    store.modify(['a'], same)
+    assert len(writes) == 1
+
+    def changed(stored):
+        stored['a']['ip'] = '192.0.2.2'
+        return stored
+
+    store.modify(['a'], changed)
+    assert len(writes) == 2
+    assert store.get('a') == {'ip': '192.0.2.2'}
+
+
+def test_modify_doesnt_change_entries_in_place(tmp_path):
+    store = JsonFileCache(str(tmp_path / 'store.json'))
+    store.put('a', {'ip': '192.0.2.1'})
+    seen = []
+
+    def unchanged(stored):
+        stored['a']['ip'] = '192.0.2.2'
+        seen.append(stored['a'])
+        return {}
+
+    store.modify(['a'], unchanged)
+    assert store.get('a') == {'ip': '192.0.2.1'}
+
+
+def test_batch_locks_out_other_writers(tmp_path):
+    filename = str(tmp_path / 'store.json')
+    store = JsonFileCache(filename)
+    other = JsonFileCache(filename)
+    writer = threading.Thread(target=other.put, args=('other', 1))
+    with store.batch():
+        store.put('mine', 1)
+        writer.start()
+        time.sleep(0.1)
+        # Waiting for the lock file
+        assert writer.is_alive()
+    writer.join(5)
+    assert read_values(filename) == {'mine': 1, 'other': 1}
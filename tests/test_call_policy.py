@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import itertools
+import time
+import pytest
+from clouddns.call_policy import CallPolicy, CircuitBreaker, CircuitOpen, THROTTLED, UNAVAILABLE
+
+# Every policy gets a circuit breaker of its own, they are shared by name
+_names = itertools.count()
+
+
+class ApiError(Exception):
+    def __init__(self, kind):
+        super().__init__(kind)
+        self.kind = kind
+
+
+def classify(exc):
+    return exc.kind, None
+
+
+def raising(kind):
+    def call():
+        raise ApiError(kind)
+
+    return call
+
+
+def make_policy(**kwargs):
+    options = dict(deadline=0, retries=0, circuit_failures=1, circuit_reset=0.05)
+    options.update(kwargs)
+
+    return CallPolicy("test-{0}".format(next(_names)), **options)
+
+
+def open_circuit(policy):
+    with pytest.raises(ApiError):
+        policy.call(raising(UNAVAILABLE), classify=classify)
+    assert policy.circuit_breaker.opened_at is not None
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker('test', failures=3, reset=60)
+    breaker.failed()
+    breaker.failed()
+    assert breaker.allow() == 0
+    breaker.failed()
+    assert breaker.allow() > 0
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker('test', failures=2, reset=60)
+    breaker.failed()
+    breaker.succeeded()
+    breaker.failed()
+    assert breaker.allow() == 0
+
+
+def test_zero_failures_never_opens():
+    breaker = CircuitBreaker('test', failures=0, reset=60)
+    for _ in range(10):
+        breaker.failed()
+    assert breaker.allow() == 0
+
+
+def test_half_open_lets_single_trial_through():
+    breaker = CircuitBreaker('test', failures=1, reset=0.05)
+    breaker.failed()
+    assert breaker.allow() > 0
+    time.sleep(0.1)
+    assert breaker.allow() == 0
+    # Trial is running, others wait for its outcome
+    assert breaker.allow() > 0
+    breaker.succeeded()
+    assert breaker.allow() == 0
+    assert breaker.opened_at is None
+
+
+def test_failed_trial_opens_circuit_again():
+    breaker = CircuitBreaker('test', failures=1, reset=0.05)
+    breaker.failed()
+    time.sleep(0.1)
+    assert breaker.allow() == 0
+    breaker.failed()
+    assert breaker.allow() > 0
+
+
+def test_open_circuit_fails_fast():
+    policy = make_policy(circuit_reset=60)
+    open_circuit(policy)
+    calls = []
+    with pytest.raises(CircuitOpen):
+        policy.call(lambda: calls.append(1))
+    assert not calls
+
+
+def test_throttled_trial_closes_circuit():
+    policy = make_policy()
+    open_circuit(policy)
+    time.sleep(0.1)
+    with pytest.raises(ApiError):
+        policy.call(raising(THROTTLED), classify=classify)
+    assert policy.call(lambda: 'ok') == 'ok'
+
+
+def test_trial_is_released_when_classify_raises():
+    def broken_classify(exc):
+        raise ValueError("unexpected error")
+
+    policy = make_policy()
+    open_circuit(policy)
+    time.sleep(0.1)
+    with pytest.raises(ValueError):
+        policy.call(raising(UNAVAILABLE), classify=broken_classify)
+    assert not policy.circuit_breaker.trial_running
+    assert policy.call(lambda: 'ok') == 'ok'
+
+
+def test_trial_is_released_on_base_exception():
+    def interrupted():
+        raise KeyboardInterrupt()
+
+    policy = make_policy()
+    open_circuit(policy)
+    time.sleep(0.1)
+    with pytest.raises(KeyboardInterrupt):
+        policy.call(interrupted, classify=classify)
+    assert policy.call(lambda: 'ok') == 'ok'
+
+
+def test_throttled_call_is_retried():
+    policy = make_policy(retries=2, circuit_failures=5)
+    attempts = []
+
+    def throttled_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ApiError(THROTTLED)
+        return 'ok'
+
+    assert policy.call(throttled_once, classify=classify) == 'ok'
+    assert len(attempts) == 2
+
+
+def test_unavailable_non_idempotent_call_is_not_retried():
+    policy = make_policy(retries=2, circuit_failures=5)
+    attempts = []
+
+    def unavailable():
+        attempts.append(1)
+        raise ApiError(UNAVAILABLE)
+
+    with pytest.raises(ApiError):
+        policy.call(unavailable, idempotent=False, classify=classify)
+    assert len(attempts) == 1
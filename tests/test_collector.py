@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import time
+import pytest
+from clouddns.collector import ReportQueue, parse_report
+
+
+def test_reports_of_host_are_coalesced():
+    queue = ReportQueue(debounce=0.1)
+    queue.put('a.example.com', {'A': '192.0.2.1'})
+    queue.put('b.example.com', {'A': '192.0.2.2'})
+    queue.put('a.example.com', {'A': '192.0.2.3'})
+    assert queue.get_batch(timeout=1) == [('a.example.com', {'A': '192.0.2.3'}), ('b.example.com', {'A': '192.0.2.2'})]
+    assert queue.get_batch(timeout=0.2) == []
+
+
+def test_batch_waits_for_reports_to_settle():
+    queue = ReportQueue(debounce=0.3)
+    queue.put('a.example.com', {'A': '192.0.2.1'})
+    assert queue.get_batch(timeout=0.1) == []
+    started = time.monotonic()
+    assert queue.get_batch(timeout=1) == [('a.example.com', {'A': '192.0.2.1'})]
+    assert time.monotonic() - started < 0.5
+
+
+def test_steady_reports_are_released_by_max_wait():
+    queue = ReportQueue(debounce=0.3, max_wait=0.5)
+    started = time.monotonic()
+    for _ in range(10):
+        queue.put('a.example.com', {'A': '192.0.2.1'})
+        if queue.get_batch(timeout=0.1):
+            break
+    assert 0.5 <= time.monotonic() - started < 0.9
+
+
+def test_newer_report_takes_precedence_over_requeued():
+    queue = ReportQueue(debounce=0.1)
+    queue.put('a.example.com', {'A': '192.0.2.3'})
+    queue.requeue([('a.example.com', {'A': '192.0.2.1'}), ('b.example.com', {'A': '192.0.2.2'})])
+    assert queue.get_batch(timeout=1) == [('a.example.com', {'A': '192.0.2.3'}), ('b.example.com', {'A': '192.0.2.2'})]
+
+
+@pytest.mark.parametrize('body', [
+    '{"hostname": "a.example.com", "addresses": {}}',
+    '{"hostname": "a.example.com", "addresses": {"MX": "192.0.2.1"}}',
+    '{"hostname": "a.example.com", "addresses": {"A": "2001:db8::1"}}',
+    '{"hostname": "a.example.com"}',
+])
+def test_invalid_report_is_refused(body):
+    with pytest.raises((ValueError, KeyError)):
+        parse_report(body)
+
+
+def test_report_hostname_is_lowercased():
+    assert parse_report('{"hostname": "A.Example.COM", "addresses": {"A": "192.0.2.1"}}') == (
+        'a.example.com', {'A': '192.0.2.1'})
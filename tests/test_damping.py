@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import pytest
+from clouddns import cache, damping
+from clouddns.damping import UpdateDamper, RECORD_BURST
+
+HOST = 'www'
+DOMAIN = 'example.com'
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(damping.time, 'time', clock.time)
+
+    return clock
+
+
+@pytest.fixture
+def state_file(tmp_path):
+    return str(tmp_path / 'damping.json')
+
+
+def make_damper(state_file, **kwargs):
+    options = dict(hold_down=0, flap_half_life=0, record_update_rate=0, zone_update_rate=0)
+    options.update(kwargs)
+
+    return UpdateDamper(state_file, **options)
+
+
+def update(damper, ip, record_type='A', host=HOST):
+    """
+    Ask to change the record to the address
+    :return: tuple, allowed changes and deferred ones
+    """
+    return damper.filter('test', host, DOMAIN, {record_type: ip}, [(record_type, ip, None)])
+
+
+def test_update_is_allowed_without_limits(clock, state_file):
+    damper = make_damper(state_file)
+    allowed, deferred = update(damper, '192.0.2.1')
+    assert allowed == [('A', '192.0.2.1', None)]
+    assert not deferred
+    assert damper.next_retry() is None
+
+
+def test_new_address_is_held_down(clock, state_file):
+    damper = make_damper(state_file, hold_down=60)
+    allowed, deferred = update(damper, '192.0.2.1')
+    assert not allowed
+    assert 'hold-down' in deferred[0][2]
+    assert damper.is_deferred('test', HOST, DOMAIN)
+    assert damper.next_retry() == pytest.approx(60)
+
+    clock.advance(30)
+    assert not update(damper, '192.0.2.1')[0]
+    clock.advance(30)
+    assert update(damper, '192.0.2.1')[0]
+    assert not damper.is_deferred('test', HOST, DOMAIN)
+
+
+def test_address_change_restarts_hold_down(clock, state_file):
+    damper = make_damper(state_file, hold_down=60)
+    update(damper, '192.0.2.1')
+    clock.advance(50)
+    update(damper, '192.0.2.2')
+    clock.advance(50)
+    assert not update(damper, '192.0.2.2')[0]
+    clock.advance(10)
+    assert update(damper, '192.0.2.2')[0]
+
+
+def test_flapping_record_is_suppressed_until_penalty_decays(clock, state_file):
+    damper = make_damper(state_file, flap_half_life=900)
+    assert update(damper, '192.0.2.1')[0]
+    assert update(damper, '192.0.2.2')[0]
+    # Second change brings the penalty to the suppress limit
+    allowed, deferred = update(damper, '192.0.2.1')
+    assert not allowed
+    assert 'flapping' in deferred[0][2]
+
+    # Allowed again, once decayed below the reuse limit
+    retry_at = damper.retry_at('test', HOST, DOMAIN)
+    clock.advance(retry_at - clock.now - 1)
+    assert not update(damper, '192.0.2.1')[0]
+    clock.advance(1)
+    assert update(damper, '192.0.2.1')[0]
+
+
+def test_record_update_rate_is_limited_after_burst(clock, state_file):
+    damper = make_damper(state_file, record_update_rate=12)
+    for index in range(RECORD_BURST):
+        assert update(damper, "192.0.2.{0}".format(index + 1))[0]
+    allowed, deferred = update(damper, '192.0.2.100')
+    assert not allowed
+    assert 'record update rate' in deferred[0][2]
+    # A token every 5 minutes
+    assert damper.next_retry() == pytest.approx(300)
+
+    clock.advance(300)
+    assert update(damper, '192.0.2.100')[0]
+
+
+def test_zone_update_rate_is_shared_by_hosts(clock, state_file):
+    damper = make_damper(state_file, zone_update_rate=1)
+    allowed = [update(damper, '192.0.2.1', host="host{0}".format(index))[0] for index in range(damping.ZONE_BURST + 1)]
+    assert all(allowed[:-1])
+    assert not allowed[-1]
+
+
+def test_record_in_dns_already_voids_deferral(clock, state_file):
+    damper = make_damper(state_file, hold_down=60)
+    update(damper, '192.0.2.1')
+    assert damper.is_deferred('test', HOST, DOMAIN)
+    # DNS has the address, nothing to change
+    allowed, deferred = damper.filter('test', HOST, DOMAIN, {'A': '192.0.2.1'}, [])
+    assert not allowed and not deferred
+    assert not damper.is_deferred('test', HOST, DOMAIN)
+
+
+def test_only_changed_record_types_are_allowed(clock, state_file):
+    damper = make_damper(state_file)
+    addresses = {'A': '192.0.2.1', 'AAAA': '2001:db8::1'}
+    allowed, _ = damper.filter('test', HOST, DOMAIN, addresses, [('AAAA', '2001:db8::1', None)])
+    assert allowed == [('AAAA', '2001:db8::1', None)]
+
+
+def test_state_is_shared_by_dampers(clock, state_file):
+    update(make_damper(state_file, hold_down=60), '192.0.2.1')
+    clock.advance(60)
+    # A later run sees the address has been stable for the hold-down
+    assert update(make_damper(state_file, hold_down=60), '192.0.2.1')[0]
+
+
+def test_unchanged_decision_isnt_written(clock, state_file, monkeypatch):
+    damper = make_damper(state_file)
+    damper.filter('test', HOST, DOMAIN, {'A': '192.0.2.1'}, [])
+    writes = []
+    write_json_atomic = cache.write_json_atomic
+    monkeypatch.setattr(cache, 'write_json_atomic', lambda *args: writes.append(args) or write_json_atomic(*args))
+    for _ in range(3):
+        damper.filter('test', HOST, DOMAIN, {'A': '192.0.2.1'}, [])
+    assert not writes
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import socket
+import sys
+import time
+import pytest
+from clouddns.dns_query import AuthoritativeResolver, parse_server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fake_providers import FakeProviderServer  # noqa: E402
+
+ZONE = 'example.com'
+FQDN = 'www.example.com'
+
+# A nameserver not answering is waited for this long
+TIMEOUT = 0.3
+
+
+@pytest.fixture(scope='module')
+def fake_server():
+    server = FakeProviderServer(propagation_delays=(0.0, 0.5))
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def fake_dns(fake_server):
+    """
+    Fake authoritative nameservers of the zone, the second one serving changes after 0.5 seconds
+    """
+    fake_server.dns.load({ZONE: {('www', 'A'): '192.0.2.1', ('www', 'AAAA'): '2001:db8::1'}})
+
+    return fake_server
+
+
+@pytest.fixture
+def silent_server():
+    """
+    Nameserver never answering
+    :return: tuple, IP-address and port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    yield sock.getsockname()
+    sock.close()
+
+
+def make_resolver(servers, tmp_path):
+    return AuthoritativeResolver(servers=[parse_server(server) if isinstance(server, str) else server
+                                          for server in servers],
+                                 timeout=TIMEOUT, cache_file=str(tmp_path / 'nameservers.json'))
+
+
+def test_all_nameservers_have_addresses(fake_dns, tmp_path):
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    assert resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.1', 'AAAA': '2001:db8::1'})
+
+
+def test_different_address(fake_dns, tmp_path):
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    assert not resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.2'})
+
+
+def test_address_missing_of_one_record_type(fake_dns, tmp_path):
+    fake_dns.dns.load({ZONE: {('www', 'A'): '192.0.2.1'}})
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    assert not resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.1', 'AAAA': '2001:db8::1'})
+
+
+def test_nameserver_not_having_change_yet(fake_dns, tmp_path):
+    with fake_dns.dns.lock:
+        fake_dns.dns.put_record(ZONE, 'www', 'A', '192.0.2.2')
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    assert not resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.2'})
+
+
+def test_nameserver_not_answering_is_not_agreement(fake_dns, silent_server, tmp_path):
+    resolver = make_resolver(fake_dns.nameserver_addresses + [silent_server], tmp_path)
+    started = time.monotonic()
+    assert not resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.1'})
+    assert time.monotonic() - started >= TIMEOUT
+
+
+def test_no_nameserver_answering(silent_server, tmp_path):
+    resolver = make_resolver([silent_server], tmp_path)
+    assert not resolver.has_addresses(ZONE, FQDN, {'A': '192.0.2.1'})
+
+
+def test_unknown_zone_is_refused(fake_dns, tmp_path):
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    assert not resolver.has_addresses('example.org', 'www.example.org', {'A': '192.0.2.1'})
+
+
+def test_wait_for_propagated_change(fake_dns, tmp_path):
+    with fake_dns.dns.lock:
+        fake_dns.dns.put_record(ZONE, 'www', 'A', '192.0.2.2')
+    resolver = make_resolver(fake_dns.nameserver_addresses, tmp_path)
+    consistent = resolver.wait_for_addresses(ZONE, FQDN, {'A': '192.0.2.2'}, timeout=5, interval=0.1)
+    first, second = [consistent[tuple(parse_server(server) if isinstance(server, str) else server)]
+                     for server in fake_dns.nameserver_addresses]
+    assert first < 0.5
+    assert 0.5 <= second < 5
+
+
+def test_wait_times_out(fake_dns, silent_server, tmp_path):
+    resolver = make_resolver(fake_dns.nameserver_addresses + [silent_server], tmp_path)
+    started = time.monotonic()
+    consistent = resolver.wait_for_addresses(ZONE, FQDN, {'A': '192.0.2.1'}, timeout=0.5, interval=0.1)
+    assert time.monotonic() - started < 2
+    assert consistent[tuple(silent_server)] is None
+    assert all(seconds is not None for server, seconds in consistent.items() if server != tuple(silent_server))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import argparse
+import importlib.util
+import os
+import pytest
+from clouddns import BaseCloud
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cloud-dyndns.py')
+
+
+@pytest.fixture(scope='module')
+def cloud_dyndns():
+    module_spec = importlib.util.spec_from_file_location('cloud_dyndns', SCRIPT)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    return module
+
+
+def platform_args(platform):
+    return argparse.Namespace(ip_address=None, ipv6_address=None, detect_public_ip=False,
+                              public_ip_from_platform=platform)
+
+
+def test_aws_metadata_address_is_str(cloud_dyndns, monkeypatch):
+    monkeypatch.setattr(BaseCloud, 'get_current_ipv4_from_aws_vm_metadata', staticmethod(lambda: b'192.0.2.10'))
+    ip = cloud_dyndns.get_ip_to_use(platform_args('aws'), argparse.ArgumentParser())
+    assert ip == '192.0.2.10'
+
+
+def test_azure_metadata_address_is_str(cloud_dyndns, monkeypatch):
+    monkeypatch.setattr(BaseCloud, 'get_current_ipv4_from_azure_vm_metadata', staticmethod(lambda: '192.0.2.11'))
+    ip = cloud_dyndns.get_ip_to_use(platform_args('azure'), argparse.ArgumentParser())
+    assert ip == '192.0.2.11'
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import sys
+import threading
+import types
+import pytest
+
+# Pyrax doesn't import on current Python versions. The modules are stubbed with what clouddns.rackspace uses
+# at import time: pyrax.http.req_methods gets replaced, everything else is looked up only when calling the API.
+PYRAX_MODULES = ('pyrax', 'pyrax.clouddns', 'pyrax.exceptions', 'pyrax.http')
+
+
+class ClientException(Exception):
+    def __init__(self, code):
+        super().__init__("HTTP {0}".format(code))
+        self.code = code
+
+
+class Response(object):
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+
+
+class Session(object):
+    """
+    Records the requests made, answers with given headers
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.headers = {}
+
+    def request(self, method, uri, **kwargs):
+        self.requests.append((method, uri, kwargs))
+
+        return Response(self.headers.get(uri))
+
+
+@pytest.fixture
+def rackspace(monkeypatch, tmp_path):
+    """
+    clouddns.rackspace imported fresh on stubbed Pyrax
+    :return: the rackspace module
+    """
+    for name in PYRAX_MODULES:
+        monkeypatch.setitem(sys.modules, name, types.ModuleType(name))
+    pyrax = sys.modules['pyrax']
+    for name in PYRAX_MODULES[1:]:
+        setattr(pyrax, name.split('.')[1], sys.modules[name])
+    pyrax.http.req_methods = {}
+    pyrax.exceptions.ClientException = ClientException
+    pyrax.exceptions.NotFound = type('NotFound', (ClientException,), {})
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.delenv('CACHE_DIRECTORY', raising=False)
+
+    import clouddns
+    import clouddns.rackspace.rackspace as module
+    session = Session()
+    monkeypatch.setattr(module, 'get_session', lambda: session)
+    module.session = session
+
+    yield module
+
+    # Not to be used with real Pyrax
+    for name in ('clouddns.rackspace', 'clouddns.rackspace.rackspace'):
+        sys.modules.pop(name, None)
+    del clouddns.rackspace
+
+
+def make_provider(rackspace, tmp_path, name, deadline=300, timeout=30):
+    from clouddns.call_policy import CallPolicy
+
+    provider = rackspace.Rackspace(domain_cache_file=str(tmp_path / (name + '.json')))
+    provider.call_policy = CallPolicy('rackspace-test', deadline=deadline, timeout=timeout, retries=1)
+
+    return provider
+
+
+def test_request_methods_are_installed_once(rackspace, tmp_path):
+    req_methods = sys.modules['pyrax.http'].req_methods
+    assert set(req_methods) == {"HEAD", "GET", "POST", "PUT", "DELETE", "PATCH"}
+    make_provider(rackspace, tmp_path, 'a')
+    make_provider(rackspace, tmp_path, 'b')
+    assert sys.modules['pyrax.http'].req_methods is req_methods
+
+
+def test_request_is_routed_through_shared_session(rackspace):
+    sys.modules['pyrax.http'].req_methods['PUT']('https://dns.example/v1/domains', data='{}')
+    assert rackspace.session.requests == [
+        ('PUT', 'https://dns.example/v1/domains', {'data': '{}', 'timeout': rackspace.DEFAULT_TIMEOUT})]
+
+
+def test_request_gets_timeout_and_retry_after_of_calling_provider(rackspace, tmp_path):
+    req_methods = sys.modules['pyrax.http'].req_methods
+    first = make_provider(rackspace, tmp_path, 'first', timeout=5)
+    second = make_provider(rackspace, tmp_path, 'second', timeout=20)
+    rackspace.session.headers['https://dns.example/first'] = {'Retry-After': '7'}
+
+    first._call(lambda: req_methods['GET']('https://dns.example/first'))
+    second._call(lambda: req_methods['GET']('https://dns.example/second'))
+
+    assert [kwargs['timeout'] for _, _, kwargs in rackspace.session.requests] == [5, 20]
+    assert first.last_response.retry_after == '7'
+    assert second.last_response.retry_after is None
+
+
+def test_given_timeout_is_kept(rackspace, tmp_path):
+    provider = make_provider(rackspace, tmp_path, 'a', timeout=5)
+    provider._call(lambda: sys.modules['pyrax.http'].req_methods['GET']('https://dns.example/', timeout=2))
+    assert rackspace.session.requests[0][2]['timeout'] == 2
+
+
+def test_calling_provider_is_per_thread_and_restored(rackspace, tmp_path):
+    req_methods = sys.modules['pyrax.http'].req_methods
+    provider = make_provider(rackspace, tmp_path, 'a', timeout=5)
+    in_thread = []
+
+    def call():
+        # Another thread making requests meanwhile isn't subject to the call policy of the provider
+        thread = threading.Thread(target=lambda: in_thread.append(req_methods['GET']('https://dns.example/other')))
+        thread.start()
+        thread.join()
+        return req_methods['GET']('https://dns.example/mine')
+
+    provider._call(call)
+    req_methods['GET']('https://dns.example/after')
+
+    timeouts = {uri: kwargs['timeout'] for _, uri, kwargs in rackspace.session.requests}
+    assert timeouts == {'https://dns.example/other': rackspace.DEFAULT_TIMEOUT, 'https://dns.example/mine': 5,
+                        'https://dns.example/after': rackspace.DEFAULT_TIMEOUT}
+
+
+def test_over_limit_is_retried_after_asked_wait(rackspace, tmp_path):
+    req_methods = sys.modules['pyrax.http'].req_methods
+    provider = make_provider(rackspace, tmp_path, 'a')
+    rackspace.session.headers['https://dns.example/limited'] = {'Retry-After': '0'}
+    attempts = []
+
+    def call():
+        attempts.append(req_methods['GET']('https://dns.example/limited'))
+        if len(attempts) == 1:
+            raise ClientException(413)
+        return 'ok'
+
+    assert provider._call(call) == 'ok'
+    assert len(attempts) == 2
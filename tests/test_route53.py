@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import asyncio
+import os
+import sys
+import pytest
+
+pytest.importorskip('boto3')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from fake_providers import FakeProviderServer  # noqa: E402
+from clouddns.route53.route53 import Route53, ENDPOINT_URL_ENV  # noqa: E402
+
+ZONE = 'example.com'
+
+
+@pytest.fixture(scope='module')
+def fake_server():
+    server = FakeProviderServer()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def route53(fake_server, tmp_path, monkeypatch):
+    fake_server.dns.load({ZONE: {('www', 'A'): '192.0.2.1', ('mail', 'A'): '192.0.2.2'}})
+    monkeypatch.setenv(ENDPOINT_URL_ENV, fake_server.route53_endpoint_url)
+    cloud = Route53(zone_cache_file=str(tmp_path / 'route53-zones.json'))
+    cloud.authenticate(('AKIDEXAMPLE', 'secret'))
+
+    return cloud
+
+
+def test_current_records_of_host(route53):
+    current = route53.get_current_ips_from_dns('www', ZONE)
+    assert current['A'][1] == '192.0.2.1'
+    assert current['AAAA'] == (None, None)
+
+
+def test_concurrent_updates_of_zone_are_coalesced(route53, fake_server):
+    hosts = [('www', '192.0.2.11'), ('mail', '192.0.2.12'), ('new', '192.0.2.13')]
+    # Look up the hosted zone ID before counting
+    route53.get_current_ips_from_dns('www', ZONE)
+    requests = fake_server.dns.requests
+
+    async def update_all():
+        await asyncio.gather(*[route53.update_rrs_async(host, ZONE, [('A', ip, None)]) for host, ip in hosts])
+
+    asyncio.run(update_all())
+    assert fake_server.dns.requests - requests == 1
+    assert {host: fake_server.dns.zones[ZONE][(host, 'A')] for host, _ in hosts} == dict(hosts)
+
+
+def test_zone_records_listing(route53):
+    current = route53.get_zone_records(ZONE, ['www', 'mail', 'missing'])
+    assert {key: ip for key, (_, ip) in current.items()} == {('www', 'A'): '192.0.2.1', ('mail', 'A'): '192.0.2.2'}
+
+
+def test_hosted_zone_id_is_cached(route53, fake_server, tmp_path):
+    route53.get_current_ips_from_dns('www', ZONE)
+    cloud = Route53(zone_cache_file=str(tmp_path / 'route53-zones.json'))
+    cloud.authenticate(('AKIDEXAMPLE', 'secret'))
+    requests = fake_server.dns.requests
+    cloud.get_current_ips_from_dns('www', ZONE)
+    assert fake_server.dns.requests - requests == 1
+
+
+def test_unknown_zone(route53):
+    with pytest.raises(RuntimeError):
+        route53.get_current_ips_from_dns('www', 'example.org')
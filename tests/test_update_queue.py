@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import time
+import pytest
+from clouddns import cache
+from clouddns.update_queue import UpdateQueue, RETRY_BASE, RETRY_CAP
+
+ADDRESSES = {'A': '192.0.2.1'}
+NEW_ADDRESSES = {'A': '192.0.2.2'}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return UpdateQueue(str(tmp_path / 'pending.json'))
+
+
+def entry(queue, fqdn, provider_name='test'):
+    return queue.store.get(queue._key(provider_name, fqdn))
+
+
+def test_updates_of_host_are_coalesced(queue):
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    queue.put('test', 'account', 'www.example.com', NEW_ADDRESSES)
+    assert queue.pending('test') == [('www.example.com', NEW_ADDRESSES)]
+
+
+def test_same_addresses_back_off(queue):
+    now = time.time()
+    for attempt in range(1, 4):
+        queue.put('test', 'account', 'www.example.com', ADDRESSES)
+        assert entry(queue, 'www.example.com')['attempts'] == attempt
+    assert entry(queue, 'www.example.com')['retry_at'] == pytest.approx(now + RETRY_BASE * 4, abs=1)
+
+
+def test_backoff_is_capped(queue):
+    now = time.time()
+    for _ in range(20):
+        queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    assert entry(queue, 'www.example.com')['retry_at'] == pytest.approx(now + RETRY_CAP, abs=1)
+
+
+def test_new_addresses_restart_backoff(queue):
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    queue.put('test', 'account', 'www.example.com', NEW_ADDRESSES)
+    assert entry(queue, 'www.example.com')['attempts'] == 1
+
+
+def test_deferred_update_is_retried_when_allowed(queue):
+    retry_at = time.time() + 600
+    queue.put('test', 'account', 'www.example.com', ADDRESSES, retry_at)
+    assert entry(queue, 'www.example.com')['attempts'] == 0
+    assert entry(queue, 'www.example.com')['retry_at'] == retry_at
+    assert queue.is_backing_off('test', 'www.example.com', ADDRESSES)
+    assert not queue.pending('test', due=True)
+
+
+def test_backing_off_only_for_same_addresses(queue):
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    assert queue.is_backing_off('test', 'www.example.com', ADDRESSES)
+    assert not queue.is_backing_off('test', 'www.example.com', NEW_ADDRESSES)
+    assert not queue.is_backing_off('test', 'other.example.com', ADDRESSES)
+
+
+def test_pending_by_provider_account_and_due(queue):
+    queue.put('test', 'account', 'a.example.com', ADDRESSES)
+    queue.put('test', 'other', 'b.example.com', ADDRESSES)
+    queue.put('other', 'account', 'c.example.com', ADDRESSES)
+    queue.put('test', 'account', 'd.example.com', ADDRESSES, time.time() - 1)
+    assert sorted(fqdn for fqdn, _ in queue.pending('test')) == ['a.example.com', 'b.example.com', 'd.example.com']
+    assert sorted(fqdn for fqdn, _ in queue.pending('test', 'account')) == ['a.example.com', 'd.example.com']
+    assert queue.pending('test', 'account', due=True) == [('d.example.com', ADDRESSES)]
+    assert queue.pending('test', exclude={'a.example.com', 'b.example.com'}) == [('d.example.com', ADDRESSES)]
+
+
+def test_next_retry(queue):
+    assert queue.next_retry('test') is None
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    assert queue.next_retry('test', 'account') == pytest.approx(RETRY_BASE, abs=1)
+    assert queue.next_retry('test', 'other') is None
+
+
+def test_updated_records_outcome_with_single_write(queue, monkeypatch):
+    queue.put('test', 'account', 'done.example.com', ADDRESSES)
+    queue.put('test', 'account', 'failed.example.com', ADDRESSES)
+    writes = []
+    write_json_atomic = cache.write_json_atomic
+    monkeypatch.setattr(cache, 'write_json_atomic', lambda *args: writes.append(args) or write_json_atomic(*args))
+
+    retry_at = time.time() + 600
+    hosts = [('done.example.com', ADDRESSES), ('failed.example.com', ADDRESSES),
+             ('deferred.example.com', NEW_ADDRESSES), ('new.example.com', ADDRESSES)]
+    queue.updated('test', 'account', hosts, ['failed.example.com'], {'deferred.example.com': retry_at})
+
+    assert len(writes) == 1
+    assert sorted(fqdn for fqdn, _ in queue.pending('test')) == ['deferred.example.com', 'failed.example.com']
+    assert entry(queue, 'failed.example.com')['attempts'] == 2
+    assert entry(queue, 'deferred.example.com')['retry_at'] == retry_at
+
+
+def test_queue_survives_restart(tmp_path):
+    UpdateQueue(str(tmp_path / 'pending.json')).put('test', 'account', 'www.example.com', ADDRESSES)
+    assert UpdateQueue(str(tmp_path / 'pending.json')).pending('test') == [('www.example.com', ADDRESSES)]
+
+
+def test_remove(queue):
+    queue.put('test', 'account', 'www.example.com', ADDRESSES)
+    queue.remove('test', 'www.example.com')
+    assert not queue.pending('test')
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+
+# This file is part of Cloud DynDNS.  Cloud DynDNS is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import json
+import socket
+import sys
+import pytest
+from clouddns.worker import Worker
+
+
+def trigger(run_update, request=b'{"command": "update"}\n'):
+    """
+    Have a worker handle a single trigger
+    :return: dict, response of the worker
+    """
+    worker_end, trigger_end = socket.socketpair()
+    with worker_end, trigger_end:
+        trigger_end.sendall(request)
+        trigger_end.shutdown(socket.SHUT_WR)
+        Worker(None, run_update).handle(worker_end)
+        worker_end.shutdown(socket.SHUT_WR)
+        response = b''
+        while True:
+            data = trigger_end.recv(65536)
+            if not data:
+                break
+            response += data
+
+    return json.loads(response)
+
+
+def test_update_status_and_output_are_returned():
+    def run_update():
+        print("Updated")
+        return 0
+
+    response = trigger(run_update)
+    assert response['status'] == 0
+    assert response['stdout'] == "Updated\n"
+
+
+@pytest.mark.parametrize('code, status', [(2, 2), (1, 1), (0, 0), (None, 0), ("Fatal", 1)])
+def test_exit_of_update_is_returned_as_status(code, status):
+    def run_update():
+        sys.stderr.write("Error: No nameservers, cannot continue.\n")
+        sys.exit(code)
+
+    response = trigger(run_update)
+    assert response['status'] == status
+    assert response['stderr'].startswith("Error: No nameservers")
+
+
+def test_exception_of_update_is_a_failure():
+    def run_update():
+        raise RuntimeError("boom")
+
+    response = trigger(run_update)
+    assert response['status'] == 1
+    assert "boom" in response['stderr']
+
+
+def test_invalid_trigger_is_rejected():
+    calls = []
+    response = trigger(lambda: calls.append(1), request=b'not json\n')
+    assert response['status'] == 2
+    assert not calls